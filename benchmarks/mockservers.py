@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+"""Local stand-ins for the Zotero and NCBI web APIs used by passport
+
+Both servers accept what passport sends and answer as the real services do,
+closely enough to be migrated to, with a configurable latency added to every
+request and an optional rate limit beyond which they answer 429 with a
+Retry-After header.  The NCBI server knows about the articles described in
+papersdb.py.  Run this module to leave both servers running in the
+foreground.
+"""
+
+import argparse
+import BaseHTTPServer
+import gzip
+import json
+import random
+import re
+import socket
+import SocketServer
+import string
+import StringIO
+import threading
+import time
+import urlparse
+
+from papersdb import PMID_BASE, PMCID_BASE
+
+
+class Stats(object):
+    """Thread-safe counters of what a mock server has been sent"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class Throttle(object):
+    """Token bucket allowing `rate` requests per second, or any if None"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.rate is None:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, port=0, latency=0, rate=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), handler)
+        self.latency = latency
+        self.throttle = Throttle(rate)
+        self.stats = Stats()
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def server_close(self):
+        """Stop listening, and end the connections clients have kept alive
+
+        Their handler threads would otherwise still be waiting for another
+        request when the interpreter exits.
+        """
+        BaseHTTPServer.HTTPServer.server_close(self)
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body="", headers=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).iteritems():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.stats.add("bytes_in", len(body))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+        return body
+
+    def admit(self, throttle=True):
+        """Count the request, wait out the latency and apply the rate limit
+
+        Returns False (having answered 429) if the request is refused.
+        """
+        self.server.stats.add("requests")
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if throttle and not self.server.throttle.allow():
+            self.server.stats.add("throttled")
+            self.read_body()
+            self.send(429, {}, {"Retry-After": "1"})
+            return False
+        return True
+
+
+class ZoteroHandler(MockHandler):
+    """The parts of the Zotero web API v3 that passport uses
+
+    The library version is kept, along with the version and data of every
+    object written, so that updates to objects modified since the version
+    given are refused as the real API does, and items can be listed and read
+    back.  Items whose data has "deleted" set are in the trash, and are
+    only listed or read back with includeTrashed=1.  Writes whose number
+    (counting from 1) is in fail_writes are refused with HTTP 500, and
+    writes holding an object longer than max_object_bytes once encoded with
+    HTTP 413, for testing how passport recovers.
+    """
+
+    fail_writes = set()
+    max_object_bytes = None
+    files = {}
+    files_lock = threading.Lock()
+    versions = {}
+    objects = {}
+    library = {"version": 0}
+    versions_lock = threading.Lock()
+
+    def do_GET(self):
+        if not self.admit():
+            return
+        path = urlparse.urlsplit(self.path).path
+        if path.startswith("/keys/"):
+            return self.send(200, {"userID": 1, "access": {
+                "user": {"library": True, "files": True, "write": True}}})
+        if path.endswith("/collections/top"):
+            return self.send(200, [])
+        params = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        listed = lambda key: (params.get("includeTrashed") == ["1"] or
+                              not self.objects.get(key, {}).get("deleted"))
+        with self.versions_lock:
+            headers = {"Last-Modified-Version": str(self.library["version"])}
+            if "/collections/" in path and path.endswith("/items/top"):
+                key = path.split("/")[-3]
+                total = sum(1 for x in self.objects.itervalues()
+                            if "parentItem" not in x
+                            and key in x.get("collections", []))
+                headers["Total-Results"] = str(total)
+                return self.send(200, [], headers)
+            if path.endswith("/items/top"):
+                since = int(params.get("since", ["0"])[0])
+                return self.send(200, dict(
+                    (k, v) for k, v in self.versions.iteritems()
+                    if v > since and k in self.objects
+                    and "parentItem" not in self.objects[k] and listed(k)),
+                    headers)
+            if path.endswith("/items") and "itemKey" in params:
+                keys = [k for k in params["itemKey"][0].split(",")
+                        if k in self.versions and listed(k)]
+                if params.get("format") == ["versions"]:
+                    return self.send(200, dict((k, self.versions[k])
+                                               for k in keys), headers)
+                return self.send(200, [
+                    {"key": k, "version": self.versions[k],
+                     "data": dict(self.objects.get(k, {}), key=k,
+                                  version=self.versions[k])}
+                    for k in keys], headers)
+            if path.endswith("/deleted"):
+                return self.send(200, {"items": [], "collections": []},
+                                 headers)
+        self.send(404, {})
+
+    def do_POST(self):
+        # Files are uploaded to storage, which the API rate limit does not
+        # cover
+        path = urlparse.urlsplit(self.path).path
+        if not self.admit(not path.startswith("/upload/")):
+            return
+        body = self.read_body()
+        if path.startswith("/upload/"):
+            self.server.stats.add("files_uploaded")
+            return self.send(201)
+        if path.endswith("/file"):
+            return self.file_request(path.split("/")[-2], body)
+        if path.endswith("/collections") or path.endswith("/items"):
+            return self.write(json.loads(body))
+        self.send(404, {})
+
+    def write(self, objects):
+        self.server.stats.add("writes")
+        success = {}
+        failed = {}
+        with self.versions_lock:
+            self.library["writes"] = self.library.get("writes", 0) + 1
+            refused = self.library["writes"] in self.fail_writes
+        if refused:
+            return self.send(500, {})
+        if self.max_object_bytes is not None and any(
+                len(json.dumps(obj)) > self.max_object_bytes
+                for obj in objects):
+            return self.send(413, {})
+        self.server.stats.add("objects", len(objects))
+        with self.versions_lock:
+            self.library["version"] += 1
+            version = self.library["version"]
+            for i, obj in enumerate(objects):
+                key = obj.get("key")
+                if key is None:
+                    key = "".join(random.choice(
+                        string.ascii_uppercase + string.digits)
+                        for x in range(8))
+                elif self.versions.get(key, 0) > obj.get("version", 0):
+                    failed[str(i)] = {"key": key, "code": 412,
+                                      "message": "Item has been modified "
+                                                 "since specified version"}
+                    continue
+                self.versions[key] = version
+                if "itemType" in obj or key in self.objects:
+                    self.objects[key] = dict(self.objects.get(key, {}), **obj)
+                success[str(i)] = key
+        return self.send(200, {"success": success, "successful": {},
+                               "unchanged": {}, "failed": failed},
+                         {"Last-Modified-Version": str(version)})
+
+    def file_request(self, key, body):
+        params = urlparse.parse_qs(body)
+        with self.files_lock:
+            if "upload" in params:
+                self.files[key] = True
+                return self.send(204)
+            if key in self.files:
+                return self.send(412, {})
+        return self.send(200, {
+            "url": "%s/upload/%s" % (self.server.url, key),
+            "contentType": "application/pdf",
+            "prefix": "",
+            "suffix": "",
+            "uploadKey": "upload-%s" % key
+            })
+
+
+class NCBIHandler(MockHandler):
+    """ESearch, ESummary and EFetch for the articles in papersdb.py"""
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        if not self.admit():
+            return
+        url = urlparse.urlsplit(self.path)
+        body = self.read_body()
+        params = urlparse.parse_qs(body or url.query)
+        tool = url.path.rsplit("/", 1)[-1].split(".")[0]
+        self.server.stats.add(tool)
+        if tool == "esearch":
+            return self.send(200, self.esearch(
+                params["term"][0], int(params.get("retstart", ["0"])[0]),
+                int(params.get("retmax", ["20"])[0])))
+        ids = [x for x in params.get("id", [""])[0].split(",") if x]
+        self.server.stats.add("ids", len(ids))
+        if tool == "esummary":
+            return self.send(200, self.esummary(ids))
+        if tool == "efetch":
+            return self.send(200, self.efetch(ids))
+        self.send(404, "")
+
+    def esearch(self, term, retstart=0, retmax=20):
+        pmids = set()
+        for t in term.split(" OR "):
+            match = re.match(r'"10\.5555/bench\.(\d+)"\[AID\]$', t)
+            if match:
+                pmids.add(PMID_BASE + int(match.group(1)))
+            match = re.match(r"PMC(\d+)\[PMCID\]$", t)
+            if match:
+                pmids.add(PMID_BASE + int(match.group(1)) - PMCID_BASE)
+        return ("<eSearchResult><Count>%s</Count><IdList>%s</IdList>"
+                "</eSearchResult>" % (len(pmids), "".join(
+                    "<Id>%s</Id>" % x
+                    for x in sorted(pmids)[retstart:retstart+retmax])))
+
+    def esummary(self, ids):
+        docsums = []
+        for pmid in ids:
+            n = int(pmid) - PMID_BASE
+            docsums.append(
+                '<DocSum><Id>%s</Id><Item Name="ArticleIds" Type="List">'
+                '<Item Name="pubmed" Type="String">%s</Item>'
+                '<Item Name="doi" Type="String">10.5555/bench.%s</Item>'
+                '<Item Name="pmc" Type="String">PMC%s</Item>'
+                '</Item></DocSum>' % (pmid, pmid, n, PMCID_BASE + n))
+        return "<eSummaryResult>%s</eSummaryResult>" % "".join(docsums)
+
+    def efetch(self, ids):
+        articles = []
+        for pmid in ids:
+            n = int(pmid) - PMID_BASE
+            articles.append(
+                "<PubmedArticle><MedlineCitation><PMID>%s</PMID><Article>"
+                "<Journal><Title>Journal of Benchmarking %s</Title>"
+                "<ISOAbbreviation>J Bench %s</ISOAbbreviation></Journal>"
+                "<Abstract><AbstractText>Abstract of synthetic publication "
+                "%s.</AbstractText></Abstract></Article></MedlineCitation>"
+                "<PubmedData><ArticleIdList>"
+                '<ArticleId IdType="pubmed">%s</ArticleId>'
+                '<ArticleId IdType="doi">10.5555/bench.%s</ArticleId>'
+                '<ArticleId IdType="pmc">PMC%s</ArticleId>'
+                "</ArticleIdList></PubmedData></PubmedArticle>" % (
+                    pmid, n % 50, n % 50, n, pmid, n, PMCID_BASE + n))
+        return "<PubmedArticleSet>%s</PubmedArticleSet>" % "".join(articles)
+
+
+def start(handler, port=0, latency=0, rate=None):
+    """Start a mock server in a background thread and return it"""
+    server = MockServer(handler, port, latency, rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Run mock Zotero and NCBI servers")
+    parser.add_argument("--zotero-port", type=int, default=8080)
+    parser.add_argument("--ncbi-port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds added to every request "
+                             "(default: %(default)s)")
+    parser.add_argument("--zotero-rate", type=float,
+                        help="Requests per second allowed by the Zotero mock")
+    parser.add_argument("--ncbi-rate", type=float,
+                        help="Requests per second allowed by the NCBI mock")
+    args = parser.parse_args()
+    zotero = start(ZoteroHandler, args.zotero_port, args.latency,
+                   args.zotero_rate)
+    ncbi = start(NCBIHandler, args.ncbi_port, args.latency, args.ncbi_rate)
+    print "Zotero API at %s, E-utilities at %s/entrez/eutils" % (zotero.url,
+                                                                 ncbi.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""Generate a synthetic Papers 3 library for benchmarking passport
+
+Only the tables and columns that passport reads are created.  Every item has
+a DOI of the form 10.5555/bench.N and, if it is known to PubMed, the PMID
+20000000+N and PMCID PMC(3000000+N), which is what the mock NCBI server in
+mockservers.py answers with.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import uuid
+
+
+SCHEMA = """
+CREATE TABLE Publication (
+    uuid TEXT PRIMARY KEY, title TEXT, abbreviation TEXT, volume TEXT,
+    number TEXT, startpage TEXT, endpage TEXT, publication_date TEXT,
+    language TEXT, doi TEXT, imported_date REAL, updated_at REAL, notes TEXT,
+    bundle TEXT, type INTEGER, privacy_level INTEGER);
+CREATE TABLE Author (uuid TEXT PRIMARY KEY, prename TEXT, surname TEXT);
+CREATE TABLE OrderedAuthor (
+    object_id TEXT, author_id TEXT, type INTEGER, priority INTEGER);
+CREATE TABLE SyncEvent (
+    device_id TEXT, remote_id TEXT, source_id TEXT, subtype INTEGER);
+CREATE TABLE Keyword (uuid TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE KeywordItem (object_id TEXT, keyword_id TEXT, type INTEGER);
+CREATE TABLE Collection (
+    uuid TEXT PRIMARY KEY, name TEXT, parent TEXT, editable INTEGER);
+CREATE TABLE CollectionItem (object_id TEXT, collection TEXT);
+CREATE TABLE PDF (
+    path TEXT, object_id TEXT, created_at REAL, type INTEGER,
+    mime_type TEXT);
+CREATE INDEX OrderedAuthor_object_id ON OrderedAuthor (object_id);
+CREATE INDEX KeywordItem_object_id ON KeywordItem (object_id);
+CREATE INDEX CollectionItem_object_id ON CollectionItem (object_id);
+CREATE INDEX SyncEvent_device_id ON SyncEvent (device_id);
+CREATE INDEX PDF_object_id ON PDF (object_id);
+"""
+
+PMID_BASE = 20000000
+PMCID_BASE = 3000000
+
+
+def new_uuid(rng):
+    """Return an upper case UUID drawn from rng, as Papers uses"""
+    return str(uuid.UUID(int=rng.getrandbits(128))).upper()
+
+
+def generate(libdir, items=1000, authors=4, tags=3, depth=3, width=4,
+             pdfs=1.0, pdf_size=256, duplicates=0.05, pubmed=0.5, notes=0.25,
+             seed=0):
+    """Write a synthetic Papers library to libdir
+
+    The database is written to libdir/Database.papersdb and the PDFs below
+    libdir/Files.  There are `items` publications, each with `authors`
+    authors and `tags` keywords, filed in a collection tree `depth` levels
+    deep with `width` subcollections per collection.  A fraction `pdfs` of
+    items have a PDF of pdf_size KB, of which a fraction `duplicates` are
+    copies of another item's PDF; a fraction `pubmed` are known to PubMed
+    and a fraction `notes` have notes.  Returns a dictionary of counts.
+    """
+    rng = random.Random(seed)
+    if not os.path.isdir(libdir):
+        os.makedirs(libdir)
+    path = os.path.join(libdir, "Database.papersdb")
+    for f in [path, path + "-wal", path + "-shm"]:
+        if os.path.exists(f):
+            os.remove(f)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    counts = {"items": items, "collections": 0, "pdfs": 0, "pdf_bytes": 0}
+
+    # The collection tree hangs from the non-editable COLLECTIONS collection
+    root = new_uuid(rng)
+    conn.execute("INSERT INTO Collection VALUES (?, 'COLLECTIONS', NULL, 0);",
+                 (root,))
+    collections = []
+    level = [root]
+    for d in xrange(depth):
+        next_level = []
+        for parent in level:
+            for w in xrange(width):
+                x = new_uuid(rng)
+                conn.execute("INSERT INTO Collection VALUES (?, ?, ?, 1);",
+                             (x, "Collection %s.%s" % (d, len(next_level)),
+                              parent))
+                next_level.append(x)
+        collections.extend(next_level)
+        level = next_level
+    counts["collections"] = len(collections)
+
+    journals = []
+    for i in xrange(max(items // 50, 1)):
+        x = new_uuid(rng)
+        conn.execute("INSERT INTO Publication (uuid, title, abbreviation, "
+                     "publication_date, type, privacy_level) "
+                     "VALUES (?, ?, ?, '99000000000000000000000000', -1, 0);",
+                     (x, "Journal of Benchmarking %s" % i, "J Bench %s" % i))
+        journals.append(x)
+
+    author_pool = []
+    for i in xrange(max(items * authors // 3, 10)):
+        x = new_uuid(rng)
+        prename = rng.choice(["John", "Mary Jane", "A B", "Chris T", "Li"])
+        conn.execute("INSERT INTO Author VALUES (?, ?, ?);",
+                     (x, prename, "Surname%s" % i))
+        author_pool.append(x)
+    keyword_pool = []
+    for i in xrange(200):
+        x = new_uuid(rng)
+        conn.execute("INSERT INTO Keyword VALUES (?, ?);",
+                     (x, "keyword %s" % i))
+        keyword_pool.append(x)
+
+    pdf_data = []
+    for i in xrange(items):
+        x = new_uuid(rng)
+        year = 1980 + rng.randint(0, 35)
+        conn.execute("INSERT INTO Publication VALUES (?, ?, NULL, ?, ?, ?, "
+                     "?, ?, 'en', ?, ?, ?, ?, ?, 0, 0);", (
+                         x,
+                         "Synthetic publication %s" % i,
+                         str(rng.randint(1, 300)),
+                         str(rng.randint(1, 12)),
+                         str(i % 900 + 1),
+                         str(i % 900 + 12),
+                         "99%04d%02d%02d1200000000222000" % (
+                             year, rng.randint(0, 12), rng.randint(0, 28)),
+                         "10.5555/bench.%s" % i,
+                         1.3e9 + i,
+                         1.3e9 + i,
+                         "Note for item %s\nSecond line" % i
+                         if rng.random() < notes else None,
+                         rng.choice(journals)
+                         ))
+        for priority, author in enumerate(rng.sample(author_pool,
+                                                     min(authors,
+                                                         len(author_pool)))):
+            conn.execute("INSERT INTO OrderedAuthor VALUES (?, ?, 0, ?);",
+                         (x, author, priority))
+        for keyword in rng.sample(keyword_pool, min(tags, len(keyword_pool))):
+            conn.execute("INSERT INTO KeywordItem VALUES (?, ?, 99);",
+                         (x, keyword))
+        if len(collections) > 0:
+            for collection in rng.sample(collections,
+                                         min(rng.randint(0, 2),
+                                             len(collections))):
+                conn.execute("INSERT INTO CollectionItem VALUES (?, ?);",
+                             (x, collection))
+
+        # Items known to PubMed have either their PMID or their PMCID
+        # recorded; the rest can only be found by DOI
+        if rng.random() < pubmed:
+            if rng.random() < 0.67:
+                conn.execute("INSERT INTO SyncEvent VALUES "
+                             "(?, ?, 'gov.nih.nlm.ncbi.pubmed', 0);",
+                             (x, str(PMID_BASE + i)))
+            else:
+                conn.execute("INSERT INTO SyncEvent VALUES "
+                             "(?, ?, 'gov.nih.nlm.ncbi.pmc', 0);",
+                             (x, "PMC%s" % (PMCID_BASE + i)))
+
+        if rng.random() < pdfs:
+            name = "Files/%X/Synthetic %s.pdf" % (i % 16, i)
+            if len(pdf_data) > 0 and rng.random() < duplicates:
+                data = rng.choice(pdf_data)
+            else:
+                data = "%PDF-1.4\n" + os.urandom(pdf_size * 1024)
+                pdf_data = (pdf_data + [data])[-16:]
+            target = os.path.join(libdir, name)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(target, "wb") as f:
+                f.write(data)
+            conn.execute("INSERT INTO PDF VALUES "
+                         "(?, ?, ?, 0, 'application/pdf');",
+                         (name, x, 1.3e9 + i))
+            counts["pdfs"] += 1
+            counts["pdf_bytes"] += len(data)
+
+    conn.commit()
+    # Papers keeps its library in WAL mode
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Generate a synthetic Papers 3 library")
+    parser.add_argument("libdir", help="Directory to write the library to")
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--authors", type=int, default=4,
+                        help="Authors per item (default: %(default)s)")
+    parser.add_argument("--tags", type=int, default=3,
+                        help="Keywords per item (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Depth of the collection tree "
+                             "(default: %(default)s)")
+    parser.add_argument("--width", type=int, default=4,
+                        help="Subcollections per collection "
+                             "(default: %(default)s)")
+    parser.add_argument("--pdfs", type=float, default=1.0,
+                        help="Fraction of items with a PDF "
+                             "(default: %(default)s)")
+    parser.add_argument("--pdf-size", type=int, default=256,
+                        help="Size of each PDF in KB (default: %(default)s)")
+    parser.add_argument("--duplicates", type=float, default=0.05,
+                        help="Fraction of PDFs duplicating another "
+                             "(default: %(default)s)")
+    parser.add_argument("--pubmed", type=float, default=0.5,
+                        help="Fraction of items known to PubMed "
+                             "(default: %(default)s)")
+    parser.add_argument("--notes", type=float, default=0.25,
+                        help="Fraction of items with notes "
+                             "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    counts = generate(args.libdir, args.items, args.authors, args.tags,
+                      args.depth, args.width, args.pdfs, args.pdf_size,
+                      args.duplicates, args.pubmed, args.notes, args.seed)
+    print ("Wrote %s item(s), %s collection(s) and %s PDF(s) (%.1f MB) "
+           "to %s" % (counts["items"], counts["collections"], counts["pdfs"],
+                      counts["pdf_bytes"] / 1048576.0, args.libdir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""Measure passport's throughput against a synthetic library and mock APIs
+
+A Papers library is generated with papersdb.py and migrated to the mock
+servers in mockservers.py, timing each phase of the migration in turn:
+collections, the PDF inventory, items and PubMed cleanup (run on its own,
+without uploading).  Items are uploaded together with their PDFs as a
+migration does, each PDF as soon as its item has a key.  With --engine
+local, everything is written to an empty Zotero database made by
+zoterodb.py rather than to the mock Zotero API.  Nothing is sent to the
+real Zotero or NCBI services.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mockservers
+import papersdb
+import passport
+import zoterodb
+
+
+def phase(results, name, unit, func, servers):
+    """Run func, which returns a count of `unit`, and record its throughput"""
+    before = [server.stats.snapshot() for server in servers]
+    start = time.time()
+    count = func()
+    elapsed = max(time.time() - start, 0.001)
+    requests = sum(server.stats.snapshot().get("requests", 0)
+                   - b.get("requests", 0)
+                   for server, b in zip(servers, before))
+    results.append({"phase": name, "count": count, "unit": unit,
+                    "seconds": elapsed, "rate": count / elapsed,
+                    "requests": requests})
+
+
+def report(results):
+    print
+    print "%-12s %10s %-11s %9s %11s %9s" % (
+            "phase", "count", "", "seconds", "per second", "requests")
+    for r in results:
+        print "%-12s %10s %-11s %9.2f %11.1f %9s" % (
+                r["phase"], r["count"], r["unit"], r["seconds"], r["rate"],
+                r["requests"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--items", type=int, default=2000,
+                        help="Number of items in the generated library "
+                             "(default: %(default)s)")
+    parser.add_argument("--authors", type=int, default=4,
+                        help="Authors of each item (default: %(default)s)")
+    parser.add_argument("--tags", type=int, default=3,
+                        help="Keywords of each item (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Levels in the collection tree "
+                             "(default: %(default)s)")
+    parser.add_argument("--width", type=int, default=4,
+                        help="Subcollections of each collection "
+                             "(default: %(default)s)")
+    parser.add_argument("--pdfs", type=float, default=1.0,
+                        help="Fraction of items with a PDF "
+                             "(default: %(default)s)")
+    parser.add_argument("--pdf-size", type=int, default=256,
+                        help="Size of each PDF in KB (default: %(default)s)")
+    parser.add_argument("--duplicates", type=float, default=0.05,
+                        help="Fraction of PDFs that copy another item's PDF "
+                             "(default: %(default)s)")
+    parser.add_argument("--pubmed", type=float, default=0.5,
+                        help="Fraction of items known to the mock PubMed "
+                             "(default: %(default)s)")
+    parser.add_argument("--zotero-latency", type=float, default=0.05,
+                        help="Seconds added to each Zotero request "
+                             "(default: %(default)s)")
+    parser.add_argument("--zotero-rate", type=float,
+                        help="Zotero requests per second before 429s")
+    parser.add_argument("--ncbi-latency", type=float, default=0.1,
+                        help="Seconds added to each NCBI request "
+                             "(default: %(default)s)")
+    parser.add_argument("--ncbi-rate", type=float,
+                        help="NCBI requests per second before 429s")
+    parser.add_argument("--workers", type=int, default=passport.WORKERS,
+                        help="Number of concurrent requests to Zotero to "
+                             "start with, as with passport.py "
+                             "(default: %(default)s)")
+    parser.add_argument("--max-workers", type=int,
+                        default=passport.MAX_WORKERS,
+                        help="Most concurrent requests to Zotero while it "
+                             "keeps up (default: %(default)s)")
+    parser.add_argument("--copy-workers", type=int,
+                        default=passport.PDF_WORKERS,
+                        help="Number of PDFs copied or uploaded at once "
+                             "(default: %(default)s)")
+    parser.add_argument("--efetch-size", type=int,
+                        default=passport.PUBMED_FETCH,
+                        help="Number of articles requested from PubMed at a "
+                             "time (default: %(default)s)")
+    parser.add_argument("--ncbi-api-key", action="store_true",
+                        help="Allow 10 NCBI requests per second, as with an "
+                             "API key, rather than 3")
+    parser.add_argument("--upload-pdfs", action="store_true",
+                        help="Upload PDFs to the mock rather than copying")
+    parser.add_argument("--link-pdfs", action="store_true",
+                        help="Hard link PDFs into Zotero storage rather than "
+                             "copying them, as with passport.py")
+    parser.add_argument("--engine", choices=["api", "local"], default="api",
+                        help="Write to the mock Zotero API (the default) or "
+                             "to a local Zotero database")
+    parser.add_argument("--workdir",
+                        help="Directory for the library and Zotero storage "
+                             "(default: a temporary directory, removed "
+                             "afterwards)")
+    parser.add_argument("--json",
+                        help="Also write the results to this file as JSON")
+    parser.add_argument("--metrics-out",
+                        help="Write passport's own metrics report to this "
+                             "file, as with passport.py --metrics-out")
+    args = parser.parse_args()
+
+    passport.WORKERS = args.workers
+    passport.MAX_WORKERS = max(args.max_workers, args.workers)
+    passport.ZOTERO_LIMITER = passport.AdaptiveLimiter(passport.WORKERS,
+                                                       passport.MAX_WORKERS)
+    passport.PDF_WORKERS = args.copy_workers
+    passport.PUBMED_FETCH = args.efetch_size
+    passport.PDF_UPLOAD = args.upload_pdfs
+    passport.PDF_LINK = args.link_pdfs
+    if args.ncbi_api_key:
+        passport.NCBI_LIMITER = passport.RateLimiter(10)
+    if args.metrics_out:
+        passport.METRICS = passport.Metrics()
+        passport.METRICS.add_limiter("zotero", passport.ZOTERO_LIMITER)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="passport-bench-")
+    libdir = os.path.join(workdir, "Library.papers3")
+    datadir = os.path.join(workdir, "Zotero")
+    servers = []
+    try:
+        print "Generating a library of %s item(s) in %s..." % (args.items,
+                                                               libdir)
+        papersdb.generate(libdir, args.items, args.authors, args.tags,
+                          args.depth, args.width, args.pdfs, args.pdf_size,
+                          args.duplicates, args.pubmed)
+
+        zotero = mockservers.start(mockservers.ZoteroHandler,
+                                   latency=args.zotero_latency,
+                                   rate=args.zotero_rate)
+        ncbi = mockservers.start(mockservers.NCBIHandler,
+                                 latency=args.ncbi_latency,
+                                 rate=args.ncbi_rate)
+        passport.ZOTERO_API = zotero.url
+        passport.EUTILS = "%s/entrez/eutils" % ncbi.url
+        servers.extend([zotero, ncbi])
+        if args.engine == "local":
+            if args.upload_pdfs:
+                parser.error("--upload-pdfs cannot be used with --engine "
+                             "local")
+            passport.LOCAL_DB = passport.ZoteroLocal(zoterodb.create(datadir))
+
+        passport.PAPERS_LIBRARY = libdir
+        papersdb_cursor = passport.open_papersdb()
+        journal_path = os.path.join(workdir, "journal.sqlite")
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        if passport.LOCAL_DB is not None:
+            userid = passport.LOCAL_DB.userid
+        else:
+            userid = passport.z_get_userid("benchmark")
+        journal = passport.journal_open(journal_path, userid, False)
+        results = []
+        state = {}
+
+        def collections():
+            p_tld_uuid, p_collections = passport.p_read_collections(
+                    papersdb_cursor)
+            state["collection_map"] = passport.z_recreate_collections(
+                    "benchmark", userid, p_tld_uuid, p_collections, journal)
+            return len(p_collections)
+
+        def inventory():
+            state["pdfs"] = passport.p_read_pdfs(papersdb_cursor, None,
+                                                 dedup=False)
+            return len(state["pdfs"])
+
+        def items():
+            state["item_map"] = passport.z_recreate_items(
+                    "benchmark", userid,
+                    passport.p_item_windows(papersdb_cursor, None),
+                    state["collection_map"], journal, state["pdfs"],
+                    datadir)
+            return len(state["item_map"])
+
+        def commit():
+            passport.journal_finish(journal, 0)
+            return len(state["item_map"])
+
+        def pubmed():
+            return sum(len(window) for window, children in
+                       passport.p_item_windows(papersdb_cursor,
+                                               ["journal", "abstract"]))
+
+        phase(results, "collections", "collections", collections, servers)
+        phase(results, "inventory", "PDFs", inventory, servers)
+        phase(results, "items+pdfs", "items", items, servers)
+        phase(results, "pubmed", "items", pubmed, servers)
+        if passport.LOCAL_DB is not None:
+            phase(results, "commit", "items", commit, servers)
+        report(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"options": vars(args), "results": results,
+                           "zotero": zotero.stats.snapshot(),
+                           "ncbi": ncbi.stats.snapshot()}, f, indent=2)
+        if args.metrics_out:
+            with open(args.metrics_out, "w") as f:
+                json.dump(passport.METRICS.report(), f, indent=2,
+                          sort_keys=True)
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
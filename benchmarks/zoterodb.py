@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Create an empty Zotero database for testing passport --engine local
+
+Only the tables and columns that passport writes to, or reads from, are
+created, following the schema of Zotero 5, with the item types, fields and
+creator types that passport uses.  Run this module to write one to a
+directory, which can then be passed to passport.py as --zotero-dir.
+"""
+
+import argparse
+import os
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE libraries (
+    libraryID INTEGER PRIMARY KEY, type TEXT NOT NULL,
+    editable INT NOT NULL, filesEditable INT NOT NULL,
+    version INT NOT NULL DEFAULT 0, storageVersion INT NOT NULL DEFAULT 0,
+    lastSync INT NOT NULL DEFAULT 0, archived INT NOT NULL DEFAULT 0);
+CREATE TABLE settings (
+    setting TEXT, key TEXT, value, PRIMARY KEY (setting, key));
+CREATE TABLE itemTypes (
+    itemTypeID INTEGER PRIMARY KEY, typeName TEXT, templateItemTypeID INT,
+    display INT DEFAULT 1);
+CREATE TABLE fields (
+    fieldID INTEGER PRIMARY KEY, fieldName TEXT, fieldFormatID INT);
+CREATE TABLE itemTypeFields (
+    itemTypeID INT, fieldID INT, hide INT, orderIndex INT,
+    PRIMARY KEY (itemTypeID, orderIndex), UNIQUE (itemTypeID, fieldID));
+CREATE TABLE creatorTypes (creatorTypeID INTEGER PRIMARY KEY,
+                           creatorType TEXT);
+CREATE TABLE collections (
+    collectionID INTEGER PRIMARY KEY, collectionName TEXT NOT NULL,
+    parentCollectionID INT DEFAULT NULL,
+    clientDateModified TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    libraryID INT NOT NULL, key TEXT NOT NULL,
+    version INT NOT NULL DEFAULT 0, synced INT NOT NULL DEFAULT 0,
+    UNIQUE (libraryID, key));
+CREATE TABLE items (
+    itemID INTEGER PRIMARY KEY, itemTypeID INT NOT NULL,
+    dateAdded TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    dateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    clientDateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    libraryID INT NOT NULL, key TEXT NOT NULL,
+    version INT NOT NULL DEFAULT 0, synced INT NOT NULL DEFAULT 0,
+    UNIQUE (libraryID, key));
+CREATE TABLE itemDataValues (valueID INTEGER PRIMARY KEY, value UNIQUE);
+CREATE TABLE itemData (
+    itemID INT, fieldID INT, valueID, PRIMARY KEY (itemID, fieldID));
+CREATE TABLE creators (
+    creatorID INTEGER PRIMARY KEY, firstName TEXT, lastName TEXT,
+    fieldMode INT, UNIQUE (lastName, firstName, fieldMode));
+CREATE TABLE itemCreators (
+    itemID INT NOT NULL, creatorID INT NOT NULL,
+    creatorTypeID INT NOT NULL DEFAULT 1, orderIndex INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (itemID, orderIndex),
+    UNIQUE (itemID, creatorID, creatorTypeID, orderIndex));
+CREATE TABLE tags (tagID INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE itemTags (
+    itemID INT NOT NULL, tagID INT NOT NULL, type INT NOT NULL,
+    PRIMARY KEY (itemID, tagID));
+CREATE TABLE collectionItems (
+    collectionID INT NOT NULL, itemID INT NOT NULL,
+    orderIndex INT NOT NULL DEFAULT 0, PRIMARY KEY (collectionID, itemID));
+CREATE TABLE itemNotes (
+    itemID INTEGER PRIMARY KEY, parentItemID INT, note TEXT, title TEXT);
+CREATE TABLE itemAttachments (
+    itemID INTEGER PRIMARY KEY, parentItemID INT, linkMode INT,
+    contentType TEXT, charsetID INT, path TEXT, syncState INT DEFAULT 0,
+    storageModTime INT, storageHash TEXT,
+    lastProcessedModificationTime INT);
+"""
+
+ITEM_TYPES = [(1, "note"), (2, "book"), (14, "attachment"),
+              (22, "journalArticle")]
+FIELDS = [(1, "url"), (2, "rights"), (4, "volume"), (5, "issue"),
+          (6, "date"), (7, "series"), (8, "seriesTitle"),
+          (10, "pages"), (12, "publicationTitle"), (13, "ISSN"),
+          (16, "extra"), (18, "journalAbbreviation"), (19, "DOI"),
+          (25, "accessDate"), (26, "seriesText"), (27, "callNumber"),
+          (28, "archiveLocation"), (87, "language"), (90, "abstractNote"),
+          (110, "title"), (116, "shortTitle"), (121, "archive"),
+          (123, "libraryCatalog")]
+TYPE_FIELDS = {
+    "journalArticle": ["title", "abstractNote", "publicationTitle", "volume",
+                       "issue", "pages", "date", "series", "seriesTitle",
+                       "seriesText", "journalAbbreviation", "language",
+                       "DOI", "ISSN", "shortTitle", "url", "accessDate",
+                       "archive", "archiveLocation", "libraryCatalog",
+                       "callNumber", "rights", "extra"],
+    "book": ["title", "abstractNote", "date", "language", "shortTitle",
+             "url", "accessDate", "libraryCatalog", "extra"],
+    "attachment": ["title", "accessDate", "url"]
+    }
+CREATOR_TYPES = [(1, "author"), (2, "contributor"), (3, "editor")]
+
+
+def create(datadir, userid=1):
+    """Write an empty zotero.sqlite, and a storage directory, to datadir
+
+    The user library is library 1, belonging to the Zotero user `userid`.
+    Returns the path to the database.
+    """
+    storage = os.path.join(datadir, "storage")
+    if not os.path.isdir(storage):
+        os.makedirs(storage)
+    path = os.path.join(datadir, "zotero.sqlite")
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.execute("INSERT INTO libraries (libraryID, type, editable, "
+                 "filesEditable) VALUES (1, 'user', 1, 1);")
+    conn.execute("INSERT INTO settings VALUES ('account', 'userID', ?);",
+                 (userid,))
+    conn.executemany("INSERT INTO itemTypes (itemTypeID, typeName) "
+                     "VALUES (?, ?);", ITEM_TYPES)
+    conn.executemany("INSERT INTO fields (fieldID, fieldName) "
+                     "VALUES (?, ?);", FIELDS)
+    type_ids = dict((name, x) for x, name in ITEM_TYPES)
+    field_ids = dict((name, x) for x, name in FIELDS)
+    conn.executemany("INSERT INTO itemTypeFields VALUES (?, ?, NULL, ?);", [
+        (type_ids[item_type], field_ids[field], i)
+        for item_type, fields in TYPE_FIELDS.iteritems()
+        for i, field in enumerate(fields)])
+    conn.executemany("INSERT INTO creatorTypes VALUES (?, ?);", CREATOR_TYPES)
+    conn.commit()
+    conn.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Create an empty Zotero database")
+    parser.add_argument("datadir", help="Directory to write zotero.sqlite to")
+    parser.add_argument("--userid", type=int, default=1)
+    args = parser.parse_args()
+    print "Wrote %s" % create(args.datadir, args.userid)
+
+
+if __name__ == "__main__":
+    main()
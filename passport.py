@@ -2,102 +2,1756 @@
 
 import argparse
 import cgi
+import collections
 import ConfigParser
+import copy
+import ctypes
+import ctypes.util
 import datetime
+import email.utils
+import errno
+import fcntl
+import functools
+import gzip
+import hashlib
+import httplib
+import itertools
 import os
 import json
+import math
+import mmap
+import multiprocessing
 import plistlib
+import Queue
+import random
 import re
 import shutil
+import socket
 import sqlite3
-import subprocess
+import StringIO
+import struct
 import sys
+import threading
 import time
+import traceback
+import unicodedata
 import urllib
-import urllib2
+import urlparse
+import uuid
 import xml.etree.ElementTree
 
+# Maximum number of objects the Zotero API accepts in a single write request
+BATCH_SIZE = 50
+# Largest JSON body (before compression) sent in a single write request; an
+# object larger than this is sent on its own
+BATCH_BYTES = 512 * 1024
+# Number of times an object is sent again after failing with one of
+# WRITE_RETRY_CODES, and the file that objects which could not be written are
+# saved to (see --rejects)
+WRITE_RETRIES = 3
+WRITE_RETRY_CODES = (409, 429, 500, 502, 503, 504)
+REJECTS = None
+# The local Zotero database written to instead of the web API with --engine
+# local (see ZoteroLocal), or None
+LOCAL_DB = None
+# Characters Zotero draws object keys from
+KEY_CHARS = "23456789ABCDEFGHIJKLMNPQRSTUVWXYZ"
+# Number of items read from papers at a time when passing them through PubMed
+PUBMED_WINDOW = 500
+
+# Number of identifiers combined into a single PubMed ESearch request
+PUBMED_TERMS = 200
+# Number of articles retrieved by each PubMed EFetch request (see
+# --efetch-size), and the number of EFetch requests sent at once
+PUBMED_FETCH = 200
+PUBMED_WORKERS = 3
+
+# The Papers preferences, which give the location of the library (see
+# --plist), and the Library.papers3 directory to read instead (see
+# --library)
+PAPERS_PLIST = "~/Library/Preferences/com.mekentosj.papers3.plist"
+PAPERS_LIBRARY = None
+# Bytes of the papers database mapped into memory, and held in sqlite's
+# page cache, for the long sequential scans passport makes of it
+PAPERS_MMAP_SIZE = 1024 * 1024 * 1024
+PAPERS_CACHE_SIZE = 64 * 1024 * 1024
+
+ZOTERO_API = "https://api.zotero.org"
+EUTILS = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+# NCBI allows 3 requests per second, or 10 with an API key (see
+# --ncbi-api-key)
+NCBI_API_KEY = None
+# Number of PDFs copied at once (see --copy-workers) and whether PDFs on the
+# same filesystem are hard linked rather than copied (see --link-pdfs)
+PDF_WORKERS = 4
+PDF_LINK = False
+# Whether PDFs are uploaded to Zotero file storage rather than copied to the
+# local Zotero data directory (see --upload-pdfs)
+PDF_UPLOAD = False
+# Files at least this large are hashed through mmap rather than read()
+MMAP_THRESHOLD = 16 * 1024 * 1024
+# ioctl request for a copy-on-write clone of a file on Linux
+FICLONE = 0x40049409
+
+# Persistent cache of PubMed lookups (see pm_cache_open), how long entries
+# stay valid in seconds and the size in bytes beyond which the least
+# recently used entries are evicted
+PUBMED_CACHE = None
+PUBMED_CACHE_TTL = 90 * 24 * 60 * 60
+PUBMED_CACHE_SIZE = 256 * 1024 * 1024
+# What to do with items already in the Zotero library (see --duplicates):
+# "upload" them again, "skip" them or "link" them to the existing item.
+# Duplicates are found in ZOTERO_INDEX, an index of the library kept
+# between runs (see z_index_open), by DOI, PMID or, for titles of at least
+# INDEX_TITLE_MIN letters and digits, by title and year.
+DUPLICATES = "upload"
+ZOTERO_INDEX = None
+INDEX_TITLE_MIN = 20
+# Number of requests sent to the Zotero API at once when a run starts (see
+# --workers), and the most it may rise to while Zotero keeps up (see
+# --max-workers)
+WORKERS = 4
+MAX_WORKERS = 16
+# Number of times a request that Zotero refuses with HTTP 429 or 503 is sent
+# again before giving up
+ZOTERO_RETRIES = 8
+# Seconds over which the recent request rate is measured for the metrics
+RATE_WINDOW = 10
+# Seconds between looks at a limiter shared between processes (see
+# AdaptiveLimiter) by threads waiting for it
+SHARED_POLL = 0.05
+# Whether request bodies are gzip compressed (see --no-gzip)
+GZIP_BODIES = True
+# Metrics collected for --metrics-out, or None if no report was requested
+METRICS = None
+# Virtual machine instructions between sqlite progress callbacks when
+# collecting metrics
+SQL_PROGRESS_STEPS = 1000
+
+# Idle keep-alive connections, keyed by (scheme, host)
+_http_pool = {}
+_http_pool_lock = threading.Lock()
+# The Papers preferences once read from PAPERS_PLIST (see p_settings)
+_papers_settings = None
+
+
+def http_request(method, url, body=None, headers=None):
+    """Send an HTTP request and return a (status, headers, body) tuple
+
+    Connections are kept alive and returned to a pool shared by all threads,
+    so that consecutive requests do not pay for a new TCP and TLS handshake.
+    If a pooled connection turns out to have been closed by the server
+    before any response arrived (see http_stale), the request is retried
+    once on a fresh connection.  Any other failure, including a timeout or
+    a failure on a fresh connection, is raised, as the server may have acted
+    on the request.  Response header names are lower case.
+
+    body may be a string, or a function returning a file-like object to be
+    streamed (called again if the request is retried), in which case a
+    Content-Length header must be given.
+    """
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    if METRICS is not None:
+        endpoint = metrics_endpoint(method, netloc, path)
+        start = time.time()
+    if query:
+        path = "?".join([path, query])
+    for attempt in xrange(2):
+        with _http_pool_lock:
+            idle = _http_pool.setdefault((scheme, netloc), [])
+            conn = idle.pop() if len(idle) > 0 else None
+        reused = conn is not None
+        if conn is None:
+            if scheme == "https":
+                conn = httplib.HTTPSConnection(netloc, timeout=120)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=120)
+        try:
+            try:
+                conn.request(method, path,
+                             body() if callable(body) else body,
+                             headers or {})
+                res = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                if reused and attempt == 0 and http_stale(e):
+                    conn.close()
+                    continue
+                raise
+            data = res.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if METRICS is not None:
+                METRICS.add_http(endpoint, "error", time.time() - start, 0, 0)
+            raise
+        res_headers = dict((k.lower(), v) for k, v in res.getheaders())
+        if res_headers.get("connection", "").lower() == "close":
+            conn.close()
+        else:
+            with _http_pool_lock:
+                _http_pool[(scheme, netloc)].append(conn)
+        if METRICS is not None:
+            sent = len(body) if isinstance(body, basestring) else int(
+                    (headers or {}).get("Content-Length", 0))
+            METRICS.add_http(endpoint, res.status, time.time() - start, sent,
+                             len(data))
+        return res.status, res_headers, data
+
+
+def http_stale(error):
+    """Return whether error shows a kept-alive connection had been closed
+
+    That is, the server closed the connection or reset it before sending
+    any of a response, rather than the request timing out or the response
+    being malformed.  httplib raises BadStatusLine with an empty line (or,
+    in later versions of Python 2.7, a message saying the server has closed
+    the connection) when no status line arrived at all.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return (error.line in ("", "''") or
+                "closed the connection" in error.line)
+    return (isinstance(error, socket.error) and
+            not isinstance(error, socket.timeout) and
+            error.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED))
+
+
+class LimiterState(object):
+    """The numbers a limiter keeps, given as keyword arguments, as attributes
+
+    If shared, they are kept in shared memory, so that a limiter made before
+    worker processes are started limits them all together (see
+    batch_migrate).  The limiter's lock must be held to use them.
+    """
+
+    def __init__(self, shared, **values):
+        names = sorted(values)
+        if shared:
+            array = multiprocessing.RawArray("d", [values[x] for x in names])
+        else:
+            array = [values[x] for x in names]
+        self.__dict__["_index"] = dict((x, i) for i, x in enumerate(names))
+        self.__dict__["_array"] = array
+
+    def __getattr__(self, name):
+        try:
+            return self._array[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._array[self._index[name]] = value
+
+
+class RateLimiter(object):
+    """Token bucket allowing `rate` calls per second, shared between threads
+
+    Tokens accumulate up to `burst` while the limiter is idle; acquire()
+    blocks until a token is available and then consumes it.  If shared, the
+    bucket is also shared with worker processes started after it is made.
+    """
+
+    def __init__(self, rate, burst=1, shared=False):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.state = LimiterState(shared, tokens=float(burst),
+                                  last=time.time())
+        self.lock = multiprocessing.Lock() if shared else threading.Lock()
+
+    def acquire(self):
+        state = self.state
+        while True:
+            with self.lock:
+                now = time.time()
+                state.tokens = min(self.burst, state.tokens +
+                                   (now - state.last) * self.rate)
+                state.last = now
+                if state.tokens >= 1:
+                    state.tokens -= 1
+                    return
+                wait = (1 - state.tokens) / self.rate
+            time.sleep(wait)
+
+
+NCBI_LIMITER = RateLimiter(3)
+
+
+def http_delay(value):
+    """Return the seconds to wait given by a Retry-After or Backoff header
+
+    The header may give either a number of seconds or an HTTP date.  Returns
+    None if there is no header or it cannot be understood.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0.0)
+
+
+class AdaptiveLimiter(object):
+    """Limit on concurrent requests that adapts to how the server copes
+
+    The limit grows by one for each limit's worth of successful responses
+    and is halved when the server throttles a request (HTTP 429 or 503) or
+    sends a Backoff header, staying between one and `maximum`.  Only a
+    request started after the last cut can cut the limit again, so a burst
+    of throttled responses to requests sent together counts once.  While a
+    Retry-After or Backoff header is in force no request is let through.
+
+    If shared, the limit, and the requests in flight counted against it, are
+    also shared with worker processes started after the limiter is made;
+    the figures for the metrics report are kept by each process.  Threads
+    waiting for a request to finish are woken by those in their own process
+    and look every SHARED_POLL seconds for those finished by others.
+    """
+
+    def __init__(self, limit, maximum, shared=False):
+        self.maximum = float(max(maximum, 1))
+        limit = min(float(max(limit, 1)), self.maximum)
+        self.state = LimiterState(shared, limit=limit, in_flight=0,
+                                  resume_at=0.0, decreased_at=0.0)
+        # The state is only ever used with lock held.  A process can exit
+        # while its threads wait on cond, so cond is never shared: a
+        # multiprocessing.Condition would wait forever to wake them.
+        self.lock = multiprocessing.Lock() if shared else threading.Lock()
+        self.cond = threading.Condition()
+        self.poll = SHARED_POLL if shared else 1
+        self.own = 0
+        self.abandoned = False
+        self.started = time.time()
+        self.recent = collections.deque()
+        self.history = []
+        self.totals = {"requests": 0, "throttled": 0, "backoffs": 0,
+                       "paused_seconds": 0.0, "in_flight_peak": 0,
+                       "concurrency_min": limit,
+                       "concurrency_max": limit}
+
+    def acquire(self):
+        """Wait until a request may be sent and return the time it was let
+        through, to be passed to release()"""
+        state = self.state
+        with self.cond:
+            while True:
+                with self.lock:
+                    now = time.time()
+                    if self.abandoned:
+                        return now
+                    wait = state.resume_at - now
+                    if wait <= 0 and state.in_flight < int(state.limit):
+                        state.in_flight += 1
+                        self.own += 1
+                        in_flight = int(state.in_flight)
+                        break
+                self.cond.wait(wait if wait > 0 else self.poll)
+            self.totals["in_flight_peak"] = max(self.totals["in_flight_peak"],
+                                                in_flight)
+            return now
+
+    def release(self, started, status, headers):
+        """Record the response to a request let through at `started`
+
+        status is None if no response was received, which leaves the limit
+        as it is.
+        """
+        state = self.state
+        retry_after = http_delay(headers.get("retry-after"))
+        backoff = http_delay(headers.get("backoff"))
+        paused = 0
+        with self.cond:
+            with self.lock:
+                if self.abandoned:
+                    return
+                now = time.time()
+                state.in_flight -= 1
+                self.own -= 1
+                if status in (429, 503) or backoff is not None:
+                    if started >= state.decreased_at:
+                        state.limit = max(state.limit / 2, 1.0)
+                        state.decreased_at = now
+                    paused = self.pause(now, max(retry_after or 0,
+                                                 backoff or 0))
+                elif status is not None and status < 400:
+                    state.limit = min(state.limit + 1 / state.limit,
+                                      self.maximum)
+                limit = state.limit
+            self.totals["requests"] += 1
+            self.recent.append(now)
+            while self.recent[0] < now - RATE_WINDOW:
+                self.recent.popleft()
+            if status in (429, 503):
+                self.totals["throttled"] += 1
+            elif backoff is not None:
+                self.totals["backoffs"] += 1
+            if paused >= 1:
+                print "Zotero asked for a pause of %s second(s)..." % int(
+                        math.ceil(paused))
+            self.totals["concurrency_min"] = min(
+                    self.totals["concurrency_min"], limit)
+            self.totals["concurrency_max"] = max(
+                    self.totals["concurrency_max"], limit)
+            elapsed = now - self.started
+            if len(self.history) == 0 or elapsed - self.history[-1][0] >= 1:
+                self.history.append((round(elapsed, 1), round(limit, 2),
+                                     self.rate(now)))
+            self.cond.notify_all()
+
+    def pause(self, now, seconds):
+        # Hold back every request for `seconds` from now and return the
+        # pause, or 0 if one already in force lasts longer; called with
+        # the lock held
+        state = self.state
+        if now + seconds <= state.resume_at:
+            return 0
+        self.totals["paused_seconds"] += now + seconds - max(state.resume_at,
+                                                             now)
+        state.resume_at = now + seconds
+        return seconds
+
+    def abandon(self):
+        """Stop counting the requests this process has in flight
+
+        A worker process that gives up on a library part way through (see
+        batch_library) leaves requests in flight, which would otherwise
+        count against a shared limit for ever.  Requests are let through
+        uncounted from then on.
+        """
+        with self.cond:
+            with self.lock:
+                self.state.in_flight -= self.own
+                self.own = 0
+                self.abandoned = True
+            self.cond.notify_all()
+
+    def rate(self, now):
+        # Requests completed per second over the last RATE_WINDOW seconds
+        return round(len(self.recent) / max(min(now - self.started,
+                                                RATE_WINDOW), 0.001), 2)
+
+    def stats(self):
+        """Return the current and overall figures for the metrics report
+
+        "history" samples the concurrency limit and request rate at most
+        once a second, as (seconds since start, limit, requests per second).
+        """
+        with self.lock:
+            limit = self.state.limit
+        with self.cond:
+            now = time.time()
+            stats = dict(self.totals)
+            stats.update({
+                "concurrency_min": round(self.totals["concurrency_min"], 2),
+                "concurrency_max": round(self.totals["concurrency_max"], 2),
+                "paused_seconds": round(self.totals["paused_seconds"], 2),
+                "concurrency": round(limit, 2),
+                "rate": self.rate(now),
+                "mean_rate": round(self.totals["requests"] /
+                                   max(now - self.started, 0.001), 2),
+                "history": list(self.history)
+                })
+            return stats
+
+
+ZOTERO_LIMITER = AdaptiveLimiter(WORKERS, MAX_WORKERS)
+
+
+class ChainReader(object):
+    """File-like object reading from a sequence of strings and open files
+
+    Files are closed once they have been read to the end.
+    """
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+
+    def read(self, size=-1):
+        chunks = []
+        while len(self.parts) > 0 and (size < 0 or size > 0):
+            part = self.parts[0]
+            if isinstance(part, basestring):
+                chunk = part if size < 0 else part[:size]
+                if len(chunk) == len(part):
+                    self.parts.pop(0)
+                else:
+                    self.parts[0] = part[len(chunk):]
+            else:
+                chunk = part.read(size)
+                if len(chunk) == 0:
+                    part.close()
+                    self.parts.pop(0)
+                    continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+
+def gzip_compress(data):
+    """Return data gzip compressed, for use as a request body"""
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="wb")
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+def pool_imap(func, iterable, workers, salvage=None):
+    """Yield func(x) for each x in iterable using a pool of worker threads
+
+    Results are yielded in the same order as iterable.  At most twice as many
+    calls as there are workers are queued at once, so iterable is consumed no
+    faster than the results are.  An exception raised by func (including
+    SystemExit from sys.exit) or by iterable is re-raised in the calling
+    thread, but only once the calls already running have finished; those
+    not yet started are dropped.  The results of the calls that succeeded
+    but were not yielded are first passed to salvage, if given, so that the
+    caller can record what they did.
+    """
+    if workers <= 1:
+        for x in iterable:
+            yield func(x)
+        return
+
+    results = Queue.Queue()
+    pool = WorkerPool(workers, results)
+    finished = {}
+    position = {"submitted": 0, "yielded": 0}
+
+    def take():
+        # Return the next result in order, waiting for it if need be
+        while position["yielded"] not in finished:
+            tag, value = WorkerPool.wait(results)[1:]
+            finished[tag] = value
+        position["yielded"] += 1
+        return finished.pop(position["yielded"] - 1)
+
+    try:
+        try:
+            for x in iterable:
+                pool.submit(position["submitted"], func, x)
+                position["submitted"] += 1
+                if (position["submitted"] - position["yielded"] >=
+                        2 * workers):
+                    yield take()
+            while position["yielded"] < position["submitted"]:
+                yield take()
+        except GeneratorExit:
+            raise
+        except BaseException:
+            error = sys.exc_info()
+            for _, tag, value in WorkerPool.drain(results, [pool]):
+                finished[tag] = value
+            if salvage is not None:
+                for tag in sorted(finished):
+                    salvage(finished[tag])
+            raise error[0], error[1], error[2]
+    finally:
+        pool.cancel()
+        pool.close()
+
+
+class WorkerPool(object):
+    """Threads running calls submitted from the calling thread
+
+    Calls can be submitted at any time (pool_imap is built on this for the
+    simpler case of mapping over an iterable).  The outcome of each is put
+    on `results`, which several pools may share, and is collected with
+    WorkerPool.wait.
+    """
+
+    def __init__(self, workers, results):
+        self.tasks = Queue.Queue()
+        self.results = results
+        self.pending = 0
+        self.threads = [threading.Thread(target=self.work)
+                        for _ in xrange(max(workers, 1))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            tag, func, args = task
+            try:
+                self.results.put((self, tag, True, func(*args)))
+            except BaseException:
+                self.results.put((self, tag, False, sys.exc_info()))
+
+    def submit(self, tag, func, *args):
+        """Call func(*args) on one of the threads, identifying it by tag"""
+        self.pending += 1
+        self.tasks.put((tag, func, args))
+
+    def close(self):
+        for t in self.threads:
+            self.tasks.put(None)
+
+    def cancel(self):
+        """Drop the calls that have not started yet"""
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except Queue.Empty:
+                return
+            self.pending -= 1
+
+    @staticmethod
+    def next(results):
+        """Return the (pool, tag, ok, value) of the next call to finish
+
+        value is the result of the call if ok, or else its exc_info.
+        """
+        while True:
+            # Waiting with a timeout keeps the main thread responsive to ^C
+            try:
+                pool, tag, ok, value = results.get(True, 1)
+                break
+            except Queue.Empty:
+                pass
+        pool.pending -= 1
+        return pool, tag, ok, value
+
+    @staticmethod
+    def wait(results):
+        """Return the (pool, tag, result) of the next call to finish
+
+        An exception raised by the call (including SystemExit from sys.exit)
+        is re-raised here instead.
+        """
+        pool, tag, ok, value = WorkerPool.next(results)
+        if not ok:
+            raise value[0], value[1], value[2]
+        return pool, tag, value
+
+    @staticmethod
+    def drain(results, pools):
+        """Yield the (pool, tag, result) of every call still to finish
+
+        This is for giving up once one call has failed: the calls in `pools`
+        (all of those sharing `results`) that have not started are dropped,
+        and those already running are waited for so that nothing carries on
+        behind the caller's back.  Those that succeed are yielded, so that
+        what they did can still be recorded; further failures are ignored.
+        """
+        for pool in pools:
+            pool.cancel()
+        while any(pool.pending > 0 for pool in pools):
+            pool, tag, ok, value = WorkerPool.next(results)
+            if ok:
+                yield pool, tag, value
+
+
+class Metrics(object):
+    """Timings and counts collected for the --metrics-out report
+
+    Phases are timed by functions decorated with timed, sqlite statements on
+    connections wrapped by metrics_connection, HTTP requests by http_request
+    and request rates by any limiter given to add_limiter.  It is safe to
+    record from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.sql = {}
+        self.http = {}
+        self.limiters = {}
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0})
+            phase["calls"] += 1
+            phase["seconds"] += seconds
+
+    def add_sql(self, sql, seconds=0.0, calls=0, rows=0, steps=0):
+        with self.lock:
+            statement = self.sql.setdefault(sql, {
+                "calls": 0, "seconds": 0.0, "rows": 0, "steps": 0})
+            statement["calls"] += calls
+            statement["seconds"] += seconds
+            statement["rows"] += rows
+            statement["steps"] += steps
+
+    def add_http(self, endpoint, status, seconds, sent, received):
+        with self.lock:
+            requests = self.http.setdefault(endpoint, {
+                "requests": 0, "bytes_sent": 0, "bytes_received": 0,
+                "status": {}, "latency": []})
+            requests["requests"] += 1
+            requests["bytes_sent"] += sent
+            requests["bytes_received"] += received
+            requests["status"][str(status)] = requests["status"].get(
+                    str(status), 0) + 1
+            requests["latency"].append(seconds)
+
+    def add_limiter(self, name, limiter):
+        """Include the stats() of an AdaptiveLimiter in the report"""
+        with self.lock:
+            self.limiters[name] = limiter
+
+    def report(self):
+        """Return the metrics as a dictionary to be written out as JSON
+
+        Latencies are summarised by their mean, median, 90th and 99th
+        percentiles and maximum, in seconds.  Statements are listed in
+        descending order of the time spent on them, where "steps" counts
+        (approximately) the sqlite virtual machine instructions they ran.
+        """
+        with self.lock:
+            http = {}
+            for endpoint, requests in self.http.iteritems():
+                latency = sorted(requests["latency"])
+                percentile = lambda p: latency[min(int(len(latency) * p),
+                                                   len(latency) - 1)]
+                http[endpoint] = dict((k, v) for k, v in requests.iteritems()
+                                      if k != "latency")
+                http[endpoint]["latency"] = {
+                    "mean": sum(latency) / len(latency),
+                    "p50": percentile(0.5),
+                    "p90": percentile(0.9),
+                    "p99": percentile(0.99),
+                    "max": latency[-1]
+                    }
+            sql = []
+            for statement in sorted(self.sql, reverse=True,
+                                    key=lambda x: self.sql[x]["seconds"]):
+                sql.append(dict(self.sql[statement], statement=statement))
+            return {"elapsed": time.time() - self.started,
+                    "phases": dict((k, dict(v))
+                                   for k, v in self.phases.iteritems()),
+                    "sql": sql,
+                    "http": http,
+                    "limiters": dict((k, v.stats())
+                                     for k, v in self.limiters.iteritems())}
+
+
+def metrics_endpoint(method, netloc, path):
+    """Return the name under which a request is counted in METRICS
+
+    User IDs, object keys and API keys in the path are replaced by "*" so
+    that, for example, every item write is counted together.
+    """
+    path = "/".join("*" if re.match(r"^([0-9]+|[A-Z0-9]{8}|[A-Za-z0-9]{24})$",
+                                    x) else x
+                    for x in path.split("/"))
+    return " ".join([method, netloc + path])
+
+
+def timed(name):
+    """Decorator recording the time spent in a function as the phase `name`
+
+    Phases may be nested; each records its own total.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if METRICS is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.add_phase(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+class TimedConnection(object):
+    """sqlite3 connection recording its statements in METRICS
+
+    Cursors are wrapped in TimedCursor.  A progress handler counts virtual
+    machine instructions against whichever statement is running, which
+    shows the work sqlite did even for queries whose rows are read lazily.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._running = None
+        conn.set_progress_handler(self._progress, SQL_PROGRESS_STEPS)
+
+    def _progress(self):
+        if self._running is not None:
+            METRICS.add_sql(self._running, steps=SQL_PROGRESS_STEPS)
+        return 0
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self):
+        return TimedCursor(self, self._conn.cursor())
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class TimedCursor(object):
+    """sqlite3 cursor recording time spent executing and reading rows"""
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self._cursor = cursor
+        self._sql = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _step(self, func, *args):
+        # Time one call on the cursor, counting it and any rows returned
+        # against the current statement
+        running = self.connection._running
+        self.connection._running = self._sql
+        start = time.time()
+        rows = 0
+        try:
+            result = func(*args)
+            if isinstance(result, list):
+                rows = len(result)
+            elif result is not None and result is not self._cursor:
+                rows = 1
+            return result
+        finally:
+            self.connection._running = running
+            METRICS.add_sql(self._sql, time.time() - start, rows=rows)
+
+    def execute(self, sql, parameters=()):
+        self._sql = " ".join(sql.split())
+        METRICS.add_sql(self._sql, calls=1)
+        self._step(self._cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = " ".join(sql.split())
+        METRICS.add_sql(self._sql, calls=1)
+        self._step(self._cursor.executemany, sql, seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        return self._step(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._step(self._cursor.fetchall)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._step(self._cursor.next)
+
+
+def metrics_connection(conn):
+    """Return conn wrapped to record its statements if METRICS is set"""
+    if METRICS is None:
+        return conn
+    return TimedConnection(conn)
+
+
+def z_request(method, url, body=None, headers=None):
+    """Send a request to the Zotero API, as far as ZOTERO_LIMITER allows
+
+    Requests that Zotero refuses with HTTP 429 or 503 are sent again, up to
+    ZOTERO_RETRIES times, once the pause it asked for in its Retry-After
+    header has passed or, failing that, after an increasing delay.  Takes
+    and returns the same as http_request.
+    """
+    for attempt in xrange(ZOTERO_RETRIES + 1):
+        started = ZOTERO_LIMITER.acquire()
+        status, res_headers = None, {}
+        try:
+            status, res_headers, data = http_request(method, url, body,
+                                                     headers)
+        finally:
+            ZOTERO_LIMITER.release(started, status, res_headers)
+        if status not in (429, 503):
+            break
+        if http_delay(res_headers.get("retry-after")) is None:
+            time.sleep(min(2 ** attempt, 60))
+    return status, res_headers, data
+
 
 def z_get_userid(token):
     """Validate the Zotero API token and return the user ID"""
     print "Retrieving user information from the Zotero API..."
-    req = urllib2.Request("https://api.zotero.org/keys/%s" % token)
-    req.add_header("Zotero-API-Version", "3")
-    try:
-        f = urllib2.urlopen(req)
-    except urllib2.HTTPError:
+    status, headers, data = z_request(
+            "GET",
+            "%s/keys/%s" % (ZOTERO_API, token),
+            headers={"Zotero-API-Version": "3"}
+            )
+    if status != 200:
         sys.exit("Could not authenticate with Zotero API: was the token "
                  "correct?")
-    result = json.load(f)
+    result = json.loads(data)
     if not (result["access"]["user"]["library"]
             and result["access"]["user"]["write"]):
         sys.exit("This token does not appear to have sufficient privileges")
     return result["userID"]
 
 
-def z_api_write(token, url, data):
+def z_encode(obj):
+    """Return obj encoded as JSON for the Zotero API
+
+    Keys beginning with "papers_" are local references to the papers library
+    (such as "papers_uuid") and are left out of what is sent.
+    """
+    return json.dumps(dict((k, v) for k, v in obj.iteritems()
+                           if not k.startswith("papers_")))
+
+
+def z_write_batch(token, url, chunk):
+    """Write one batch of objects to the Zotero API
+
+    chunk is a list of (object, encoded JSON) pairs.  Each request carries
+    its own Zotero-Write-Token so that a batch which is sent again (for
+    example after a dropped connection) is not written twice.  Objects that
+    fail with a temporary error are sent again on their own, up to
+    WRITE_RETRIES times with an increasing delay.  A batch refused as a
+    whole, as too large (HTTP 413) or malformed (HTTP 400), is halved and
+    each half written in turn, so that only the object to blame fails.
+    Returns the keys written and the failures, each as a dictionary keyed by
+    index within chunk, and the library version after the last request (or
+    None if Zotero did not say).  Objects left unchanged by an update count
+    as written.  With --engine local the objects are written to LOCAL_DB
+    instead.
+    """
+    if LOCAL_DB is not None:
+        return LOCAL_DB.write(url, [obj for obj, encoded in chunk])
+    pending = range(len(chunk))
+    chunk_success = {}
+    chunk_failed = {}
+    version = None
+    for attempt in xrange(WRITE_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(2 ** (attempt - 1))
+        body = "[%s]" % ",".join(chunk[i][1] for i in pending)
+        headers = {
+            "Zotero-API-Key": token,
+            "Zotero-API-Version": "3",
+            "Content-Type": "application/json",
+            "Zotero-Write-Token": uuid.uuid4().hex
+            }
+        if GZIP_BODIES:
+            body = gzip_compress(body)
+            headers["Content-Encoding"] = "gzip"
+        status, res_headers, res_body = z_request("POST", url, body, headers)
+        if status in (400, 413) and len(pending) > 1:
+            half = len(pending) // 2
+            for part in [pending[:half], pending[half:]]:
+                success, failed, part_version = z_write_batch(
+                        token, url, [chunk[i] for i in part])
+                chunk_success.update((part[i], key)
+                                     for i, key in success.iteritems())
+                chunk_failed.update((part[i], failure)
+                                    for i, failure in failed.iteritems())
+                if part_version is not None:
+                    version = part_version
+            break
+        if status in (400, 413):
+            chunk_failed[pending[0]] = {
+                    "code": status,
+                    "message": res_body.decode("utf-8", "replace").strip()}
+            break
+        if status != 200:
+            sys.exit("Error: received HTTP %s" % status)
+        res_json = json.loads(res_body)
+        if res_headers.get("last-modified-version") is not None:
+            version = int(res_headers["last-modified-version"])
+        for k, key in itertools.chain(
+                res_json["success"].iteritems(),
+                res_json.get("unchanged", {}).iteritems()):
+            chunk_success[pending[int(k)]] = key
+        retry = []
+        for k, failure in res_json["failed"].iteritems():
+            if (failure.get("code") in WRITE_RETRY_CODES and
+                    attempt < WRITE_RETRIES):
+                retry.append(pending[int(k)])
+            else:
+                chunk_failed[pending[int(k)]] = failure
+        if len(retry) == 0:
+            break
+        pending = sorted(retry)
+    return chunk_success, chunk_failed, version
+
+
+def z_take_batch(queue):
+    """Remove and return the next batch from a list of encoded objects
+
+    queue holds tuples whose second element is the encoded JSON, as from
+    z_encode.  The batch is as long as BATCH_SIZE and BATCH_BYTES allow, but
+    always holds at least one object if there is one.
+    """
+    size = 0
+    n = 0
+    while n < min(len(queue), BATCH_SIZE):
+        size += len(queue[n][1]) + 1
+        if n > 0 and size > BATCH_BYTES:
+            break
+        n += 1
+    batch = queue[:n]
+    del queue[:n]
+    return batch
+
+
+def z_api_write(token, url, data, on_batch=None, on_failed=None):
     """Write the supplied data to the zotero API.
 
     The data should be in the format of a list of dictionaries which is
-    converted into the JSON expected by the Zotero API.  It takes care of
-    uploading in batches of fifty.  It returns the "success" dictionary where
-    the key is the list index corresponding to that item, and the value is
-    the zotero key returned.
+    converted into the JSON expected by the Zotero API; any iterable will do,
+    and it is only consumed one batch at a time.  It takes care of
+    uploading in batches of up to fifty objects and BATCH_BYTES of JSON, with
+    as many batches in flight at once as ZOTERO_LIMITER allows.  It
+    returns the "success" dictionary where the key is the list index
+    corresponding to that item, and the value is the zotero key returned.
+    Objects with a "key" update existing objects; those left unchanged by an
+    update are included in "success".
+
+    Batches are written by z_write_batch.  Objects that still fail after
+    its retries are saved by z_reject and left out of "success" rather than
+    stopping the migration.  If on_batch is given, it is called with the
+    "success" dictionary of each batch and the library version after the
+    write (or None if Zotero did not say) as soon as that batch has been
+    written, for checkpointing.  If on_failed is given, it is called with a
+    dictionary of the failures of each batch, keyed by list index like
+    "success", and may return the indices of those it has dealt with; only
+    the rest are passed to z_reject.  If a batch cannot be written at all,
+    nothing more is sent, but the batches already being written are waited
+    for and passed to on_batch before the error is raised.
     """
 
-    data_chunks = [data[i:i+50] for i in xrange(0, len(data), 50)]
+    def chunks():
+        # Yield (offset, chunk) pairs, where each chunk is a list of
+        # (object, encoded JSON) pairs
+        offset = 0
+        queue = []
+        size = 0
+        for obj in data:
+            encoded = z_encode(obj)
+            queue.append((obj, encoded))
+            size += len(encoded) + 1
+            if len(queue) > BATCH_SIZE or size > BATCH_BYTES:
+                chunk = z_take_batch(queue)
+                size -= sum(len(x[1]) + 1 for x in chunk)
+                yield offset, chunk
+                offset += len(chunk)
+        while len(queue) > 0:
+            chunk = z_take_batch(queue)
+            yield offset, chunk
+            offset += len(chunk)
+
+    def write(offset_chunk):
+        offset, chunk = offset_chunk
+        return (offset, chunk) + z_write_batch(token, url, chunk)
+
+    def record(result):
+        offset, chunk, chunk_success, chunk_failed, version = result
+        batch_success = dict((offset + i, key)
+                             for i, key in chunk_success.iteritems())
+        if on_batch is not None:
+            on_batch(batch_success, version)
+        if len(chunk_failed) > 0:
+            claimed = set()
+            if on_failed is not None:
+                claimed = set(on_failed(dict(
+                        (offset + i, failure)
+                        for i, failure in chunk_failed.iteritems())) or ())
+            rejected = [(chunk[i][0], chunk_failed[i])
+                        for i in sorted(chunk_failed)
+                        if offset + i not in claimed]
+            if len(rejected) > 0:
+                z_reject(url, rejected)
+        success.update(batch_success)
+
+    # Batches that were written before a failure are still recorded, so
+    # that --resume does not write them a second time
     success = {}
-    for chunk_key, chunk in enumerate(data_chunks):
-        req = urllib2.Request(url, json.dumps(chunk))
-        req.add_header("Zotero-API-Key", token)
-        req.add_header("Zotero-API-Version", "3")
-        req.add_header("Content-Type", "application/json")
-        try:
-            res = urllib2.urlopen(req)
-        except urllib2.HTTPError as e:
-            sys.exit("Error: received HTTP %s" % e.code)
-        res_json = json.load(res)
-        if len(res_json["failed"]) > 0:
-            sys.exit("Error: failed to write")
-        for k in res_json["success"].iterkeys():
-            success[(chunk_key * 50) + int(k)] = res_json["success"][k]
+    for result in pool_imap(write, chunks(), MAX_WORKERS, record):
+        record(result)
     return success
 
 
+def z_reject(url, failures):
+    """Report objects that could not be written and save them to REJECTS
+
+    failures is a list of (object, failure) pairs, where failure is the
+    entry for the object in the "failed" dictionary returned by Zotero.  Each
+    is appended to REJECTS as a line of JSON so that it can be put right and
+    loaded later.
+    """
+    for obj, failure in failures:
+        print "Could not write %s%s: %s (HTTP %s)" % (
+                obj.get("itemType", "item" if url.endswith("/items")
+                        else "collection"),
+                " %s" % obj["key"] if "key" in obj else "",
+                failure.get("message"), failure.get("code"))
+    if REJECTS is None:
+        return
+    with open(REJECTS, "a") as f:
+        for obj, failure in failures:
+            f.write(json.dumps({"url": url, "failure": failure,
+                                "object": obj}))
+            f.write("\n")
+
+
+class ZoteroLocal(object):
+    """Zotero API objects written straight into a Zotero profile's database
+
+    This stands in for the web API with --engine local.  Everything is
+    written in a single transaction, begun when the database is opened
+    (which fails while Zotero is running and holding it) and ended by
+    commit().  The creator, tag and field value tables are read into memory
+    once so that each distinct creator, tag and value is looked up without
+    a query and inserted only once, and each batch is written with one bulk
+    insert per table.  New objects are marked as unsynced, so Zotero uploads
+    them to zotero.org at its next sync.  It is safe to write from any
+    thread.
+    """
+
+    # Keys of API objects that are not item fields
+    NOT_FIELDS = frozenset(["itemType", "creators", "tags", "collections",
+                            "relations", "parentItem", "note", "linkMode",
+                            "contentType", "charset", "filename", "dateAdded",
+                            "dateModified", "key", "version", "md5", "mtime"])
+    LINK_MODES = {"imported_file": 0, "imported_url": 1, "linked_file": 2,
+                  "linked_url": 3}
+    # Tables in the order they are written
+    TABLES = ["collections", "items", "itemDataValues", "itemData",
+              "creators", "itemCreators", "tags", "itemTags",
+              "collectionItems", "itemNotes", "itemAttachments"]
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = metrics_connection(sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None))
+        try:
+            self.conn.execute("BEGIN IMMEDIATE;")
+        except sqlite3.OperationalError:
+            sys.exit("Could not lock %s: quit Zotero and try again" % path)
+        query = lambda sql: self.conn.execute(sql).fetchall()
+        self.library_id = query("SELECT libraryID FROM libraries "
+                                "WHERE type = 'user';")[0][0]
+        row = query("SELECT value FROM settings "
+                    "WHERE setting = 'account' AND key = 'userID';")
+        self.userid = row[0][0] if len(row) > 0 else "local"
+        self.item_types = dict(query("SELECT typeName, itemTypeID "
+                                     "FROM itemTypes;"))
+        self.fields = dict((name.lower(), field) for name, field in query(
+                "SELECT fieldName, fieldID FROM fields;"))
+        self.type_fields = set(query("SELECT itemTypeID, fieldID "
+                                     "FROM itemTypeFields;"))
+        self.creator_types = dict(query("SELECT creatorType, creatorTypeID "
+                                        "FROM creatorTypes;"))
+        self.values = dict(query("SELECT value, valueID "
+                                 "FROM itemDataValues;"))
+        self.creators = dict(((r[1], r[2], r[3]), r[0]) for r in query(
+                "SELECT creatorID, firstName, lastName, fieldMode "
+                "FROM creators;"))
+        self.tags = dict(query("SELECT name, tagID FROM tags;"))
+        self.collections = dict(query(
+                "SELECT key, collectionID FROM collections "
+                "WHERE libraryID = %d;" % self.library_id))
+        self.items = dict(query("SELECT key, itemID FROM items "
+                                "WHERE libraryID = %d;" % self.library_id))
+        self.next_id = {}
+        for table, column in [("collections", "collectionID"),
+                              ("items", "itemID"),
+                              ("itemDataValues", "valueID"),
+                              ("creators", "creatorID"),
+                              ("tags", "tagID")]:
+            self.next_id[column] = query("SELECT COALESCE(MAX(%s), 0) + 1 "
+                                         "FROM %s;" % (column, table))[0][0]
+
+    def new_id(self, column):
+        self.next_id[column] += 1
+        return self.next_id[column] - 1
+
+    def new_key(self):
+        while True:
+            key = "".join(random.choice(KEY_CHARS) for _ in xrange(8))
+            if key not in self.items and key not in self.collections:
+                return key
+
+    def top_collections(self):
+        """Return the names of the collections at the top of the library"""
+        return [row[0] for row in self.conn.execute(
+            "SELECT collectionName FROM collections "
+            "WHERE parentCollectionID IS NULL AND libraryID = ?;",
+            (self.library_id,))]
+
+    def write(self, url, objects):
+        """Write collections or items as z_write_batch does
+
+        url is the web API address that the objects would have been posted
+        to, which says whether they are collections or items.  Returns the
+        keys written and the failures, keyed by index within objects, and a
+        library version of None.  Objects that the web API would refuse, or
+        that update an existing object, fail with the same HTTP codes.
+        """
+        with self.lock:
+            rows = collections.defaultdict(list)
+            success = {}
+            failed = {}
+            for i, obj in enumerate(objects):
+                try:
+                    if "key" in obj:
+                        raise ZoteroLocalError(501, "Updates are not "
+                                               "supported with --engine "
+                                               "local")
+                    if url.endswith("/collections"):
+                        success[i] = self.add_collection(obj, rows)
+                    else:
+                        success[i] = self.add_item(obj, rows)
+                except ZoteroLocalError as e:
+                    failed[i] = {"code": e.args[0], "message": e.args[1]}
+            for table in self.TABLES:
+                table_rows = rows.get(table)
+                if not table_rows:
+                    continue
+                self.conn.executemany(
+                        "INSERT INTO %s (%s) VALUES (%s);" % (
+                            table, ", ".join(table_rows[0][0]),
+                            ", ".join("?" * len(table_rows[0][0]))),
+                        [values for columns, values in table_rows])
+            return success, failed, None
+
+    def add_collection(self, obj, rows):
+        parent = obj.get("parentCollection")
+        if parent and parent not in self.collections:
+            raise ZoteroLocalError(409, "Parent collection %s doesn't exist"
+                                   % parent)
+        collection_id = self.new_id("collectionID")
+        key = self.new_key()
+        rows["collections"].append((
+            ("collectionID", "collectionName", "parentCollectionID",
+             "libraryID", "key", "version", "synced"),
+            (collection_id, obj["name"],
+             self.collections[parent] if parent else None, self.library_id,
+             key, 0, 0)))
+        self.collections[key] = collection_id
+        return key
+
+    def add_item(self, obj, rows):
+        # Everything is checked before any rows are added, so that a failed
+        # item leaves nothing behind
+        item_type = self.item_types.get(obj["itemType"])
+        if item_type is None:
+            raise ZoteroLocalError(400, "'%s' is not a valid itemType" %
+                                   obj["itemType"])
+        fields = []
+        for name, value in obj.iteritems():
+            if (name in self.NOT_FIELDS or name.startswith("papers_")
+                    or value in ("", None)):
+                continue
+            field = self.fields.get(name.lower())
+            if field is None or (item_type, field) not in self.type_fields:
+                raise ZoteroLocalError(400, "'%s' is not a valid field for "
+                                       "type '%s'" % (name, obj["itemType"]))
+            fields.append((field, local_date(value) if name == "date"
+                           else local_timestamp(value) if name == "accessDate"
+                           else value))
+        creators = []
+        for creator in obj.get("creators", []):
+            creator_type = self.creator_types.get(creator["creatorType"])
+            if creator_type is None:
+                raise ZoteroLocalError(400, "'%s' is not a valid creator "
+                                       "type" % creator["creatorType"])
+            if "name" in creator:
+                creators.append(("", creator["name"], 1, creator_type))
+            else:
+                creators.append((creator.get("firstName", ""),
+                                 creator.get("lastName", ""), 0,
+                                 creator_type))
+        parent = obj.get("parentItem")
+        if parent and parent not in self.items:
+            raise ZoteroLocalError(409, "Parent item %s doesn't exist" %
+                                   parent)
+        for collection in obj.get("collections", []):
+            if collection not in self.collections:
+                raise ZoteroLocalError(409, "Collection %s doesn't exist" %
+                                       collection)
+
+        item_id = self.new_id("itemID")
+        key = self.new_key()
+        added = local_timestamp(obj.get("dateAdded")) or time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.gmtime())
+        rows["items"].append((
+            ("itemID", "itemTypeID", "dateAdded", "dateModified",
+             "clientDateModified", "libraryID", "key", "version", "synced"),
+            (item_id, item_type, added, added, added, self.library_id, key,
+             0, 0)))
+        for field, value in fields:
+            if value not in self.values:
+                self.values[value] = self.new_id("valueID")
+                rows["itemDataValues"].append((("valueID", "value"),
+                                               (self.values[value], value)))
+            rows["itemData"].append((("itemID", "fieldID", "valueID"),
+                                     (item_id, field, self.values[value])))
+        for order, (first, last, mode, creator_type) in enumerate(creators):
+            if (first, last, mode) not in self.creators:
+                self.creators[(first, last, mode)] = self.new_id("creatorID")
+                rows["creators"].append((
+                    ("creatorID", "firstName", "lastName", "fieldMode"),
+                    (self.creators[(first, last, mode)], first, last, mode)))
+            rows["itemCreators"].append((
+                ("itemID", "creatorID", "creatorTypeID", "orderIndex"),
+                (item_id, self.creators[(first, last, mode)], creator_type,
+                 order)))
+        for tag in obj.get("tags", []):
+            if tag["tag"] not in self.tags:
+                self.tags[tag["tag"]] = self.new_id("tagID")
+                rows["tags"].append((("tagID", "name"),
+                                     (self.tags[tag["tag"]], tag["tag"])))
+            rows["itemTags"].append((("itemID", "tagID", "type"),
+                                     (item_id, self.tags[tag["tag"]],
+                                      tag.get("type", 0))))
+        for collection in obj.get("collections", []):
+            rows["collectionItems"].append((
+                ("collectionID", "itemID", "orderIndex"),
+                (self.collections[collection], item_id, 0)))
+        parent_id = self.items[parent] if parent else None
+        if obj["itemType"] == "note" or obj.get("note"):
+            title = re.sub(r"<[^>]*>", "", obj["note"].split("<br />")[0])
+            rows["itemNotes"].append((
+                ("itemID", "parentItemID", "note", "title"),
+                (item_id, parent_id, obj["note"], title)))
+        if obj["itemType"] == "attachment":
+            path = None
+            if obj["linkMode"] in ("imported_file", "imported_url"):
+                path = "storage:" + obj.get("filename", "")
+            rows["itemAttachments"].append((
+                ("itemID", "parentItemID", "linkMode", "contentType", "path",
+                 "syncState"),
+                (item_id, parent_id, self.LINK_MODES[obj["linkMode"]],
+                 obj.get("contentType", ""), path, 0)))
+        self.items[key] = item_id
+        return key
+
+    def commit(self):
+        """End the transaction, leaving what was written in the database"""
+        with self.lock:
+            self.conn.execute("COMMIT;")
+
+
+class ZoteroLocalError(Exception):
+    """An object that ZoteroLocal refuses, with an HTTP code and message"""
+
+
+def local_timestamp(value):
+    """Convert an ISO 8601 time from the web API to Zotero's SQL format"""
+    if not value:
+        return None
+    return value.replace("T", " ").rstrip("Z")
+
+
+def local_date(value):
+    """Convert a date to the "multipart" form Zotero stores
+
+    This is the date in SQL form, with zeros for any part that is not
+    known, followed by the date as given.
+    """
+    match = re.match(r"^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$", value)
+    parts = match.groups() if match else ()
+    return "%04d-%02d-%02d %s" % tuple([int(x or 0) for x in parts] +
+                                       [0] * (3 - len(parts)) + [value])
+
+
+def journal_open(path, userid, resume):
+    """Open the checkpoint journal and return the sqlite connection
+
+    The journal records the Zotero key of every object as soon as the batch
+    containing it has been written, keyed by the kind of object ("collection",
+    "item", "note", "pubmed" or "pdf") and the papers UUID it came from.  An
+    interrupted migration can then be continued with --resume, skipping
+    everything that has already been uploaded.  The library version after
+    each object was written and, for items, a digest of what was read from
+    papers are kept too, for sync.  Papers linked to an item that was
+    already in Zotero are recorded both as an "item" and as a "link".
+    """
+    journal = metrics_connection(sqlite3.connect(path))
+    journal.execute("CREATE TABLE IF NOT EXISTS map ("
+                    "kind TEXT NOT NULL, "
+                    "papers_uuid TEXT NOT NULL, "
+                    "zotero_key TEXT NOT NULL, "
+                    "version INTEGER, "
+                    "digest TEXT, "
+                    "PRIMARY KEY (kind, papers_uuid));")
+    # Journals from before sync existed lack the version and digest
+    columns = [row[1] for row in journal.execute("PRAGMA table_info(map);")]
+    for column, column_type in [("version", "INTEGER"), ("digest", "TEXT")]:
+        if column not in columns:
+            journal.execute("ALTER TABLE map ADD COLUMN %s %s;" % (
+                column, column_type))
+    journal.execute("CREATE TABLE IF NOT EXISTS state ("
+                    "name TEXT PRIMARY KEY, "
+                    "value TEXT);")
+    journal.commit()
+
+    used = journal.execute("SELECT COUNT(*) FROM map;").fetchone()[0]
+    if used > 0 and not resume:
+        sys.exit("A journal from a previous migration exists at %s: pass "
+                 "--resume to continue it or remove it to start again" % path)
+    journal_userid = journal_get(journal, "userid")
+    if journal_userid is not None and journal_userid != str(userid):
+        sys.exit("The journal at %s belongs to a different Zotero user" % path)
+    journal_set(journal, "userid", userid)
+    return journal
+
+
+def journal_get(journal, name):
+    """Return a value from the journal state table, or None"""
+    row = journal.execute("SELECT value FROM state WHERE name = ?;",
+                          (name,)).fetchone()
+    return row[0] if row is not None else None
+
+
+def journal_set(journal, name, value):
+    """Store a value in the journal state table
+
+    Floats are stored with repr(), as str() would round them to 12
+    significant digits.
+    """
+    journal.execute("INSERT OR REPLACE INTO state VALUES (?, ?);",
+                    (name, repr(value) if isinstance(value, float)
+                     else str(value)))
+    journal.commit()
+
+
+def journal_finish(journal, synced_at):
+    """Record a completed run, of papers as last modified at synced_at
+
+    With --engine local, LOCAL_DB is committed first.
+    """
+    if LOCAL_DB is not None:
+        LOCAL_DB.commit()
+    journal_set(journal, "synced_at", synced_at)
+
+
+def journal_map(journal, kind):
+    """Return a dictionary mapping papers UUID to Zotero key for `kind`"""
+    return dict(journal.execute("SELECT papers_uuid, zotero_key FROM map "
+                                "WHERE kind = ?;", (kind,)))
+
+
+def journal_entries(journal, kind):
+    """Return a dictionary mapping papers UUID to (key, version, digest)"""
+    return dict((row[0], tuple(row[1:])) for row in journal.execute(
+        "SELECT papers_uuid, zotero_key, version, digest FROM map "
+        "WHERE kind = ?;", (kind,)))
+
+
+def journal_recorder(journal, refs, digests=None):
+    """Return an on_batch callback for z_api_write recording to the journal
+
+    `refs` is a list parallel to the data passed to z_api_write where each
+    entry is a (kind, papers_uuid) tuple.  `digests`, if given, is a parallel
+    list of the digests to record with them.  With --engine local the
+    journal is only committed once LOCAL_DB has been, so that it never
+    records objects that were rolled back.
+    """
+    def record(batch_success, version=None):
+        journal.executemany(
+                "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?, ?);",
+                [refs[i] + (key, version,
+                            digests[i] if digests is not None else None)
+                 for i, key in batch_success.iteritems()]
+                )
+        if LOCAL_DB is None:
+            journal.commit()
+    return record
+
+
+def journal_link_recorder(journal, papers):
+    """Return an on_batch callback for z_api_write recording linked items
+
+    `papers` is a list parallel to the data passed to z_api_write where each
+    entry lists the (papers_uuid, digest) pairs of the papers linked to that
+    existing item.  Each paper is recorded as both an "item" and a "link".
+    """
+    def record(batch_success, version=None):
+        refs = []
+        digests = []
+        success = {}
+        for i, key in batch_success.iteritems():
+            for papers_uuid, digest in papers[i]:
+                for kind in ["item", "link"]:
+                    success[len(refs)] = key
+                    refs.append((kind, papers_uuid))
+                    digests.append(digest if kind == "item" else None)
+        journal_recorder(journal, refs, digests)(success, version)
+    return record
+
+
+def plist_load(path):
+    """Return the contents of the property list file at path
+
+    plistlib only reads XML property lists, so binary ones (as Papers
+    writes its preferences) are read by plist_parse_binary instead.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(b"bplist00"):
+        return plist_parse_binary(data)
+    return plistlib.readPlistFromString(data)
+
+
+def plist_parse_binary(data):
+    """Return the object held in a binary (bplist00) property list
+
+    Strings are returned as unicode, data as plistlib.Data and dates as
+    datetime objects, as plistlib returns them from XML.  Sets are returned
+    as lists and UIDs as integers.  Raises ValueError if the property list
+    is malformed.
+    """
+    data = bytearray(data)
+    if len(data) < 40 or data[:8] != bytearray(b"bplist00"):
+        raise ValueError("Not a binary property list")
+    offset_size, ref_size, count, top, table = struct.unpack(
+            ">6xBBQQQ", bytes(data[-32:]))
+
+    def chunk(start, size):
+        if start < 0 or start + size > len(data) - 32:
+            raise ValueError("Truncated binary property list")
+        return data[start:start+size]
+
+    def number(start, size):
+        # An unsigned big-endian integer
+        value = 0
+        for byte in chunk(start, size):
+            value = value << 8 | byte
+        return value
+
+    def length(marker, start):
+        # Returns the count in the low nibble of a marker, or in the integer
+        # which follows it, and where the contents begin
+        if marker & 0xF != 0xF:
+            return marker & 0xF, start
+        size = 1 << (chunk(start, 1)[0] & 0xF)
+        return number(start + 1, size), start + 1 + size
+
+    offsets = [number(table + i * offset_size, offset_size)
+               for i in xrange(count)]
+    parsing = set()
+
+    def parse(ref):
+        # Containers refer to their contents by index in the offset table;
+        # one that contains itself would otherwise never finish
+        if ref >= count or ref in parsing:
+            raise ValueError("Bad object reference in binary property list")
+        start = offsets[ref]
+        marker = chunk(start, 1)[0]
+        kind, info = marker >> 4, marker & 0xF
+        start += 1
+        if marker in (0x00, 0x08, 0x09):
+            return {0x00: None, 0x08: False, 0x09: True}[marker]
+        if kind == 0x1:
+            value = number(start, 1 << info)
+            if info == 3 and value >= 1 << 63:
+                value -= 1 << 64
+            return value
+        if kind == 0x2 and info in (2, 3):
+            return struct.unpack(">f" if info == 2 else ">d",
+                                 bytes(chunk(start, 1 << info)))[0]
+        if marker == 0x33:
+            seconds = struct.unpack(">d", bytes(chunk(start, 8)))[0]
+            return (datetime.datetime(2001, 1, 1) +
+                    datetime.timedelta(seconds=seconds))
+        if kind == 0x8:
+            return number(start, info + 1)
+        n, start = length(marker, start)
+        if kind == 0x4:
+            return plistlib.Data(bytes(chunk(start, n)))
+        if kind == 0x5:
+            return bytes(chunk(start, n)).decode("ascii")
+        if kind == 0x6:
+            return bytes(chunk(start, 2 * n)).decode("utf-16-be")
+        if kind in (0xA, 0xC, 0xD):
+            refs = [number(start + i * ref_size, ref_size)
+                    for i in xrange(2 * n if kind == 0xD else n)]
+            parsing.add(ref)
+            try:
+                values = [parse(x) for x in refs]
+            finally:
+                parsing.discard(ref)
+            if kind == 0xD:
+                return dict(zip(values[:n], values[n:]))
+            return values
+        raise ValueError("Unknown object 0x%02x in binary property list" %
+                         marker)
+
+    return parse(top)
+
+
+def p_settings():
+    """Return the Papers preferences, reading them from PAPERS_PLIST once"""
+    global _papers_settings
+    if _papers_settings is None:
+        path = os.path.expanduser(PAPERS_PLIST)
+        try:
+            _papers_settings = plist_load(path)
+        except (IOError, ValueError) as e:
+            sys.exit("Could not read the Papers preferences at %s (%s): pass "
+                     "--library to give the library instead" % (path, e))
+    return _papers_settings
+
+
+def p_library_paths():
+    """Return the paths to the papers database and to its PDFs
+
+    PDF paths in the database are relative to the second.  If
+    PAPERS_LIBRARY is set, both are that Library.papers3 directory (and
+    the database in it); otherwise they are found from the Papers
+    preferences.
+    """
+    if PAPERS_LIBRARY is not None:
+        library = os.path.expanduser(PAPERS_LIBRARY)
+        return os.path.join(library, "Database.papersdb"), library
+    settings = p_settings()
+    try:
+        return ("/".join([os.path.expanduser("~/Library/Application Support"),
+                          settings["mt_papers3_library_location_local"],
+                          "Library.papers3/Database.papersdb"]),
+                settings["mt_papers3_full_library_location_shared"])
+    except KeyError as e:
+        sys.exit("The Papers preferences do not give the library's location "
+                 "(%s): pass --library to give it instead" % e)
+
+
 def open_papersdb():
-    """Return the connection cursor to the papers sqlite library"""
+    """Return a read-only cursor on the papers sqlite library
+
+    The connection refuses to write (PRAGMA query_only), so that passport
+    cannot change the library even by mistake, and is tuned for reading it
+    from end to end.  If the library is in WAL mode, as papers keeps it,
+    everything is read inside one transaction: passport sees the library as
+    it was when opened however long it runs, without holding up papers.
+    Queries that may run while others are being read are made on their own
+    cursors from the connection.
+    """
     print "Opening the Papers 3 library database..."
-    f = os.path.expanduser("~/Library/Preferences/com.mekentosj.papers3.plist")
-
-    # Unfortunately, plistlib does not handle binary plists so the plutil
-    # shell utility is needed to avoid depending on external libraries
-    plist = subprocess.check_output(["plutil", "-convert", "xml1", "-o", "-", f])
-    lib = plistlib.readPlistFromString(plist)["mt_papers3_library_location_local"]
-    sqlfile = "/".join([os.path.expanduser("~/Library/Application Support"),
-                        lib,
-                        "Library.papers3/Database.papersdb"
-                        ])
-
-    conn = sqlite3.connect(sqlfile)
+    sqlfile = p_library_paths()[0]
+    # sqlite would otherwise create an empty database in its place
+    if not os.path.isfile(sqlfile):
+        sys.exit("Could not find the Papers library database at %s" %
+                 sqlfile)
+
+    # Transactions are begun here rather than by the sqlite3 module, which
+    # would otherwise end the snapshot before some statements
+    conn = sqlite3.connect(sqlfile, isolation_level=None)
     conn.row_factory = sqlite3.Row
-    return conn.cursor()
+    conn.execute("PRAGMA query_only = ON;")
+    conn.execute("PRAGMA mmap_size = %d;" % PAPERS_MMAP_SIZE)
+    conn.execute("PRAGMA cache_size = %d;" % -(PAPERS_CACHE_SIZE // 1024))
+    # In any other journal mode, an open read transaction would stop papers
+    # writing to the library until passport finished
+    if conn.execute("PRAGMA journal_mode;").fetchone()[0] == "wal":
+        conn.execute("BEGIN;")
+        conn.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+    return metrics_connection(conn).cursor()
+
+
+def p_grouped(papersdb_cursor, sql):
+    """Yield (object_id, rows) pairs from a query sorted on its first column
+
+    A fresh cursor is used so that the relation can be read alongside the
+    main items query.  Rows are grouped as they stream past, so only a single
+    object's rows are ever held in memory.
+    """
+    cursor = papersdb_cursor.connection.cursor()
+    for object_id, rows in itertools.groupby(cursor.execute(sql),
+                                             key=lambda row: row[0]):
+        yield object_id, list(rows)
 
 
-def z_recreate_collections(token, userid, papersdb_cursor):
-    """Recreate the collection structure from papers
+def p_lookup(groups):
+    """Return a function mapping an object_id to its rows in `groups`
 
-    This function returns a dictionary mapping the papers collection UUID
-    to the Zotero API key.
+    This is a merge join: `groups` must be sorted by object_id (as from
+    p_grouped) and the returned function must be called with object_ids in
+    the same ascending order.  Each relation is therefore read exactly once
+    in step with the items query rather than being queried per item.
     """
-
-    print "Creating collections..."
+    groups = iter(groups)
+    current = [next(groups, None)]
+
+    def lookup(object_id):
+        while current[0] is not None and current[0][0] < object_id:
+            current[0] = next(groups, None)
+        if current[0] is not None and current[0][0] == object_id:
+            return current[0][1]
+        return []
+
+    return lookup
+
+
+def p_collection_levels(p_collections, p_tld_uuid):
+    """Group papers collections by their depth below the top level collection
+
+    `p_collections` maps each collection UUID to a dictionary with its
+    "parent".  The hierarchy is indexed by parent once and walked breadth
+    first, returning a (levels, orphans) tuple where levels is a list of
+    lists of UUIDs, one per depth, with every collection at a lower depth
+    than its children.  Collections whose parent does not exist (or which
+    form a cycle) cannot be reached from the top level; they are returned in
+    the set orphans and placed at the first level, with their own
+    subcollections at the levels below.
+    """
+    children = {}
+    for x in sorted(p_collections):
+        children.setdefault(p_collections[x]["parent"], []).append(x)
+    levels = []
+    placed = set()
+    orphans = set()
+
+    def place(roots):
+        # Walk breadth first down from roots, which sit at the first level
+        frontier = roots
+        depth = 0
+        while len(frontier) > 0:
+            if len(levels) == depth:
+                levels.append([])
+            levels[depth].extend(frontier)
+            placed.update(frontier)
+            frontier = [c for x in frontier for c in children.get(x, [])
+                        if c not in placed]
+            depth += 1
+
+    place(children.get(p_tld_uuid, []))
+    while len(placed) < len(p_collections):
+        # Whatever is left cannot be reached from the top level collection:
+        # start from those whose parent is missing, or else break a cycle
+        remaining = [x for x in sorted(p_collections) if x not in placed]
+        roots = [x for x in remaining
+                 if p_collections[x]["parent"] not in p_collections]
+        if len(roots) == 0:
+            roots = remaining[:1]
+        orphans.update(roots)
+        place(roots)
+    return levels, orphans
+
+
+def z_create_tld(token, userid, journal, p_tld_uuid):
+    """Create the passport-import collection and return its Zotero key"""
     # List all top-level collections and generate a unique name for the
     # library import
-    tlds_url = "https://api.zotero.org/users/%s/collections/top" % userid
-    tlds_req = urllib2.Request(tlds_url)
-    tlds_req.add_header("Zotero-API-Key", token)
-    tlds_req.add_header("Zotero-API-Version", "3")
-    tlds = [x["data"]["name"] for x in json.load(urllib2.urlopen(tlds_req))]
+    if LOCAL_DB is not None:
+        tlds = LOCAL_DB.top_collections()
+    else:
+        tlds_url = "%s/users/%s/collections/top" % (ZOTERO_API, userid)
+        status, headers, data = z_request(
+                "GET",
+                tlds_url,
+                headers={"Zotero-API-Key": token, "Zotero-API-Version": "3"}
+                )
+        if status != 200:
+            sys.exit("Error: received HTTP %s" % status)
+        tlds = [x["data"]["name"] for x in json.loads(data)]
 
     now = datetime.datetime.utcnow().replace(microsecond=0).isoformat()
     new_tld = "_".join(["passport-import", now])
@@ -111,76 +1765,133 @@ def z_recreate_collections(token, userid, papersdb_cursor):
                 "parentCollection": False}]
     lib_res = z_api_write(
             token,
-            "https://api.zotero.org/users/%s/collections" % userid,
-            lib_data
+            "%s/users/%s/collections" % (ZOTERO_API, userid),
+            lib_data,
+            journal_recorder(journal, [("collection", p_tld_uuid)])
             )
     try:
-        tld_key = lib_res[0]
+        return lib_res[0]
     except KeyError:
         sys.exit("Could not create a new collection for import")
+
+
+def p_read_collections(papersdb_cursor):
+    """Return the UUID of the top level papers collection and all the others
+
+    The other collections are returned as a dictionary mapping each UUID to a
+    dictionary with its "name" and "parent".
+    """
+    cursor = papersdb_cursor.connection.cursor()
     p_tld_sql = ("SELECT uuid FROM Collection WHERE editable = 0 "
                 "AND name = 'COLLECTIONS';")
-    papersdb_cursor.execute(p_tld_sql)
-    p_tld_uuid = papersdb_cursor.fetchone()[0]
-    collection_map = {p_tld_uuid: tld_key}
-    # For ease of later referencing in z_recreate_items for orphaned items, we
-    # also insert it into the map with key "tld"
-    collection_map["tld"] = tld_key
-
-    # Get a list of all collections in papers
+    cursor.execute(p_tld_sql)
+    p_tld_uuid = cursor.fetchone()[0]
     p_sql = ("SELECT uuid, name, parent FROM Collection WHERE editable=1")
     p_collections = {}
-    for row in papersdb_cursor.execute(p_sql):
+    for row in cursor.execute(p_sql):
         p_collections[row[0]] = {"name": row[1], "parent": row[2]}
+    return p_tld_uuid, p_collections
+
+
+def p_collection_counts(papersdb_cursor, p_tld_uuid):
+    """Return the number of publications that passport files in each collection
+
+    The counts are returned as a dictionary keyed by collection UUID, and
+    are taken with one aggregate query over CollectionItem, counting only
+    the publications that p_read_items reads.  Publications that are in no
+    collection are filed in the top level collection (see
+    z_item_collections), so they are added to its count.
+    """
+    publications = ("FROM Publication a, Publication b "
+                    "WHERE a.bundle = b.uuid "
+                    "AND a.type >= 0 "
+                    "AND a.privacy_level = 0")
+    counts_sql = ("SELECT CollectionItem.collection, "
+                  "COUNT(DISTINCT a.uuid) "
+                  "FROM CollectionItem, Publication a, Publication b "
+                  "WHERE CollectionItem.object_id = a.uuid "
+                  "AND a.bundle = b.uuid "
+                  "AND a.type >= 0 "
+                  "AND a.privacy_level = 0 "
+                  "GROUP BY CollectionItem.collection;")
+    orphans_sql = ("SELECT COUNT(*) %s AND NOT EXISTS ("
+                   "SELECT 1 FROM CollectionItem, Collection "
+                   "WHERE CollectionItem.object_id = a.uuid "
+                   "AND CollectionItem.collection = Collection.uuid "
+                   "AND (Collection.editable = 1 OR Collection.uuid = ?));" %
+                   publications)
+    cursor = papersdb_cursor.connection.cursor()
+    counts = dict((row[0], row[1]) for row in cursor.execute(counts_sql))
+    orphans = cursor.execute(orphans_sql, (p_tld_uuid,)).fetchone()[0]
+    counts[p_tld_uuid] = counts.get(p_tld_uuid, 0) + orphans
+    return counts
+
+
+@timed("collections")
+def z_recreate_collections(token, userid, p_tld_uuid, p_collections, journal):
+    """Recreate the collection structure from papers
 
-    # Create all level 1 collections (i.e. not sub-collections)
-    level1_data = []
-    level1_uuids = []
-    for uuid, v in p_collections.copy().iteritems():
-        if v["parent"] == p_tld_uuid:
-            level1_data.append({
-                "name": v["name"],
-                "parentCollection": collection_map[p_tld_uuid]
+    The collections are as returned by p_read_collections.  This function
+    returns a dictionary mapping the papers collection UUID to the Zotero API
+    key.  Collections already recorded in the journal are not created again.
+    """
+
+    print "Creating collections..."
+    collection_map = journal_map(journal, "collection")
+    if p_tld_uuid in collection_map:
+        print "Resuming the import into the existing collections..."
+    else:
+        collection_map[p_tld_uuid] = z_create_tld(token, userid, journal,
+                                                  p_tld_uuid)
+    # For ease of later referencing in z_recreate_items for orphaned items, we
+    # also insert it into the map with key "tld"
+    collection_map["tld"] = collection_map[p_tld_uuid]
+
+    # Plan the tree by depth
+    levels, orphans = p_collection_levels(p_collections, p_tld_uuid)
+    if len(orphans) > 0:
+        print ("%s collection(s) have no parent in Papers and will be placed "
+               "in the top level import collection" % len(orphans))
+
+    # Create each level in turn (every parent is created before its
+    # children), skipping collections recorded in the journal
+    for level in levels:
+        level_uuids = [x for x in level if x not in collection_map]
+        level_data = []
+        for x in level_uuids:
+            if x in orphans:
+                parent_key = collection_map[p_tld_uuid]
+            else:
+                # A parent that could not be written leaves its children at
+                # the top level rather than stopping the migration
+                parent_key = collection_map.get(p_collections[x]["parent"],
+                                                collection_map[p_tld_uuid])
+            level_data.append({
+                "name": p_collections[x]["name"],
+                "parentCollection": parent_key
                 })
-            level1_uuids.append(uuid)
-            del p_collections[uuid]
-    level1_success = z_api_write(
-            token,
-            "https://api.zotero.org/users/%s/collections" % userid,
-            level1_data
-            )
-    for x in level1_success:
-        collection_map[level1_uuids[int(x)]] = level1_success[x]
-
-    # Create all level >1 collections by looping through 
-    # collection_map and searching p_collections for children
-    while len(p_collections) > 0:
-        levelgt1_data = []
-        levelgt1_uuids = []
-        for p_uuid in collection_map.copy().iterkeys():
-            to_add = {k: v for k, v in p_collections.items()
-                                    if v["parent"] == p_uuid}
-            for uuid, v in to_add.iteritems():
-                levelgt1_data.append({
-                    "name": v["name"],
-                    "parentCollection": collection_map[v["parent"]]
-                    })
-                levelgt1_uuids.append(uuid)
-                del p_collections[uuid]
-        levelgt1_success = z_api_write(
+        level_success = z_api_write(
                 token,
-                "https://api.zotero.org/users/%s/collections" % userid,
-                levelgt1_data
+                "%s/users/%s/collections" % (ZOTERO_API, userid),
+                level_data,
+                journal_recorder(journal,
+                                 [("collection", x) for x in level_uuids])
                 )
-        for x in levelgt1_success:
-            collection_map[levelgt1_uuids[int(x)]] = levelgt1_success[x]
+        for x in level_success:
+            collection_map[level_uuids[int(x)]] = level_success[x]
 
     return collection_map
 
 
-def z_recreate_items(token, userid, papersdb_cursor, collection_map, pubmed_cleanup):
-    """Import items from papers into the Zotero API"""
-    print "Reading items from Papers..."
+def p_read_items(papersdb_cursor):
+    """Yield an (item, note) pair for each publication in papers
+
+    Rows are read from the cursor as they are needed rather than all at once.
+    `item` is the dictionary to upload to the Zotero API with the extra keys
+    "papers_uuid", "papers_collections", "papers_digest", "papers_updated"
+    and (if known) "pmid"/"pmcid"; `note` is the child note for the item, or
+    None.
+    """
     items_sql = ("SELECT "
                  "a.uuid AS uuid, "
                  "a.title AS title, "
@@ -194,31 +1905,54 @@ def z_recreate_items(token, userid, papersdb_cursor, collection_map, pubmed_clea
                  "a.language AS language, "
                  "a.doi AS doi, "
                  "a.imported_date AS imported_date, "
+                 "a.updated_at AS updated_at, "
                  "a.notes AS notes "
                  "FROM Publication a, Publication b "
                  "WHERE a.bundle = b.uuid "
                  "AND a.type >= 0 "
-                 "AND a.privacy_level = 0;")
-    items_res = papersdb_cursor.execute(items_sql)
-    import_items = []
-    import_notes = []
-    for item in items_res.fetchall():
+                 "AND a.privacy_level = 0 "
+                 "ORDER BY a.uuid;")
+
+    # Each relation is read with a single query sorted by object_id and
+    # merged against the (identically sorted) items query, rather than
+    # running four separate queries for every item
+    authors_sql = ("SELECT OrderedAuthor.object_id, "
+                   "Author.prename, Author.surname "
+                   "FROM OrderedAuthor "
+                   "LEFT JOIN Author "
+                   "ON OrderedAuthor.author_id = Author.uuid "
+                   "WHERE OrderedAuthor.type = 0 "
+                   "ORDER BY OrderedAuthor.object_id, OrderedAuthor.priority;")
+    pubmed_sql = ("SELECT device_id, remote_id, source_id FROM SyncEvent "
+                  "WHERE subtype = 0 "
+                  "AND (source_id = 'gov.nih.nlm.ncbi.pubmed' "
+                  "OR source_id = 'gov.nih.nlm.ncbi.pmc') "
+                  "ORDER BY device_id;")
+    tags_sql = ("SELECT KeywordItem.object_id, Keyword.name FROM KeywordItem "
+                "LEFT JOIN Keyword "
+                "ON KeywordItem.keyword_id = Keyword.uuid "
+                "WHERE KeywordItem.type = 99 "
+                "ORDER BY KeywordItem.object_id;")
+    coll_sql = ("SELECT CollectionItem.object_id, Collection.uuid "
+                "FROM CollectionItem "
+                "LEFT JOIN Collection "
+                "ON CollectionItem.collection = Collection.uuid "
+                "ORDER BY CollectionItem.object_id;")
+    authors_of = p_lookup(p_grouped(papersdb_cursor, authors_sql))
+    pubmed_of = p_lookup(p_grouped(papersdb_cursor, pubmed_sql))
+    tags_of = p_lookup(p_grouped(papersdb_cursor, tags_sql))
+    colls_of = p_lookup(p_grouped(papersdb_cursor, coll_sql))
+
+    cursor = papersdb_cursor.connection.cursor()
+    for item in cursor.execute(items_sql):
         jsondict = {"itemType": "journalArticle"}
 
         if item["title"] is not None:
             jsondict["title"] = item["title"]
         
         # Parse authors into list of dictionaries as per Zotero API
-        authors_sql = ("SELECT Author.prename, Author.surname "
-                       "FROM OrderedAuthor "
-                       "LEFT JOIN Author "
-                       "ON OrderedAuthor.author_id = Author.uuid "
-                       "WHERE OrderedAuthor.object_id = ? "
-                       "AND OrderedAuthor.type = 0 "
-                       "ORDER BY OrderedAuthor.priority;")
-        authors_res = papersdb_cursor.execute(authors_sql, (item["uuid"],))
         authors = []
-        for author in authors_res.fetchall():
+        for author in authors_of(item["uuid"]):
             firstName = author["prename"]
             # Zotero puts a period after each initial
             while (re.search(r"(^| )[A-Z]( |$)", firstName) is not None):
@@ -285,152 +2019,1021 @@ def z_recreate_items(token, userid, papersdb_cursor, collection_map, pubmed_clea
         # - jsondict["libraryCatalog"] = "PubMed"
         # - jsondict["extra"] = "PMCID: ... \n PMID: ...." as needed
         # - a "PubMed entry" attachment
-        pubmed_sql = ("SELECT remote_id, source_id FROM SyncEvent "
-                      "WHERE device_id = ? "
-                      "AND subtype = 0 "
-                      "AND (source_id = 'gov.nih.nlm.ncbi.pubmed' "
-                      "OR source_id = 'gov.nih.nlm.ncbi.pmc');")
-        pubmed_res = papersdb_cursor.execute(pubmed_sql, (item["uuid"],))
-        for pubmed_row in pubmed_res.fetchall():
+        for pubmed_row in pubmed_of(item["uuid"]):
             if pubmed_row["source_id"] == "gov.nih.nlm.ncbi.pubmed":
                 jsondict["pmid"] = pubmed_row["remote_id"]
             elif pubmed_row["source_id"] == "gov.nih.nlm.ncbi.pmc":
                 jsondict["pmcid"] = pubmed_row["remote_id"]
 
         # Tags
-        tags_sql = ("SELECT Keyword.name FROM KeywordItem "
-                    "LEFT JOIN Keyword "
-                    "ON KeywordItem.keyword_id = Keyword.uuid "
-                    "WHERE KeywordItem.object_id = ? "
-                    "AND KeywordItem.type = 99;")
-        tags_res = papersdb_cursor.execute(tags_sql, (item["uuid"],))
         tags = []
-        for tag in tags_res.fetchall():
+        for tag in tags_of(item["uuid"]):
             tags.append({"tag": tag["name"], "type": 1})
         jsondict["tags"] = tags
 
-        # Collections need to be mapped from their papers uuid to the zotero key
-        coll_sql = ("SELECT Collection.uuid FROM CollectionItem "
-                    "LEFT JOIN Collection "
-                    "ON CollectionItem.collection = Collection.uuid "
-                    "WHERE CollectionItem.object_id = ?;")
-        coll_res = papersdb_cursor.execute(coll_sql, (item["uuid"],))
-        collections = []
-        for coll in coll_res.fetchall():
-            # For some reason, some items in papers are assigned to a collection
-            # that does not exist: put these in the top level import folder
-            if coll["uuid"] in collection_map:
-                collections.append(collection_map[coll["uuid"]])
-        if len(collections) == 0:
-            collections.append(collection_map["tld"])
-        jsondict["collections"] = collections
+        # Collections are mapped from their papers uuid to the zotero key
+        # when the item is uploaded
+        jsondict["papers_collections"] = [coll["uuid"]
+                                          for coll in colls_of(item["uuid"])
+                                          if coll["uuid"] is not None]
 
         jsondict["relations"] = {}
 
         # Notes can only be imported once we have the key to the parent item.
-        # They are therefore added to a separate list `import_notes` which also
-        # contains the dictionary item "papers_uuid".  Later, when we have the
-        # item_map we replace papers_uuid with parentItem and upload them.
+        # They therefore carry the dictionary item "papers_uuid" which is
+        # replaced with parentItem once the parent has been uploaded.
+        note = None
         if item["notes"] is not None:
-            import_notes.append({
+            note = {
                 "itemType": "note",
                 "note": "<br />".join(cgi.escape(item["notes"]).split("\n")),
                 "tags": [],
                 "collections": [],
                 "relations": {},
                 "papers_uuid": item["uuid"]
-                })
+                }
 
         # Although the papers uuid does not need importing into zotero,
-        # add it to the array so that the item_map can be built later
+        # add it to the dictionary so that the item_map can be built later
         jsondict["papers_uuid"] = item["uuid"]
-        
-        # Add this item to the `import_items` list for importing
-        import_items.append(jsondict)
 
-    # If requested, cleanup import_items by querying the PubMed database
+        # For sync, keep when papers last modified the item and a digest of
+        # everything read for it, which also changes with its tags,
+        # collections and notes
+        jsondict["papers_digest"] = hashlib.md5(json.dumps(
+                [jsondict, note], sort_keys=True)).hexdigest()
+        jsondict["papers_updated"] = item["updated_at"]
+
+        yield jsondict, note
+
+
+def z_pubmed_entry(item):
+    """Move the "pmid" and "pmcid" keys of an item into Zotero fields
+
+    These are replaced by libraryCatalog and "extra" on the item itself.  If
+    there is a PMID, a "PubMed entry" attachment (still carrying
+    "papers_uuid" in place of parentItem) is returned, otherwise None.
+    """
+    pubmed = None
+    if item.viewkeys() & {"pmid", "pmcid"}:
+        extra = []
+        if "pmid" in item:
+            extra.append("PMID: %s" % item["pmid"])
+            pubmed = {
+                "itemType": "attachment",
+                "linkMode": "linked_url",
+                "title": "PubMed entry",
+                "accessDate": item["dateAdded"],
+                "url": "http://www.ncbi.nlm.nih.gov/pubmed/%s" % item["pmid"],
+                "note": "",
+                "contentType": "text/html",
+                "tags": [],
+                "collections": [],
+                "relations": {},
+                "charset": "",
+                "papers_uuid": item["papers_uuid"]
+                }
+            del item["pmid"]
+        if "pmcid" in item:
+            extra.append("PMCID: %s" % item["pmcid"])
+            del item["pmcid"]
+        item["libraryCatalog"] = "PubMed"
+        item["extra"] = "\n".join(extra)
+    return pubmed
+
+
+def p_item_windows(papersdb_cursor, pubmed_cleanup, select=None):
+    """Yield the items in papers a window at a time, ready for Zotero
+
+    Each window is an (items, children) pair of lists: the items have been
+    through the PubMed cleanup (if requested) and the children are their
+    notes and PubMed entries.  Items and children still refer to papers by
+    "papers_uuid" (and items to their collections by "papers_collections"),
+    so memory use does not grow with the size of the library.  If `select`
+    is given, only the (item, note) pairs for which it returns True are
+    included.
+    """
+    # Each window fills one batch for as many workers as may be used; a
+    # larger window also lets pmclean send fewer, larger requests to PubMed
+    window_size = BATCH_SIZE * MAX_WORKERS
     if pubmed_cleanup:
-        print "Passing %s item(s) through PubMed" % len(import_items)
-        import_items = pmclean(import_items, pubmed_cleanup)
-
-    # Loop through import_items, replace the "pmid" and "pmcid" keys with
-    # the appropriate entries then create import_pubmed (which has the extra
-    # key "papers_uuid" to be replaced with the zotero key to the parent item
-    # once we have item_map).
-    import_pubmed = []
-    for i, item in enumerate(import_items):
-        if item.viewkeys() & {"pmid", "pmcid"}:
-            extra = []
-            if "pmid" in item:
-                extra.append("PMID: %s" % item["pmid"])
-                import_pubmed.append({
-                    "itemType": "attachment",
-                    "linkMode": "linked_url",
-                    "title": "PubMed entry",
-                    "accessDate": import_items[i]["dateAdded"],
-                    "url": "http://www.ncbi.nlm.nih.gov/pubmed/%s" %
-                        item["pmid"],
-                    "note": "",
-                    "contentType": "text/html",
-                    "tags": [],
-                    "collections": [],
-                    "relations": {},
-                    "charset": "",
-                    "papers_uuid": item["papers_uuid"]
-                    })
-                del import_items[i]["pmid"]
-            if "pmcid" in item:
-                extra.append("PMCID: %s" % item["pmcid"])
-                del import_items[i]["pmcid"]
-            import_items[i]["libraryCatalog"] = "PubMed"
-            import_items[i]["extra"] = "\n".join(extra)
-
-    # Upload items
-    print "Uploading %s item(s) to Zotero..." % len(import_items)
-    item_map = {}
-    item_map_uuids = {}
-    for i, item in enumerate(import_items):
-        item_map_uuids[i] = item["papers_uuid"]
-        del import_items[i]["papers_uuid"]
-    item_success = z_api_write(
-            token,
-            "https://api.zotero.org/users/%s/items" % userid,
-            import_items
-            )
-    for x in item_success:
-        item_map[item_map_uuids[int(x)]] = item_success[x]
-
-    # Upload notes
-    print "Uploading %s note(s) to Zotero..." % len(import_notes)
-    for i, note in enumerate(import_notes):
-        import_notes[i]["parentItem"] = item_map[note["papers_uuid"]]
-        del import_notes[i]["papers_uuid"]
-    z_api_write(
-            token,
-            "https://api.zotero.org/users/%s/items" % userid,
-            import_notes
-            )
+        window_size = max(window_size, PUBMED_WINDOW)
+    rows = p_read_items(papersdb_cursor)
+    if select is not None:
+        rows = itertools.ifilter(select, rows)
+    while True:
+        window = list(itertools.islice(rows, window_size))
+        if len(window) == 0:
+            return
+        import_items = [item for item, note in window]
+        import_children = [note for item, note in window if note is not None]
+
+        # If requested, cleanup import_items by querying the PubMed database
+        if pubmed_cleanup:
+            import_items = pmclean(import_items, pubmed_cleanup)
+
+        for item in import_items:
+            pubmed = z_pubmed_entry(item)
+            if pubmed is not None:
+                import_children.append(pubmed)
+        yield import_items, import_children
+
+
+def z_item_collections(item, collection_map):
+    """Return the Zotero keys of the collections an item belongs in"""
+    # For some reason, some items in papers are assigned to a collection that
+    # does not exist: put these in the top level import folder
+    collections = [collection_map[x] for x in item["papers_collections"]
+                   if x in collection_map]
+    if len(collections) == 0:
+        collections.append(collection_map["tld"])
+    return collections
+
+
+def z_child_ref(child):
+    """Return the (kind, papers_uuid) journal reference for a child item
+
+    PDFs are referred to by their path relative to the papers library since
+    an item may have several.
+    """
+    if child["itemType"] == "note":
+        return ("note", child["papers_uuid"])
+    if child["linkMode"] == "linked_url":
+        return ("pubmed", child["papers_uuid"])
+    return ("pdf", child["papers_path"])
 
-    # Upload PubMed entries
-    print "Uploading %s PubMed entries to Zotero..." % len(import_pubmed)
-    for i, pubmed in enumerate(import_pubmed):
-        import_pubmed[i]["parentItem"] = item_map[pubmed["papers_uuid"]]
-        del import_pubmed[i]["papers_uuid"]
-    z_api_write(
-            token,
-            "https://api.zotero.org/users/%s/items" % userid,
-            import_pubmed
-            )
 
+def z_index_open(path):
+    """Open (creating if necessary) the index of Zotero libraries at path
+
+    For every top-level item in each library indexed, the index holds its
+    version, the identifiers from z_identifiers and its collections, along
+    with the library version it was last brought up to date with.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    index = metrics_connection(sqlite3.connect(path, timeout=60))
+    index.execute("CREATE TABLE IF NOT EXISTS items ("
+                  "userid TEXT NOT NULL, "
+                  "key TEXT NOT NULL, "
+                  "version INTEGER NOT NULL, "
+                  "doi TEXT, "
+                  "pmid TEXT, "
+                  "title TEXT, "
+                  "year TEXT, "
+                  "collections TEXT NOT NULL, "
+                  "PRIMARY KEY (userid, key));")
+    for column in ["doi", "pmid", "title"]:
+        index.execute("CREATE INDEX IF NOT EXISTS items_%s "
+                      "ON items (userid, %s);" % (column, column))
+    index.execute("CREATE TABLE IF NOT EXISTS libraries ("
+                  "userid TEXT PRIMARY KEY, "
+                  "version INTEGER NOT NULL);")
+    index.commit()
+    return index
+
+
+def z_identifiers(data):
+    """Return the (DOI, PMID, title, year) by which an item is matched
+
+    data is the item as sent to or received from the Zotero API.  The DOI
+    is lower case without any resolver prefix, and the title is reduced to
+    lower case letters and digits.  Any that are missing are None.
+    """
+    doi = (data.get("DOI") or data.get("doi") or "").strip().lower()
+    doi = re.sub(r"^(https?://(dx\.)?doi\.org/|doi:\s*)", "", doi) or None
+    pmid = data.get("pmid")
+    match = re.search(r"^PMID:\s*(\d+)", data.get("extra") or "", re.M)
+    if pmid is None and match:
+        pmid = match.group(1)
+    title = unicodedata.normalize("NFKD", data.get("title") or u"")
+    title = re.sub(r"[\W_]+", "", title.lower(), flags=re.U) or None
+    match = re.search(r"\b(\d{4})\b", data.get("date") or "")
+    return doi, pmid, title, match.group(1) if match else None
+
+
+def z_item_data(token, userid, keys):
+    """Return a dictionary of the (version, data) of each item in keys
+
+    Items are fetched BATCH_SIZE at a time, MAX_WORKERS requests at once.
+    Items in the trash are included, with "deleted" set in their data; keys
+    of items that are no longer in Zotero at all are left out.
+    """
+    def fetch(chunk):
+        status, headers, data = z_request(
+                "GET",
+                "%s/users/%s/items?%s" % (ZOTERO_API, userid,
+                                          urllib.urlencode({
+                                              "itemKey": ",".join(chunk),
+                                              "limit": len(chunk),
+                                              "format": "json",
+                                              "include": "data",
+                                              "includeTrashed": 1
+                                              })),
+                headers={"Zotero-API-Key": token, "Zotero-API-Version": "3"}
+                )
+        if status != 200:
+            sys.exit("Error: received HTTP %s" % status)
+        return json.loads(data)
+
+    items = {}
+    chunks = [keys[i:i+BATCH_SIZE] for i in xrange(0, len(keys), BATCH_SIZE)]
+    for objects in pool_imap(fetch, chunks, MAX_WORKERS):
+        for obj in objects:
+            items[obj["key"]] = (obj["version"], obj["data"])
+    return items
+
+
+def z_index_update(token, userid):
+    """Bring the ZOTERO_INDEX entries for a Zotero library up to date
+
+    Only the top-level items modified since the library version recorded by
+    the last update are fetched: their keys are listed with format=versions
+    and since=, and their data then fetched by z_item_data.  Trashed items
+    are listed too (the API leaves them out unless includeTrashed is given,
+    and /deleted does not report them), so that items deleted or moved to
+    the trash since are dropped from the index.
+    """
+    userid = str(userid)
+    row = ZOTERO_INDEX.execute("SELECT version FROM libraries "
+                               "WHERE userid = ?;", (userid,)).fetchone()
+    since = row[0] if row is not None else 0
+    headers = {"Zotero-API-Key": token, "Zotero-API-Version": "3"}
+    url = "%s/users/%s" % (ZOTERO_API, userid)
+    status, res_headers, data = z_request("GET", "%s/items/top?%s" % (
+        url, urllib.urlencode({"format": "versions", "since": since,
+                               "includeTrashed": 1})),
+        headers=headers)
+    if status != 200:
+        sys.exit("Error: received HTTP %s" % status)
+    keys = sorted(json.loads(data))
+    version = int(res_headers.get("last-modified-version", since))
+    print "Indexing %s item(s) changed in Zotero since the last run..." % (
+            len(keys))
+
+    removed = []
+    rows = []
+    for key, (item_version, item) in z_item_data(token, userid,
+                                                 keys).iteritems():
+        if item.get("deleted") or item["itemType"] in ("note", "attachment"):
+            removed.append(key)
+            continue
+        rows.append((userid, key, item_version) + z_identifiers(item) +
+                    (json.dumps(item.get("collections", [])),))
+    ZOTERO_INDEX.executemany("INSERT OR REPLACE INTO items "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?);", rows)
+    if since > 0:
+        status, res_headers, data = z_request("GET", "%s/deleted?%s" % (
+            url, urllib.urlencode({"since": since})), headers=headers)
+        if status != 200:
+            sys.exit("Error: received HTTP %s" % status)
+        removed.extend(json.loads(data).get("items", []))
+    ZOTERO_INDEX.executemany("DELETE FROM items WHERE userid = ? AND key = ?;",
+                             [(userid, key) for key in removed])
+    ZOTERO_INDEX.execute("INSERT OR REPLACE INTO libraries VALUES (?, ?);",
+                         (userid, version))
+    ZOTERO_INDEX.commit()
+
+
+def z_index_match(userid, item):
+    """Return the (key, version, collections) of an item's duplicate
+
+    The duplicate is looked up in ZOTERO_INDEX by DOI, then PMID, then title
+    and year, and is None if there is none.
+    """
+    doi, pmid, title, year = z_identifiers(item)
+    if title is not None and len(title) < INDEX_TITLE_MIN:
+        title = None
+    for column, value, extra in [("doi", doi, ""), ("pmid", pmid, ""),
+                                 ("title", title, " AND year IS ?")]:
+        if value is None:
+            continue
+        params = (str(userid), value) + ((year,) if extra else ())
+        row = ZOTERO_INDEX.execute(
+                "SELECT key, version, collections FROM items "
+                "WHERE userid = ? AND %s = ?%s LIMIT 1;" % (column, extra),
+                params).fetchone()
+        if row is not None:
+            return row[0], row[1], json.loads(row[2])
+    return None
+
+
+def z_batch_full(queue):
+    """Return whether a queue as for z_take_batch holds a full batch"""
+    return len(queue) >= BATCH_SIZE or sum(
+            len(x[1]) + 1 for x in queue[:BATCH_SIZE]) > BATCH_BYTES
+
+
+def z_upload(token, userid, windows, collection_map, item_map, journal,
+             pdfs=(), datadir=None):
+    """Upload items, their children and PDFs, each as soon as it can be
+
+    `windows` yields (items, children) pairs as from p_item_windows, and
+    `pdfs` lists PDF attachments as from p_read_pdfs.  Items are written in
+    batches as they are read, and the PDFs of each window's items are only
+    checked for duplicates by pdf_dedup once the window is read, so that
+    hashing the whole library does not hold up the first batch.  A child (a
+    note, PubMed entry or PDF attachment) is queued as soon as the batch
+    holding its parent comes back with the parent's key, and a PDF's file is
+    copied to the storage directory under datadir (or, if PDF_UPLOAD is set,
+    uploaded to Zotero file storage) as soon as its attachment has a
+    key.  Writes share up to MAX_WORKERS threads, preferring full batches of
+    children to items, and files another PDF_WORKERS, so the upload takes
+    about as long as the slowest of these streams rather than all of them in
+    turn.  Batches of children are only sent part full once every item has
+    been written.  Only the first of a set of identical files is copied; the
+    rest are hard linked to that copy at the end.
+
+    item_map maps the papers UUID of each item already in Zotero to its key
+    and is added to; children of items that are neither in it nor uploaded
+    are dropped.  If ZOTERO_INDEX is open, items that duplicate one already
+    in Zotero are skipped or, if DUPLICATES is "link", take the existing
+    item's key (so that their children are added to it) and the existing
+    item is then added to their collections.  Anything recorded in the
+    journal is not uploaded again, but the files of PDFs are still copied if
+    they are missing from storage.  The journal is only written from the
+    calling thread.  Returns a dictionary counting the objects written by
+    kind, and the files ("files") and bytes ("file_bytes") copied or
+    uploaded out of those handled ("file_jobs"), the duplicates found
+    ("duplicate"), and the duplicate PDFs found ("duplicate_files"), dropped
+    ("dropped_files") and not copied ("saved_bytes").  If anything fails,
+    nothing more is sent, but the batches already being written are waited
+    for and journaled before the error is raised.
+    """
+    url = "%s/users/%s/items" % (ZOTERO_API, userid)
+    done = dict((kind, journal_map(journal, kind))
+                for kind in ["note", "pubmed", "pdf"])
+    counts = dict((kind, 0) for kind in ["item", "note", "pubmed", "pdf",
+                                         "file_jobs", "files", "file_bytes",
+                                         "duplicate", "duplicate_files",
+                                         "dropped_files", "saved_bytes"])
+    # Objects waiting to be written, as (object, encoded JSON, journal
+    # reference, digest) tuples, and children waiting for their parent's key
+    # by the papers UUID of the parent
+    items = []
+    children = []
+    waiting = collections.defaultdict(list)
+    # PDFs not yet checked for duplicates, by the papers UUID of their item
+    unchecked = collections.defaultdict(list)
+    for pdf in pdfs:
+        unchecked[pdf["papers_uuid"]].append(pdf)
+    sizes = pdf_sizes(pdfs)
+    seen = set()
+    # Updates to existing items linked to, by their Zotero key
+    links = collections.OrderedDict()
+    first_copy = {}
+    link_jobs = []
+    state = {"reading": True, "item_batches": 0, "stopping": False}
+    windows = iter(windows)
+    results = Queue.Queue()
+    api = WorkerPool(MAX_WORKERS, results)
+    files = WorkerPool(PDF_WORKERS, results)
+
+    def queue_file(pdf, key):
+        if state["stopping"]:
+            # The file is copied when the migration is resumed
+            return
+        counts["file_jobs"] += 1
+        if PDF_UPLOAD:
+            files.submit(None, z_upload_file, token, userid, key,
+                         pdf["papers_file"], pdf.get("papers_md5"))
+            return
+        dest = "/".join([datadir, "storage", key])
+        name = os.path.basename(pdf["papers_file"])
+        md5 = pdf.get("papers_md5")
+        if md5 in first_copy:
+            link_jobs.append((first_copy[md5], dest, name, True))
+            return
+        if md5 is not None:
+            first_copy[md5] = os.path.join(dest, name)
+        files.submit(None, pdf_copy, pdf["papers_file"], dest)
+
+    def queue_child(child):
+        kind, ref = z_child_ref(child)
+        if ref in done[kind]:
+            if kind == "pdf":
+                queue_file(child, done[kind][ref])
+            return
+        if child["papers_uuid"] not in item_map:
+            waiting[child["papers_uuid"]].append(child)
+            return
+        child["parentItem"] = item_map[child["papers_uuid"]]
+        children.append((child, z_encode(child), (kind, ref), None))
+
+    def check_pdfs(uuids):
+        pending = [pdf for uuid in uuids for pdf in unchecked.pop(uuid, [])]
+        if len(pending) == 0:
+            return
+        kept, duplicates, saved = pdf_dedup(pending, sizes, seen)
+        counts["duplicate_files"] += duplicates
+        counts["dropped_files"] += len(pending) - len(kept)
+        counts["saved_bytes"] += saved
+        for pdf in kept:
+            queue_child(pdf)
+
+    def read_window():
+        try:
+            import_items, import_children = next(windows)
+        except StopIteration:
+            state["reading"] = False
+            # What is left belongs to items that were not read, of which
+            # only those already in Zotero can have PDFs attached
+            check_pdfs([uuid for uuid in unchecked if uuid in item_map])
+            return
+        for item in import_items:
+            if item["papers_uuid"] in item_map:
+                continue
+            item["collections"] = z_item_collections(item, collection_map)
+            duplicate = None
+            if ZOTERO_INDEX is not None:
+                duplicate = z_index_match(userid, item)
+            if duplicate is not None:
+                counts["duplicate"] += 1
+                if DUPLICATES == "link":
+                    link(item, *duplicate)
+                continue
+            items.append((item, z_encode(item), ("item", item["papers_uuid"]),
+                          item.get("papers_digest")))
+        for child in import_children:
+            queue_child(child)
+        check_pdfs(item["papers_uuid"] for item in import_items)
+
+    def link(item, key, version, existing):
+        # The existing item stands in for this one from now on, and is
+        # updated with its collections once everything else is written.
+        # Several papers may match the same item, so each item gets a
+        # single update with the collections of all of them.
+        item_map[item["papers_uuid"]] = key
+        journal_link_recorder(journal, [[(item["papers_uuid"],
+                                          item.get("papers_digest"))]])(
+                {0: key}, version)
+        update = links.setdefault(key, {"key": key, "version": version,
+                                        "collections": set(existing),
+                                        "papers": []})
+        update["collections"].update(item["collections"])
+        update["papers"].append((item["papers_uuid"],
+                                 item.get("papers_digest")))
+        for child in waiting.pop(item["papers_uuid"], []):
+            queue_child(child)
+
+    def next_batch():
+        # Returns the next batch to write and whether it holds items, or
+        # None if nothing can be written until more batches come back
+        while not z_batch_full(children):
+            if len(items) >= BATCH_SIZE or not state["reading"]:
+                break
+            read_window()
+        if z_batch_full(children):
+            return z_take_batch(children), False
+        if len(items) > 0:
+            return z_take_batch(items), True
+        if (len(children) > 0 and not state["reading"]
+                and state["item_batches"] == 0):
+            return z_take_batch(children), False
+        return None
+
+    def written(batch, success, failed, version):
+        refs = [x[2] for x in batch]
+        journal_recorder(journal, refs, [x[3] for x in batch])(success,
+                                                               version)
+        if len(failed) > 0:
+            z_reject(url, [(batch[i][0], failed[i]) for i in sorted(failed)])
+        for i, key in success.iteritems():
+            kind, ref = refs[i]
+            counts[kind] += 1
+            if kind == "item":
+                item_map[ref] = key
+                for child in waiting.pop(ref, []):
+                    queue_child(child)
+                continue
+            done[kind][ref] = key
+            if kind == "pdf":
+                queue_file(batch[i][0], key)
+
+    start = time.time()
+    try:
+        while True:
+            while api.pending < 2 * MAX_WORKERS:
+                batch = next_batch()
+                if batch is None:
+                    break
+                batch, is_items = batch
+                if is_items:
+                    state["item_batches"] += 1
+                api.submit((batch, is_items), z_write_batch, token, url,
+                           [x[:2] for x in batch])
+            if api.pending == 0 and files.pending == 0:
+                break
+            pool, tag, result = WorkerPool.wait(results)
+            if pool is files:
+                if result is not None:
+                    counts["files"] += 1
+                    counts["file_bytes"] += result
+                continue
+            batch, is_items = tag
+            if is_items:
+                state["item_batches"] -= 1
+            written(batch, *result)
+    except BaseException:
+        # Batches already being written are waited for and journaled, so
+        # that --resume does not write them a second time
+        error = sys.exc_info()
+        state["stopping"] = True
+        for pool, tag, result in WorkerPool.drain(results, [api, files]):
+            if pool is api:
+                written(tag[0], *result)
+        raise error[0], error[1], error[2]
+    finally:
+        api.close()
+        files.close()
+    updates = links.values()
+    z_api_write(token, url, [{"key": x["key"], "version": x["version"],
+                              "collections": sorted(x["collections"])}
+                             for x in updates],
+                journal_link_recorder(journal, [x["papers"] for x in updates]))
+    for n in pool_imap(lambda job: pdf_copy(*job), link_jobs, PDF_WORKERS):
+        if n is not None:
+            counts["files"] += 1
+            counts["file_bytes"] += n
+
+    pdf_report_duplicates(counts["duplicate_files"], counts["dropped_files"],
+                          counts["saved_bytes"])
+    if counts["file_jobs"] > 0:
+        elapsed = max(time.time() - start, 0.001)
+        print "%s %s PDF(s) (%.1f MB at %.1f MB/s); %s already %s" % (
+                "Uploaded" if PDF_UPLOAD else "Copied", counts["files"],
+                counts["file_bytes"] / 1048576.0,
+                counts["file_bytes"] / 1048576.0 / elapsed,
+                counts["file_jobs"] - counts["files"],
+                "stored" if PDF_UPLOAD else "present")
+    return counts
+
+
+@timed("items")
+def z_recreate_items(token, userid, windows, collection_map, journal,
+                     pdfs=(), datadir=None):
+    """Import items into the Zotero API
+
+    `windows` yields (items, children) pairs as from p_item_windows, which
+    are uploaded by z_upload along with the PDFs in `pdfs`, as from
+    p_read_pdfs.  Anything already recorded in the journal is not uploaded
+    again.  Returns the item map.
+    """
+    print "Uploading items to Zotero..."
+    item_map = journal_map(journal, "item")
+    if len(item_map) > 0:
+        print "Skipping %s item(s) already uploaded..." % len(item_map)
+    if len(pdfs) > 0:
+        print ("PDFs will be %s as their entries are created..." % (
+                   "uploaded to Zotero file storage" if PDF_UPLOAD
+                   else "copied to the local Zotero data storage directory"))
+    counts = z_upload(token, userid, windows, collection_map, item_map,
+                      journal, pdfs, datadir)
+    print ("Uploaded %s item(s), %s note(s), %s PubMed entries and %s PDF "
+           "attachment(s) to Zotero" % (counts["item"], counts["note"],
+                                        counts["pubmed"], counts["pdf"]))
+    if counts["duplicate"] > 0:
+        print "%s %s item(s) already in the Zotero library" % (
+                "Linked" if DUPLICATES == "link" else "Skipped",
+                counts["duplicate"])
+    return item_map
+
+
+def p_last_modified(papersdb_cursor):
+    """Return the time the most recently modified papers item was changed"""
+    cursor = papersdb_cursor.connection.cursor()
+    cursor.execute("SELECT MAX(updated_at) FROM Publication;")
+    return cursor.fetchone()[0] or 0
+
+
+def z_item_versions(token, userid, keys):
+    """Return a dictionary of the current version of each item in keys"""
+    versions = {}
+    for i in xrange(0, len(keys), BATCH_SIZE):
+        status, headers, data = z_request(
+                "GET",
+                "%s/users/%s/items?%s" % (ZOTERO_API, userid,
+                                          urllib.urlencode({
+                                              "format": "versions",
+                                              "itemKey": ",".join(
+                                                  keys[i:i+BATCH_SIZE])
+                                              })),
+                headers={"Zotero-API-Key": token, "Zotero-API-Version": "3"}
+                )
+        if status != 200:
+            sys.exit("Error: received HTTP %s" % status)
+        versions.update(json.loads(data))
+    return versions
+
+
+def z_update_items(token, userid, items, notes, collection_map, journal):
+    """Update items (and their notes) already in Zotero from papers
+
+    Each object is sent with the version recorded in the journal when it was
+    last written, so Zotero refuses to overwrite anything that has been
+    modified there since; those are reported and left alone.  Objects
+    written before versions were recorded are updated from their current
+    version.
+
+    Items that papers were linked to (see z_upload) belong to the Zotero
+    library rather than to papers, so their fields are left alone.  They
+    are only added to the collections of the papers linked to them, on top
+    of those they are in now, with one update per item.  Any that have been
+    moved to the trash are left there.
+    """
+    entries = {"item": journal_entries(journal, "item"),
+               "note": journal_entries(journal, "note")}
+    linked = journal_map(journal, "link")
+    links = collections.OrderedDict()
+    objects = []
+    refs = []
+    digests = []
+    for item in items:
+        item["collections"] = z_item_collections(item, collection_map)
+        if item["papers_uuid"] in linked:
+            key = linked[item["papers_uuid"]]
+            update = links.setdefault(key, {"key": key,
+                                            "collections": set(),
+                                            "papers": []})
+            update["collections"].update(item["collections"])
+            update["papers"].append((item["papers_uuid"],
+                                     item["papers_digest"]))
+            continue
+        objects.append(item)
+        refs.append(("item", item["papers_uuid"]))
+        digests.append(item["papers_digest"])
+    for note in notes:
+        if note["papers_uuid"] in entries["note"]:
+            objects.append(note)
+            refs.append(("note", note["papers_uuid"]))
+            digests.append(None)
+    if len(objects) == 0 and len(links) == 0:
+        return
+
+    print "Updating %s item(s) and note(s) changed in Papers..." % (
+            len(objects) + len(links))
+    for obj, (kind, papers_uuid) in itertools.izip(objects, refs):
+        obj["key"], obj["version"] = entries[kind][papers_uuid][:2]
+    unversioned = [obj["key"] for obj in objects if obj["version"] is None]
+    if len(unversioned) > 0:
+        versions = z_item_versions(token, userid, unversioned)
+        for obj in objects:
+            if obj["version"] is None:
+                obj["version"] = versions.get(obj["key"], 0)
+
+    url = "%s/users/%s/items" % (ZOTERO_API, userid)
+    conflicts = []
+
+    def failed(failures):
+        # Objects modified in Zotero are expected and reported together
+        # below rather than rejected
+        claimed = [i for i in failures if failures[i].get("code") == 412]
+        conflicts.extend(claimed)
+        return claimed
+
+    z_api_write(token, url, objects, journal_recorder(journal, refs, digests),
+                failed)
+    if len(links) > 0:
+        current = z_item_data(token, userid, links.keys())
+        updates = [x for x in links.itervalues() if x["key"] in current
+                   and not current[x["key"]][1].get("deleted")]
+        z_api_write(token, url,
+                    [{"key": x["key"], "version": current[x["key"]][0],
+                      "collections": sorted(x["collections"] | set(
+                          current[x["key"]][1].get("collections", [])))}
+                     for x in updates],
+                    journal_link_recorder(journal,
+                                          [x["papers"] for x in updates]))
+    if len(conflicts) > 0:
+        print ("%s item(s) or note(s) have been modified in Zotero since they "
+               "were last synced and were not overwritten" % len(conflicts))
+
+
+@timed("sync")
+def z_sync_items(token, userid, papersdb_cursor, collection_map,
+                 pubmed_cleanup, journal, pdfs=(), datadir=None):
+    """Push items that are new or changed in papers since the last sync
+
+    An item has changed if papers has modified it since the journal's
+    "synced_at" time, or if the digest of what is read for it (including
+    its tags, collections and note) differs from the one recorded.  Only
+    these are read through the PubMed cleanup.  New items, and new notes and
+    PubMed entries and the PDFs in `pdfs`, are uploaded by z_recreate_items;
+    items already in Zotero are updated by z_update_items.  Returns the item
+    map.
+    """
+    synced_at = float(journal_get(journal, "synced_at") or 0)
+    entries = journal_entries(journal, "item")
+
+    def changed(row):
+        item = row[0]
+        entry = entries.get(item["papers_uuid"])
+        return (entry is None or (item["papers_updated"] or 0) > synced_at
+                or entry[2] != item["papers_digest"])
+
+    # Changed items already in Zotero are set aside (with their notes) as
+    # the windows pass through z_recreate_items, which skips them
+    updates = []
+    update_notes = []
+
+    def windows():
+        for import_items, import_children in p_item_windows(
+                papersdb_cursor, pubmed_cleanup, changed):
+            updates.extend(item for item in import_items
+                           if item["papers_uuid"] in entries)
+            update_notes.extend(child for child in import_children
+                                if child["itemType"] == "note"
+                                and child["papers_uuid"] in entries)
+            yield import_items, import_children
+
+    item_map = z_recreate_items(token, userid, windows(), collection_map,
+                                journal, pdfs, datadir)
+    z_update_items(token, userid, updates, update_notes, collection_map,
+                   journal)
     return item_map
 
 
-def z_recreate_pdfs(token, userid, papersdb_cursor, item_map):
-    """Copy PDFs to zotero local storage and upload info to API"""
-    print "Retrieving information on PDFs from Papers..."
-    # Get path to zotero data directory
+def z_collection_count(token, userid, key):
+    """Return the number of top-level items in a Zotero collection
+
+    Only a single item is asked for; the count is read from the
+    Total-Results header.  Items in the trash are not counted.
+    """
+    status, headers, data = z_request(
+            "GET",
+            "%s/users/%s/collections/%s/items/top?limit=1" % (ZOTERO_API,
+                                                              userid, key),
+            headers={"Zotero-API-Key": token, "Zotero-API-Version": "3"})
+    if status == 404:
+        return None
+    if status != 200:
+        sys.exit("Error: received HTTP %s" % status)
+    return int(headers.get("total-results", 0))
+
+
+@timed("verify")
+def z_verify_collections(token, userid, p_tld_uuid, p_collections,
+                         expected, collection_map):
+    """Compare the number of items in each collection with papers
+
+    `expected` is as returned by p_collection_counts and `collection_map`
+    maps papers collection UUIDs to Zotero keys, as recorded in the journal.
+    The Zotero collections are counted MAX_WORKERS at a time.  Each
+    collection whose count differs (or which is missing from Zotero) is
+    printed, and a list of (papers UUID, expected, actual) tuples is
+    returned for them; actual is None for a missing collection.
+    """
+    uuids = [p_tld_uuid] + sorted(p_collections)
+    print "Counting the items in %s collection(s) in Zotero..." % len(uuids)
+    counts = pool_imap(
+            lambda x: (z_collection_count(token, userid, collection_map[x])
+                       if x in collection_map else None),
+            uuids, MAX_WORKERS)
+    mismatches = []
+    for x, actual in itertools.izip(uuids, counts):
+        if actual != expected.get(x, 0):
+            mismatches.append((x, expected.get(x, 0), actual))
+
+    def path(x):
+        # The collection's name, preceded by those of its parents
+        names = []
+        while x in p_collections and len(names) <= len(p_collections):
+            names.append(p_collections[x]["name"])
+            x = p_collections[x]["parent"]
+        return "/".join(reversed(names)) or "(top level import collection)"
+
+    for x, wanted, actual in mismatches:
+        if actual is None:
+            print "%s: missing from Zotero (%s item(s) in Papers)" % (
+                    path(x), wanted)
+        else:
+            print "%s: %s item(s) in Zotero, %s in Papers" % (path(x), actual,
+                                                              wanted)
+    return mismatches
+
+
+def file_md5(path):
+    """Return the hex MD5 digest of the file at path
+
+    Large files are mapped into memory and hashed a slice at a time, which
+    avoids a read() system call per block; smaller ones are read in blocks.
+    hashlib releases the GIL while hashing, so several files can be hashed
+    at once in threads.
+    """
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i in xrange(0, size, MMAP_THRESHOLD):
+                    digest.update(m[i:i+MMAP_THRESHOLD])
+            finally:
+                m.close()
+        else:
+            for block in iter(lambda: f.read(1048576), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def file_clone(src, dst):
+    """Make dst a copy-on-write clone of src if the filesystem allows it
+
+    This uses clonefile() on APFS and the FICLONE ioctl on Linux (btrfs,
+    XFS), neither of which copies any data.  Returns False, leaving nothing
+    at dst, if cloning is not possible.
+    """
+    encode = lambda path: (path.encode(sys.getfilesystemencoding())
+                           if isinstance(path, unicode) else path)
+    try:
+        if sys.platform == "darwin":
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            return libc.clonefile(encode(src), encode(dst), 0) == 0
+        with open(src, "rb") as s:
+            with open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except (AttributeError, IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+def pdf_copy(src, dest, name=None, link=None):
+    """Copy the PDF at src into the directory dest, creating it if needed
+
+    The copy is called name, or the name of src by default.  A file already
+    in dest with the same size and checksum is left alone and None is
+    returned; otherwise the number of bytes written is returned.  The file is
+    hard linked if link (by default PDF_LINK) is set and both are on the same
+    filesystem, cloned if the filesystem supports it, and otherwise copied.
+    """
+    if link is None:
+        link = PDF_LINK
+    try:
+        os.makedirs(dest)
+    except OSError:
+        if not os.path.isdir(dest):
+            raise
+    target = os.path.join(dest, name or os.path.basename(src))
+    size = os.path.getsize(src)
+    if os.path.isfile(target):
+        if (os.path.getsize(target) == size and
+                file_md5(target) == file_md5(src)):
+            return None
+        os.remove(target)
+
+    if link and os.stat(src).st_dev == os.stat(dest).st_dev:
+        os.link(src, target)
+        return 0
+    if not file_clone(src, target):
+        with open(src, "rb") as s:
+            with open(target, "wb") as d:
+                shutil.copyfileobj(s, d, 1048576)
+        shutil.copystat(src, target)
+    return size
+
+
+def pdf_sizes(pdfs):
+    """Set the "papers_size" of each PDF and return a Counter of the sizes"""
+    for pdf in pdfs:
+        pdf["papers_size"] = os.path.getsize(pdf["papers_file"])
+    return collections.Counter(pdf["papers_size"] for pdf in pdfs)
+
+
+def pdf_dedup(pdfs, sizes=None, seen=None):
+    """Find PDFs in the list from p_pdf_inventory with identical content
+
+    Only files that share their size with another can be identical, so just
+    those are hashed, PDF_WORKERS at a time.  `sizes` counts the sizes of
+    all the PDFs that will be checked, as from pdf_sizes, when the list is
+    only part of them, and `seen` holds the digests found by earlier calls
+    and is added to.  Each PDF gains a "papers_md5" (None if it was not
+    hashed).  Identical files attached to the same item are dropped, so all
+    the PDFs of an item must be checked together.  Returns the remaining
+    PDFs, the number of duplicates found and the number of bytes that need
+    not be copied, counting the dropped files and all but the first of each
+    set of identical files.
+    """
+    if sizes is None:
+        sizes = pdf_sizes(pdfs)
+    if seen is None:
+        seen = set()
+    for pdf in pdfs:
+        pdf["papers_md5"] = None
+    candidates = [pdf for pdf in pdfs if sizes[pdf["papers_size"]] > 1]
+    digests = pool_imap(lambda pdf: file_md5(pdf["papers_file"]), candidates,
+                        PDF_WORKERS)
+    for pdf, digest in itertools.izip(candidates, digests):
+        pdf["papers_md5"] = digest
+
+    kept = []
+    duplicates = 0
+    saved = 0
+    for pdf in pdfs:
+        md5 = pdf["papers_md5"]
+        if md5 is not None:
+            if md5 in seen:
+                duplicates += 1
+                saved += pdf["papers_size"]
+            if (pdf["papers_uuid"], md5) in seen:
+                continue
+            seen.update([md5, (pdf["papers_uuid"], md5)])
+        kept.append(pdf)
+    return kept, duplicates, saved
+
+
+def pdf_report_duplicates(duplicates, dropped, saved):
+    """Print the numbers of duplicate PDFs and bytes saved from pdf_dedup"""
+    if duplicates > 0:
+        print ("Found %s duplicate PDF(s), of which %s duplicated within an "
+               "item were dropped; storing each file once saves %.1f MB" % (
+                   duplicates, dropped, saved / 1048576.0))
+
+
+def p_list_files(prefix, directories):
+    """Return the set of files present in each of directories under prefix
+
+    Paths are relative to prefix and NFC normalised, since HFS+ returns
+    decomposed file names.  Each directory is listed once instead of each
+    file being checked with its own stat, which is slow on network mounts.
+    """
+    fs_encoding = sys.getfilesystemencoding()
+    if not isinstance(prefix, unicode):
+        prefix = prefix.decode(fs_encoding)
+    files = set()
+    for directory in directories:
+        try:
+            names = os.listdir(os.path.join(prefix, directory))
+        except OSError:
+            continue
+        for name in names:
+            if not isinstance(name, unicode):
+                name = name.decode(fs_encoding, "replace")
+            files.add(unicodedata.normalize("NFC", "/".join(
+                    [directory, name]) if directory else name))
+    return files
+
+
+def p_pdf_inventory(papersdb_cursor, uuids, prefix):
+    """Return a list of the PDFs in papers belonging to the items in uuids
+
+    Each entry is the attachment to upload to the Zotero API, with the extra
+    keys "papers_uuid" (its parent), "papers_path" (its path relative to the
+    papers library) and "papers_file" (the full path to the file).  If
+    uuids is None, the PDFs of every item read by p_read_items are
+    returned.  Otherwise the PDF table is read in one scan and filtered
+    here, since the read-only connection from open_papersdb cannot load the
+    items into a temporary table.  PDFs whose files are missing are dropped
+    using a listing of the directories involved.
+    """
+    cursor = papersdb_cursor.connection.cursor()
+    pdfs_sql = ("SELECT PDF.path, PDF.object_id, PDF.created_at FROM PDF "
+                "WHERE PDF.type = 0 "
+                "AND PDF.mime_type = 'application/pdf'")
+    if uuids is None:
+        # The same items as p_read_items, whose other PDFs would never
+        # find a parent
+        pdfs_sql += (" AND PDF.object_id IN ("
+                     "SELECT a.uuid FROM Publication a, Publication b "
+                     "WHERE a.bundle = b.uuid "
+                     "AND a.type >= 0 "
+                     "AND a.privacy_level = 0)")
+    rows = cursor.execute(pdfs_sql + ";").fetchall()
+    if uuids is not None:
+        uuids = set(uuids)
+        rows = [row for row in rows if row["object_id"] in uuids]
+
+    present = p_list_files(prefix,
+                           set(os.path.dirname(row["path"]) for row in rows))
+    pdfs = []
+    for pdfs_row in rows:
+        if unicodedata.normalize("NFC", pdfs_row["path"]) not in present:
+            continue
+        d = datetime.datetime.utcfromtimestamp(pdfs_row["created_at"])
+        d = "".join([d.replace(microsecond=0).isoformat(), "Z"])
+        name = os.path.basename(pdfs_row["path"])
+        pdfs.append({
+                "itemType": "attachment",
+                "linkMode": "imported_file",
+                "title": name,
+                "contentType": "application/pdf",
+                "filename": name,
+                "tags": [],
+                "relations": {},
+                "dateAdded": d,
+                "papers_uuid": pdfs_row["object_id"],
+                "papers_path": pdfs_row["path"],
+                "papers_file": "/".join([prefix, pdfs_row["path"]])
+                })
+    return pdfs
+
+
+def z_local_datadir():
+    """Return the path to the local Zotero data directory"""
     config = ConfigParser.RawConfigParser()
-    profilesini = config.read(os.path.expanduser(
+    config.read(os.path.expanduser(
         "~/Library/Application Support/Zotero/profiles.ini"
         ))
     prefsjs = open(os.path.expanduser("/".join([
@@ -444,188 +3047,921 @@ def z_recreate_pdfs(token, userid, papersdb_cursor, item_map):
                 line
                 )
         if match:
-            datadir = match.group(1)
-
-    # Generate "pdfs", a list where each item is a dictionary containing
-    # a PDF path, a zotero key and the date the item was added
-    f = os.path.expanduser("~/Library/Preferences/com.mekentosj.papers3.plist")
-    plist = subprocess.check_output(["plutil", "-convert", "xml1", "-o", "-", f])
-    prefix = plistlib.readPlistFromString(plist)[
-                 "mt_papers3_full_library_location_shared"
-                 ]
-    pdfs_sql = ("SELECT path, object_id, created_at FROM PDF "
-                "WHERE type = 0 "
-                "AND mime_type = 'application/pdf';")
-    pdfs_res = papersdb_cursor.execute(pdfs_sql)
-    pdfs = []
-    for pdfs_row in pdfs_res.fetchall():
-        path_abs = "/".join([prefix, pdfs_row["path"]])
-        if pdfs_row["object_id"] in item_map:
-            if os.path.isfile(path_abs):
-                d = datetime.datetime.utcfromtimestamp(pdfs_row["created_at"])
-                d = "".join([d.replace(microsecond=0).isoformat(), "Z"])
-                pdfs.append({
-                        "path": path_abs,
-                        "parentItem": item_map[pdfs_row["object_id"]],
-                        "dateAdded": d
-                        })
-
-    # Create import_pdfs and upload to the zotero API
-    print "Associating PDFs with entries in Zotero..."
-    import_pdfs = []
-    for pdf in pdfs:
-        import_pdfs.append({
-            "itemType": "attachment",
-            "linkMode": "imported_file",
-            "title": os.path.basename(pdf["path"]),
-            "contentType": "application/pdf",
-            "filename": os.path.basename(pdf["path"]),
-            "tags": [],
-            "relations": {},
-            "dateAdded": pdf["dateAdded"],
-            "parentItem": pdf["parentItem"]
-            })
-    pdfs_success = z_api_write(
-            token,
-            "https://api.zotero.org/users/%s/items" % userid,
-            import_pdfs
+            return match.group(1)
+    sys.exit("Could not find the Zotero data directory")
+
+
+def z_upload_file(token, userid, key, path, md5=None):
+    """Upload a file to Zotero file storage for the attachment item `key`
+
+    This follows the Zotero file upload protocol: the upload is authorised
+    with the file's MD5, size and modification time, the file is streamed to
+    the URL given (between the prefix and suffix supplied) and the upload is
+    then registered.  md5 is computed by reading the file in blocks if it is
+    not given.  Returns the number of bytes uploaded, or None if Zotero
+    already had the file.
+    """
+    size = os.path.getsize(path)
+    if md5 is None:
+        md5 = file_md5(path)
+    name = os.path.basename(path)
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    url = "%s/users/%s/items/%s/file" % (ZOTERO_API, userid, key)
+    headers = {
+        "Zotero-API-Key": token,
+        "Zotero-API-Version": "3",
+        "Content-Type": "application/x-www-form-urlencoded",
+        "If-None-Match": "*"
+        }
+    status, res_headers, data = z_request("POST", url, urllib.urlencode({
+        "md5": md5,
+        "filename": name,
+        "filesize": size,
+        "mtime": int(os.path.getmtime(path) * 1000)
+        }), headers)
+    # 412 means the attachment already has a file, from an earlier run
+    if status == 412:
+        return None
+    if status != 200:
+        sys.exit("Error: received HTTP %s authorising upload of %s" % (
+            status, path))
+    auth = json.loads(data)
+    if auth.get("exists"):
+        return None
+
+    prefix = auth["prefix"].encode("utf-8")
+    suffix = auth["suffix"].encode("utf-8")
+    status, res_headers, data = http_request(
+            "POST",
+            auth["url"],
+            lambda: ChainReader([prefix, open(path, "rb"), suffix]),
+            {"Content-Type": auth["contentType"],
+             "Content-Length": str(len(prefix) + size + len(suffix))}
+            )
+    if status != 201:
+        sys.exit("Error: received HTTP %s uploading %s" % (status, path))
+
+    status, res_headers, data = z_request(
+            "POST",
+            url,
+            urllib.urlencode({"upload": auth["uploadKey"]}),
+            headers
             )
+    if status != 204:
+        sys.exit("Error: received HTTP %s registering upload of %s" % (
+            status, path))
+    return size
+
+
+@timed("pdf_inventory")
+def p_read_pdfs(papersdb_cursor, uuids, skip=(), dedup=True):
+    """Return the PDFs in papers belonging to the items in uuids (or all)
+
+    The PDFs are listed by p_pdf_inventory, leaving out those whose papers
+    path is in skip.  If dedup is set, identical files attached to the same
+    item are dropped by pdf_dedup; otherwise that is left to z_upload, which
+    checks the PDFs of each item as it is read.
+    """
+    print "Retrieving information on PDFs from Papers..."
+    prefix = p_library_paths()[1]
+    pdfs = [pdf for pdf in p_pdf_inventory(papersdb_cursor, uuids, prefix)
+            if pdf["papers_path"] not in skip]
+    if not dedup:
+        return pdfs
+    print "Checking %s PDF(s) for duplicates..." % len(pdfs)
+    found = len(pdfs)
+    pdfs, duplicates, saved = pdf_dedup(pdfs)
+    pdf_report_duplicates(duplicates, found - len(pdfs), saved)
+    return pdfs
+
+
+def ncbi_request(tool, params):
+    """POST params to an NCBI E-utility and return the response body
+
+    Requests from all threads are rate limited by NCBI_LIMITER and carry
+    NCBI_API_KEY when one has been given.
+    """
+    params = dict((k, v.encode("utf-8") if isinstance(v, unicode) else v)
+                  for k, v in params.iteritems())
+    if NCBI_API_KEY is not None:
+        params["api_key"] = NCBI_API_KEY
+    NCBI_LIMITER.acquire()
+    status, headers, data = http_request(
+            "POST",
+            "%s/%s.fcgi" % (EUTILS, tool),
+            urllib.urlencode(params),
+            {"Content-Type": "application/x-www-form-urlencoded"}
+            )
+    if status != 200:
+        sys.exit("Error: received HTTP %s from PubMed %s" % (status, tool))
+    return data
+
 
-    # Copy PDFs to the zotero data directory
-    print "Copying PDFs to the local Zotero data storage directory..."
-    for i in pdfs_success:
-        dest = "/".join([datadir, "storage", pdfs_success[i]])
-        os.mkdir(dest)
-        shutil.copy(pdfs[i]["path"], dest)
+def pm_normalise_pmcid(pmcid):
+    """Return a PMCID in the form "PMC1234" whatever form it was given in"""
+    pmcid = pmcid.strip().upper()
+    if not pmcid.startswith("PMC"):
+        pmcid = "PMC" + pmcid
+    return pmcid
 
 
+def pm_cache_open(path):
+    """Open (creating if necessary) the PubMed cache at path
+
+    The cache is an sqlite database holding the PMID found for each DOI and
+    PMCID searched for, and the details of each article fetched, so that
+    reruns of a migration need hardly any requests to PubMed.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    cache = metrics_connection(sqlite3.connect(path, timeout=60))
+    # Several passport processes may share the cache (see batch_migrate);
+    # in WAL mode they can read it while one of them writes
+    cache.execute("PRAGMA journal_mode = WAL;")
+    cache.execute("CREATE TABLE IF NOT EXISTS cache ("
+                  "kind TEXT NOT NULL, "
+                  "key TEXT NOT NULL, "
+                  "value TEXT NOT NULL, "
+                  "fetched REAL NOT NULL, "
+                  "used REAL NOT NULL, "
+                  "size INTEGER NOT NULL, "
+                  "PRIMARY KEY (kind, key));")
+    cache.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used);")
+    cache.commit()
+    return cache
+
+
+def pm_cache_get(kind, keys):
+    """Return a dictionary of the cached values of `kind` for keys
+
+    Keys that are not cached or whose entries are older than
+    PUBMED_CACHE_TTL are left out.
+    """
+    hits = {}
+    if PUBMED_CACHE is None:
+        return hits
+    keys = list(keys)
+    now = time.time()
+    for i in xrange(0, len(keys), 500):
+        chunk = keys[i:i+500]
+        sql = ("SELECT key, value FROM cache "
+               "WHERE kind = ? AND fetched > ? AND key IN (%s);" %
+               ",".join("?" * len(chunk)))
+        hits.update(PUBMED_CACHE.execute(
+                sql, [kind, now - PUBMED_CACHE_TTL] + chunk))
+    PUBMED_CACHE.executemany(
+            "UPDATE cache SET used = ? WHERE kind = ? AND key = ?;",
+            [(now, kind, k) for k in hits])
+    PUBMED_CACHE.commit()
+    return hits
+
+
+def pm_cache_put(kind, entries):
+    """Store (key, value) pairs of `kind` in the cache"""
+    if PUBMED_CACHE is None:
+        return
+    now = time.time()
+    PUBMED_CACHE.executemany(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?);",
+            [(kind, k, v, now, now, len(k) + len(v)) for k, v in entries])
+    PUBMED_CACHE.commit()
+
+
+def pm_cache_evict():
+    """Drop expired entries, then the least recently used beyond the size"""
+    if PUBMED_CACHE is None:
+        return
+    PUBMED_CACHE.execute("DELETE FROM cache WHERE fetched <= ?;",
+                         (time.time() - PUBMED_CACHE_TTL,))
+    total = PUBMED_CACHE.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache;").fetchone()[0]
+    if total > PUBMED_CACHE_SIZE:
+        evict = []
+        for kind, key, size in PUBMED_CACHE.execute(
+                "SELECT kind, key, size FROM cache ORDER BY used;"):
+            if total <= PUBMED_CACHE_SIZE:
+                break
+            evict.append((kind, key))
+            total -= size
+        PUBMED_CACHE.executemany(
+                "DELETE FROM cache WHERE kind = ? AND key = ?;", evict)
+    PUBMED_CACHE.commit()
+
+
+def pm_resolve_pmids(import_items):
+    """Look up a PMID for items that have a DOI or PMCID but no PMID
+
+    Rather than one ESearch per item, up to PUBMED_TERMS identifiers are
+    combined into each ESearch with OR and the matching articles are then
+    fetched in a single ESummary, whose article IDs map each PMID back to
+    the DOI or PMCID it was found by.  If the ESearch matches more articles
+    than it returned, the rest are paged through with retstart so that every
+    match is seen.  As when searching for identifiers one at a time, a PMID
+    is only assigned if exactly one article matches; a DOI match takes
+    precedence over a PMCID match.  Identifiers found in the cache are not
+    searched for again.
+    """
+    missing = [item for item in import_items
+               if "pmid" not in item and ("doi" in item or "pmcid" in item)]
+    dois = set(item["doi"].lower() for item in missing if "doi" in item)
+    pmcids = set(pm_normalise_pmcid(item["pmcid"]) for item in missing
+                 if "pmcid" in item)
+    # A cached PMID of "" records that no single article matched
+    doi_pmid = pm_cache_get("doi", dois)
+    pmcid_pmid = pm_cache_get("pmcid", pmcids)
+    dois = [x for x in dois if x not in doi_pmid]
+    pmcids = [x for x in pmcids if x not in pmcid_pmid]
+    terms = sorted(['"%s"[AID]' % x for x in dois] +
+                   ["%s[PMCID]" % x for x in pmcids])
+
+    by_doi = {}
+    by_pmcid = {}
+    for i in xrange(0, len(terms), PUBMED_TERMS):
+        chunk = terms[i:i+PUBMED_TERMS]
+        pmids = []
+        while True:
+            esearch_et = xml.etree.ElementTree.fromstring(ncbi_request(
+                "esearch",
+                {"db": "pubmed", "term": " OR ".join(chunk),
+                 "retstart": str(len(pmids)), "retmax": str(len(chunk) * 2)}
+                ))
+            page = [x.text for x in esearch_et.find("IdList").iter("Id")]
+            pmids.extend(page)
+            if (len(page) == 0 or
+                    len(pmids) >= int(esearch_et.findtext("Count") or 0)):
+                break
+        if len(pmids) == 0:
+            continue
+        esummary_et = xml.etree.ElementTree.fromstring(ncbi_request(
+            "esummary",
+            {"db": "pubmed", "id": ",".join(pmids)}
+            ))
+        for docsum in esummary_et.iter("DocSum"):
+            pmid = docsum.findtext("Id")
+            for id in docsum.iter("Item"):
+                if id.text is None:
+                    continue
+                if id.attrib.get("Name") == "doi":
+                    by_doi.setdefault(id.text.lower(), set()).add(pmid)
+                elif id.attrib.get("Name") == "pmc":
+                    by_pmcid.setdefault(pm_normalise_pmcid(id.text),
+                                        set()).add(pmid)
+
+    for searched, found, result, kind in [(dois, by_doi, doi_pmid, "doi"),
+                                          (pmcids, by_pmcid, pmcid_pmid,
+                                           "pmcid")]:
+        for x in searched:
+            pmids = found.get(x, ())
+            result[x] = list(pmids)[0] if len(pmids) == 1 else ""
+        pm_cache_put(kind, [(x, result[x]) for x in searched])
+
+    for item in missing:
+        if "doi" in item and doi_pmid.get(item["doi"].lower()):
+            item["pmid"] = doi_pmid[item["doi"].lower()]
+        elif ("pmcid" in item and
+                pmcid_pmid.get(pm_normalise_pmcid(item["pmcid"]))):
+            item["pmid"] = pmcid_pmid[pm_normalise_pmcid(item["pmcid"])]
+
+
+def pm_parse_articles(data):
+    """Yield a dictionary for each PubmedArticle in an EFetch response
+
+    The response is parsed incrementally and each article is cleared once it
+    has been read, so the parsed tree never holds more than one article.  The
+    dictionary has the article's "pmid" and, where PubMed has them, its
+    "doi", "pmcid", "publicationTitle", "journalAbbreviation" and
+    "abstractNote".
+    """
+    root = None
+    for event, elem in xml.etree.ElementTree.iterparse(
+            StringIO.StringIO(data), events=("start", "end")):
+        if root is None:
+            root = elem
+        if event != "end" or elem.tag != "PubmedArticle":
+            continue
+
+        record = {"pmid": None}
+        for id in elem.find("PubmedData").find("ArticleIdList"):
+            if id.attrib.get("IdType") == "pubmed":
+                record["pmid"] = id.text
+            elif id.attrib.get("IdType") == "doi":
+                record["doi"] = id.text
+            elif id.attrib.get("IdType") == "pmc":
+                record["pmcid"] = id.text
+        try:
+            journal = elem.find("MedlineCitation").find("Article").find(
+                    "Journal")
+            record["publicationTitle"] = journal.find("Title").text
+            record["journalAbbreviation"] = journal.find(
+                    "ISOAbbreviation").text
+        except AttributeError:
+            pass
+        try:
+            record["abstractNote"] = elem.find("MedlineCitation").find(
+                    "Article").find("Abstract").find("AbstractText").text
+        except AttributeError:
+            pass
+
+        yield record
+        root.clear()
+
+
+def pm_fetch_articles(pmids):
+    """Yield a dictionary (see pm_parse_articles) for each PMID in pmids
+
+    Articles in the cache are returned from there.  The remainder are
+    requested PUBMED_FETCH at a time, with up to PUBMED_WORKERS EFetch
+    requests in flight at once within the NCBI rate limit, and cached.
+    """
+    def fetch(chunk):
+        return list(pm_parse_articles(ncbi_request("efetch", {
+            "db": "pubmed",
+            "id": ",".join(chunk),
+            "rettype": "abstract",
+            "retmode": "xml"
+            })))
+
+    cached = pm_cache_get("pmid", pmids)
+    for pmid in pmids:
+        if pmid in cached:
+            yield json.loads(cached[pmid])
+
+    pmids = [x for x in pmids if x not in cached]
+    chunks = (pmids[i:i+PUBMED_FETCH]
+              for i in xrange(0, len(pmids), PUBMED_FETCH))
+    for records in pool_imap(fetch, chunks, PUBMED_WORKERS):
+        pm_cache_put("pmid", [(record["pmid"], json.dumps(record))
+                              for record in records
+                              if record["pmid"] is not None])
+        for record in records:
+            yield record
+
+
+@timed("pmclean")
 def pmclean(import_items, pubmed_cleanup):
     """Clean entries by querying the PubMed database"""
-    last_sent = datetime.datetime.now()
-
-    # See if we can retrieve a PMID for items with a DOI but no PMID
-    for i, item in enumerate(import_items):
-        if "doi" in item and "pmid" not in item:
-            # Crude way of limiting requests to a third of a second between the
-            current = datetime.datetime.now()
-            time_passed = current - last_sent
-            if time_passed.total_seconds() < (1.0/3):
-                time.sleep((1.0/3) - time_passed.total_seconds())
-            last_sent = datetime.datetime.now()
-
-            esearch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-            esearch_params = urllib.urlencode({
-                "db": "pubmed",
-                "term": '"%s"[AID]' % item["doi"]
-                })
-            esearch_req = urllib2.Request(esearch_url, esearch_params)
-            esearch_res = urllib2.urlopen(esearch_req)
-            esearch_et = xml.etree.ElementTree.parse(esearch_res)
-            if esearch_et.find("Count").text == "1":
-                import_items[i]["pmid"] = esearch_et.find("IdList").find("Id").text
-
-    # See if we can retrieve a PMID for items with a PMCID but no PMID
-    for i, item in enumerate(import_items):
-        if "pmcid" in item and "pmid" not in item:
-            current = datetime.datetime.now()
-            time_passed = current - last_sent
-            if time_passed.total_seconds() < (1.0/3):
-                time.sleep((1.0/3) - time_passed.total_seconds())
-            last_sent = datetime.datetime.now()
-
-            esearch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-            esearch_params = urllib.urlencode({
-                "db": "pubmed",
-                "term": item["pmcid"]
-                })
-            esearch_req = urllib2.Request(esearch_url, esearch_params)
-            esearch_res = urllib2.urlopen(esearch_req)
-            esearch_et = xml.etree.ElementTree.parse(esearch_res)
-            if esearch_et.find("Count").text == "1":
-                import_items[i]["pmid"] = esearch_et.find("IdList").find("Id").text
-
-    id_list = []
-    # TODO: Iterate retstart to enable more than 10000 articles to be retrieved
-    if len(id_list) > 10000:
-        sys.exit("Error: more than 10000 articles would be sent to PubMed EFetch")
+    pm_resolve_pmids(import_items)
+
+    by_pmid = {}
     for item in import_items:
         if "pmid" in item:
-            id_list.append(item["pmid"])
-    efetch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-    efetch_params = urllib.urlencode({
-        "db": "pubmed",
-        "id": ",".join(id_list),
-        "rettype": "abstract",
-        "retmode": "xml"
-        })
-    efetch_req = urllib2.Request(efetch_url, efetch_params)
-    efetch_res = urllib2.urlopen(efetch_req)
-    efetch_et = xml.etree.ElementTree.parse(efetch_res)
-    for article in efetch_et.iter("PubmedArticle"):
-        # Replace the doi/PMCID and also set import_i, the list index for the
-        # current article in import_items
-        pmid = None
-        doi = None
-        pmcid = None
-        import_i = None
-        for id in article.find("PubmedData").find("ArticleIdList"):
-            if id.attrib.get("IdType") == "pubmed":
-                pmid = id.text
-            elif id.attrib.get("IdType") == "doi":
-                doi = id.text
-            elif id.attrib.get("IdType") == "pmc":
-                pmcid = id.text
-        for i, item in enumerate(import_items):
-            if "pmid" in item and item["pmid"] == pmid:
-                import_i = i
-        if import_i:
-            if doi:
-                import_items[import_i]["doi"] = doi
-            if pmcid:
-                import_items[import_i]["pmcid"] = pmcid
+            by_pmid.setdefault(item["pmid"], []).append(item)
+
+    for record in pm_fetch_articles(sorted(by_pmid)):
+        # Replace the doi/PMCID, and the journal and abstract if requested
+        for item in by_pmid.get(record["pmid"], []):
+            if record.get("doi"):
+                item["doi"] = record["doi"]
+            if record.get("pmcid"):
+                item["pmcid"] = record["pmcid"]
 
             if "journal" in pubmed_cleanup:
-                try:
-                    import_items[import_i]["publicationTitle"] = article.find(
-                            "MedlineCitation").find("Article").find("Journal").find(
-                                    "Title").text
-                    import_items[import_i]["journalAbbreviation"] = article.find(
-                            "MedlineCitation").find("Article").find("Journal").find(
-                                    "ISOAbbreviation").text
-                except AttributeError:
-                    pass
+                for k in ["publicationTitle", "journalAbbreviation"]:
+                    if k in record:
+                        item[k] = record[k]
 
-            if "abstract" in pubmed_cleanup:
-                try:
-                    import_items[import_i]["abstractNote"] = article.find(
-                            "MedlineCitation").find("Article").find(
-                                    "Abstract").find("AbstractText").text
-                except AttributeError:
-                    pass
+            if "abstract" in pubmed_cleanup and "abstractNote" in record:
+                item["abstractNote"] = record["abstractNote"]
 
+    pm_cache_evict()
     return import_items
 
 
+def ndjson_write(f, objects):
+    """Write each object in objects to the open file f as a line of JSON"""
+    n = 0
+    for obj in objects:
+        f.write(json.dumps(obj))
+        f.write("\n")
+        n += 1
+    return n
+
+
+def ndjson_read(path):
+    """Yield the object on each line of the NDJSON file at path"""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def p_export(papersdb_cursor, pubmed_cleanup, outdir):
+    """Export the papers library as Zotero JSON to NDJSON files in outdir
+
+    collections.ndjson, items.ndjson, notes.ndjson and attachments.ndjson
+    (PubMed entries and then PDFs) hold one object per line, exactly as it
+    would be uploaded to the Zotero API except that papers UUIDs are kept in
+    the "papers_" keys in place of Zotero keys.  manifest.json records the
+    top level papers collection and when papers last modified an item.  The
+    files can be uploaded with the load command.
+    """
+    print "Exporting the Papers library to %s..." % outdir
+    last_modified = p_last_modified(papersdb_cursor)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    path = lambda name: os.path.join(outdir, name)
+
+    p_tld_uuid, p_collections = p_read_collections(papersdb_cursor)
+    levels, orphans = p_collection_levels(p_collections, p_tld_uuid)
+    with open(path("collections.ndjson"), "w") as f:
+        n_collections = ndjson_write(f, ({
+            "name": p_collections[x]["name"],
+            "papers_uuid": x,
+            "papers_parent": p_collections[x]["parent"]
+            } for level in levels for x in level))
+
+    uuids = []
+    counts = {"item": 0, "note": 0, "attachment": 0}
+    with open(path("items.ndjson"), "w") as items_f, \
+            open(path("notes.ndjson"), "w") as notes_f, \
+            open(path("attachments.ndjson"), "w") as attachments_f:
+        for import_items, import_children in p_item_windows(papersdb_cursor,
+                                                            pubmed_cleanup):
+            uuids.extend(item["papers_uuid"] for item in import_items)
+            counts["item"] += ndjson_write(items_f, import_items)
+            counts["note"] += ndjson_write(notes_f, [
+                child for child in import_children
+                if child["itemType"] == "note"])
+            counts["attachment"] += ndjson_write(attachments_f, [
+                child for child in import_children
+                if child["itemType"] != "note"])
+        counts["attachment"] += ndjson_write(
+                attachments_f, p_read_pdfs(papersdb_cursor, uuids))
+
+    with open(path("manifest.json"), "w") as f:
+        json.dump({"papers_tld": p_tld_uuid,
+                   "papers_updated": last_modified,
+                   "pubmed_cleanup": pubmed_cleanup or [],
+                   "exported": datetime.datetime.utcnow().replace(
+                       microsecond=0).isoformat() + "Z"}, f, indent=2)
+    print "Exported %s collection(s), %s item(s), %s note(s) and %s " \
+          "attachment(s)" % (n_collections, counts["item"], counts["note"],
+                             counts["attachment"])
+
+
+def z_load_export(token, userid, indir, journal, datadir):
+    """Upload a library exported by p_export in indir to the Zotero API
+
+    Items are read a window at a time and uploaded by z_recreate_items,
+    followed by their notes and attachments, each of which is uploaded as
+    soon as its item has a key.  The journal works in the same way as for a
+    migration straight from papers.
+    """
+    path = lambda name: os.path.join(indir, name)
+    with open(path("manifest.json")) as f:
+        manifest = json.load(f)
+    p_collections = {}
+    for collection in ndjson_read(path("collections.ndjson")):
+        p_collections[collection["papers_uuid"]] = {
+                "name": collection["name"],
+                "parent": collection["papers_parent"]
+                }
+    collection_map = z_recreate_collections(token, userid,
+                                            manifest["papers_tld"],
+                                            p_collections, journal)
+
+    window_size = BATCH_SIZE * MAX_WORKERS
+
+    def windows():
+        items = ndjson_read(path("items.ndjson"))
+        while True:
+            window = list(itertools.islice(items, window_size))
+            if len(window) == 0:
+                break
+            yield window, []
+        for name in ["notes.ndjson", "attachments.ndjson"]:
+            window = []
+            for child in ndjson_read(path(name)):
+                window.append(child)
+                if len(window) == window_size:
+                    yield [], window
+                    window = []
+            yield [], window
+
+    z_recreate_items(token, userid, windows(), collection_map, journal,
+                     datadir=datadir)
+    journal_finish(journal, manifest.get("papers_updated", 0))
+
+
+def batch_read_manifest(path):
+    """Return the (name, library, token) of each library in a batch manifest
+
+    The manifest holds one JSON object per line giving the "library" (its
+    Library.papers3 directory, relative to the manifest) and the "token"
+    (the Zotero API key of its owner), and optionally a "name" for the
+    directory holding its files, which is otherwise its line number.
+    """
+    libraries = []
+    names = set()
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                library = os.path.join(os.path.dirname(path),
+                                       os.path.expanduser(entry["library"]))
+                token = entry["token"]
+            except (ValueError, KeyError, TypeError) as e:
+                sys.exit("Line %s of %s does not give a library and token "
+                         "(%s)" % (n, path, e))
+            name = unicode(entry.get("name") or n)
+            if name in names or name in (".", "..") or "/" in name:
+                sys.exit("Line %s of %s needs a name that is unique and can "
+                         "be used as a directory name" % (n, path))
+            names.add(name)
+            libraries.append((name, library, token))
+    return libraries
+
+
+def batch_done(path):
+    """Return whether the journal at path records a completed migration"""
+    if not os.path.exists(path):
+        return False
+    journal = sqlite3.connect(path)
+    try:
+        return journal_get(journal, "synced_at") is not None
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        journal.close()
+
+
+def batch_library(job):
+    """Migrate one library of a batch, in a worker process
+
+    job is a (name, args) pair, where args are as for run.  Everything
+    printed goes to the log in the library's directory.  Returns (name,
+    error), where error is None if the migration succeeded.
+    """
+    name, args = job
+    path = os.path.join(os.path.dirname(args.journal), "passport.log")
+    with open(path, "a", 1) as log:
+        sys.stdout = sys.stderr = log
+        print "Migrating %s (%s)" % (args.library, datetime.datetime.now(
+                ).replace(microsecond=0).isoformat())
+        try:
+            run(args)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                print e.code
+                return name, str(e.code)
+        except Exception as e:
+            traceback.print_exc()
+            return name, repr(e)
+        finally:
+            ZOTERO_LIMITER.abandon()
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    return name, None
+
+
+def batch_migrate(args):
+    """Migrate each library in the --manifest, several at once
+
+    Each library is migrated by run in a worker process of its own, with a
+    journal, log, rejects file, metrics report and Zotero index in a
+    directory named after it under --batch-dir.  The worker processes share
+    ZOTERO_LIMITER and NCBI_LIMITER (which main makes shared) and the
+    PubMed cache, so that the batch as a whole keeps within the limits of
+    the APIs.  With --resume, libraries whose journal records a completed
+    migration are skipped and the rest continued.
+    """
+    jobs = []
+    for name, library, token in batch_read_manifest(args.manifest):
+        directory = os.path.join(args.batch_dir, name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        journal = os.path.join(directory, "journal.sqlite")
+        if args.resume and batch_done(journal):
+            print "%s: already migrated" % name
+            continue
+        job_args = copy.copy(args)
+        job_args.command = "migrate"
+        job_args.library = library
+        job_args.token = token
+        job_args.journal = journal
+        job_args.rejects = os.path.join(directory, "rejects.ndjson")
+        job_args.metrics_out = os.path.join(directory, "metrics.json")
+        job_args.zotero_index = os.path.join(directory, "zotero-index.sqlite")
+        jobs.append((name, job_args))
+    if len(jobs) == 0:
+        return
+
+    processes = min(args.processes or multiprocessing.cpu_count(), len(jobs))
+    print "Migrating %s libraries, %s at a time (logs are in %s)..." % (
+            len(jobs), processes, args.batch_dir)
+    # Every library gets a fresh worker process, which inherits the shared
+    # limiters but nothing left behind by the library before it
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    failed = []
+    try:
+        results = pool.imap_unordered(batch_library, jobs)
+        for i in xrange(1, len(jobs) + 1):
+            # Waiting with a timeout keeps the main process responsive to ^C
+            while True:
+                try:
+                    name, error = results.next(1)
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+            if error is None:
+                print "[%s/%s] %s: migrated" % (i, len(jobs), name)
+            else:
+                failed.append(name)
+                print "[%s/%s] %s: failed: %s" % (i, len(jobs), name, error)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+    if len(failed) > 0:
+        sys.exit("%s of %s libraries were not migrated: see their logs in %s" %
+                 (len(failed), len(jobs), args.batch_dir))
+
+
 def main():
+    global WORKERS, GZIP_BODIES, NCBI_API_KEY, NCBI_LIMITER, PUBMED_FETCH
+    global PUBMED_CACHE_TTL, PUBMED_CACHE_SIZE
+    global PDF_WORKERS, PDF_LINK, PDF_UPLOAD
+    global MAX_WORKERS, ZOTERO_LIMITER, DUPLICATES, PAPERS_PLIST
     description = """
     Import a Papers 3 library to Zotero.  For more information see:
     https://andrewlkho.github.com/passport.
     """
     parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("command",
+                        nargs="?",
+                        choices=["migrate", "export", "load", "sync",
+                                 "verify", "batch"],
+                        default="migrate",
+                        help="migrate straight from Papers to Zotero (the "
+                             "default), export Papers to files, load "
+                             "exported files into Zotero, sync changes "
+                             "made in Papers since the last run, verify "
+                             "that each collection holds as many items in "
+                             "Zotero as in Papers or migrate each library "
+                             "in --manifest")
+    parser.add_argument("--export-dir",
+                        default="passport-export",
+                        help="Directory written by export and read by load "
+                             "(default: %(default)s)")
     parser.add_argument("--token",
                         help="Specify API key")
+    parser.add_argument("--library",
+                        help="Papers library (Library.papers3 directory) to "
+                             "read, for example a copy on another machine "
+                             "(default: the one in the Papers preferences)")
+    parser.add_argument("--plist",
+                        default=PAPERS_PLIST,
+                        help="Papers preferences giving the location of the "
+                             "library (default: %(default)s)")
+    parser.add_argument("--engine",
+                        choices=["api", "local"],
+                        default="api",
+                        help="Write to Zotero through the web API (the "
+                             "default) or straight into the local Zotero "
+                             "database, which Zotero must not be running to "
+                             "use and then syncs to zotero.org itself")
+    parser.add_argument("--zotero-dir",
+                        help="Zotero data directory (default: the one set "
+                             "in the Zotero preferences)")
+    parser.add_argument("--journal",
+                        default="passport-journal.sqlite",
+                        help="Checkpoint journal recording what has been "
+                             "uploaded (default: %(default)s)")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Continue the migration recorded in the journal")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=WORKERS,
+                        help="Number of concurrent requests to the Zotero API "
+                             "to start with (default: %(default)s)")
+    parser.add_argument("--max-workers",
+                        type=int,
+                        default=MAX_WORKERS,
+                        help="Most concurrent requests to the Zotero API "
+                             "while it keeps up (default: %(default)s)")
+    parser.add_argument("--no-gzip",
+                        action="store_true",
+                        help="Do not compress request bodies sent to Zotero")
+    parser.add_argument("--copy-workers",
+                        type=int,
+                        default=PDF_WORKERS,
+                        help="Number of PDFs copied or uploaded at once "
+                             "(default: %(default)s)")
+    parser.add_argument("--upload-pdfs",
+                        action="store_true",
+                        help="Upload PDFs to Zotero file storage instead of "
+                             "copying them to the local Zotero data directory")
+    parser.add_argument("--link-pdfs",
+                        action="store_true",
+                        help="Hard link PDFs into Zotero storage instead of "
+                             "copying them where possible; Zotero and Papers "
+                             "will then share the same files")
     parser.add_argument("--pubmed-cleanup",
                         action="append",
                         choices=["journal", "abstract"],
                         help="Look up and replace metadata from PubMed")
+    parser.add_argument("--efetch-size",
+                        type=int,
+                        default=PUBMED_FETCH,
+                        help="Number of articles requested from PubMed at a "
+                             "time (default: %(default)s)")
+    parser.add_argument("--pubmed-cache",
+                        default=os.path.expanduser(
+                            "~/.passport/pubmed-cache.sqlite"),
+                        help="Cache of PubMed lookups shared between runs "
+                             "(default: %(default)s)")
+    parser.add_argument("--no-pubmed-cache",
+                        action="store_true",
+                        help="Always look everything up in PubMed afresh")
+    parser.add_argument("--pubmed-cache-ttl",
+                        type=float,
+                        default=PUBMED_CACHE_TTL / (24 * 60 * 60),
+                        help="Days before a cached PubMed lookup is repeated "
+                             "(default: %(default)s)")
+    parser.add_argument("--pubmed-cache-size",
+                        type=float,
+                        default=PUBMED_CACHE_SIZE / (1024 * 1024),
+                        help="Size in MB beyond which the least recently used "
+                             "cache entries are dropped (default: "
+                             "%(default)s)")
+    parser.add_argument("--ncbi-api-key",
+                        help="NCBI API key, allowing faster PubMed lookups")
+    parser.add_argument("--metrics-out",
+                        help="Write phase timings, sqlite statement "
+                             "statistics and HTTP request statistics to this "
+                             "file as JSON")
+    parser.add_argument("--rejects",
+                        default="passport-rejects.ndjson",
+                        help="File to which objects that Zotero refused are "
+                             "appended (default: %(default)s)")
+    parser.add_argument("--duplicates",
+                        choices=["upload", "skip", "link"],
+                        default=DUPLICATES,
+                        help="What to do with items already in the Zotero "
+                             "library: upload them anyway (the default), "
+                             "skip them, or add their notes, PDFs and "
+                             "collections to the existing item")
+    parser.add_argument("--zotero-index",
+                        default=os.path.expanduser(
+                            "~/.passport/zotero-index.sqlite"),
+                        help="Index of the Zotero library used to find "
+                             "duplicates, kept between runs (default: "
+                             "%(default)s)")
+    parser.add_argument("--manifest",
+                        help="Libraries for batch to migrate: a file with "
+                             "one JSON object per line giving the \"library\" "
+                             "(Library.papers3 directory), the \"token\" for "
+                             "its owner's Zotero library and optionally a "
+                             "\"name\"")
+    parser.add_argument("--batch-dir",
+                        default="passport-batch",
+                        help="Directory in which batch keeps the journal, "
+                             "log, rejects and metrics of each library "
+                             "(default: %(default)s)")
+    parser.add_argument("--processes",
+                        type=int,
+                        help="Number of libraries batch migrates at once "
+                             "(default: the number of CPUs)")
     args = parser.parse_args()
-
-    papersdb_cursor = open_papersdb()
-    userid = z_get_userid(args.token)
-    collection_map = z_recreate_collections(args.token, userid, papersdb_cursor)
-    item_map = z_recreate_items(args.token, userid, papersdb_cursor,
-            collection_map, args.pubmed_cleanup)
-    z_recreate_pdfs(args.token, userid, papersdb_cursor, item_map)
+    local = args.engine == "local"
+    batch = args.command == "batch"
+    if (args.command not in ("export", "batch") and not args.token
+            and not local):
+        parser.error("--token is required to %s" % args.command)
+    if local and args.command in ("sync", "verify", "batch"):
+        parser.error("%s works only through the web API" % args.command)
+    if batch and not args.manifest:
+        parser.error("--manifest is required for batch")
+    if batch and not args.upload_pdfs:
+        parser.error("batch needs --upload-pdfs, since each library's PDFs "
+                     "belong in its owner's Zotero storage")
+    if local and args.upload_pdfs:
+        parser.error("--upload-pdfs cannot be used with --engine local")
+    if local and args.duplicates != "upload":
+        parser.error("--duplicates works only through the web API")
+
+    # A batch's worker processes share the limiters made here
+    WORKERS = args.workers
+    MAX_WORKERS = max(args.max_workers, WORKERS)
+    ZOTERO_LIMITER = AdaptiveLimiter(WORKERS, MAX_WORKERS, batch)
+    GZIP_BODIES = not args.no_gzip
+    PUBMED_FETCH = args.efetch_size
+    PDF_WORKERS = args.copy_workers
+    PDF_LINK = args.link_pdfs
+    PDF_UPLOAD = args.upload_pdfs
+    PAPERS_PLIST = args.plist
+    DUPLICATES = args.duplicates
+    PUBMED_CACHE_TTL = args.pubmed_cache_ttl * 24 * 60 * 60
+    PUBMED_CACHE_SIZE = args.pubmed_cache_size * 1024 * 1024
+    if args.ncbi_api_key:
+        NCBI_API_KEY = args.ncbi_api_key
+    if args.ncbi_api_key or batch:
+        NCBI_LIMITER = RateLimiter(10 if args.ncbi_api_key else 3,
+                                   shared=batch)
+
+    if batch:
+        batch_migrate(args)
+    else:
+        run(args)
+
+
+def run(args):
+    """Carry out the command in args, as parsed by main, for one library
+
+    The settings common to every library, including the rate limiters, are
+    set up by main beforehand.
+    """
+    global PUBMED_CACHE, METRICS, REJECTS, LOCAL_DB, ZOTERO_INDEX
+    global PAPERS_LIBRARY
+    REJECTS = args.rejects
+    PAPERS_LIBRARY = args.library
+    if args.pubmed_cleanup and not args.no_pubmed_cache:
+        PUBMED_CACHE = pm_cache_open(args.pubmed_cache)
+    if args.metrics_out:
+        METRICS = Metrics()
+        METRICS.add_limiter("zotero", ZOTERO_LIMITER)
+
+    local = args.engine == "local"
+    try:
+        if args.command == "export":
+            papersdb_cursor = open_papersdb()
+            p_export(papersdb_cursor, args.pubmed_cleanup, args.export_dir)
+            return
+
+        datadir = None
+        if not PDF_UPLOAD and args.command != "verify":
+            datadir = args.zotero_dir or z_local_datadir()
+        if local:
+            LOCAL_DB = ZoteroLocal(os.path.join(datadir, "zotero.sqlite"))
+            userid = LOCAL_DB.userid
+        else:
+            userid = z_get_userid(args.token)
+
+        if args.command == "verify":
+            papersdb_cursor = open_papersdb()
+            journal = journal_open(args.journal, userid, True)
+            collection_map = journal_map(journal, "collection")
+            if len(collection_map) == 0:
+                sys.exit("The journal at %s does not record a migration to "
+                         "verify" % args.journal)
+            p_tld_uuid, p_collections = p_read_collections(papersdb_cursor)
+            mismatches = z_verify_collections(
+                    args.token, userid, p_tld_uuid, p_collections,
+                    p_collection_counts(papersdb_cursor, p_tld_uuid),
+                    collection_map)
+            if len(mismatches) > 0:
+                sys.exit("%s of %s collection(s) differ from Papers" % (
+                    len(mismatches), len(p_collections) + 1))
+            print "All %s collection(s) match Papers" % (
+                    len(p_collections) + 1)
+            return
+
+        ZOTERO_INDEX = None
+        if DUPLICATES != "upload":
+            ZOTERO_INDEX = z_index_open(args.zotero_index)
+            z_index_update(args.token, userid)
+
+        if args.command == "load":
+            journal = journal_open(args.journal, userid, args.resume)
+            z_load_export(args.token, userid, args.export_dir, journal,
+                          datadir)
+            return
+
+        papersdb_cursor = open_papersdb()
+        sync = args.command == "sync"
+        journal = journal_open(args.journal, userid, args.resume or sync)
+        if sync and journal_get(journal, "synced_at") is None:
+            sys.exit("The journal at %s does not record a completed "
+                     "migration to sync from" % args.journal)
+        # Anything papers changes from now on is picked up by the next sync
+        last_modified = p_last_modified(papersdb_cursor)
+        p_tld_uuid, p_collections = p_read_collections(papersdb_cursor)
+        collection_map = z_recreate_collections(args.token, userid,
+                p_tld_uuid, p_collections, journal)
+        # PDFs are listed up front so that each can be attached as soon as
+        # its item is uploaded, but only hashed to find duplicates as their
+        # items are read.  A sync only looks at PDFs it has not seen before.
+        pdfs = p_read_pdfs(papersdb_cursor, None,
+                           journal_map(journal, "pdf") if sync else (),
+                           dedup=False)
+        if sync:
+            z_sync_items(args.token, userid, papersdb_cursor, collection_map,
+                         args.pubmed_cleanup, journal, pdfs, datadir)
+        else:
+            z_recreate_items(args.token, userid,
+                    p_item_windows(papersdb_cursor, args.pubmed_cleanup),
+                    collection_map, journal, pdfs, datadir)
+        journal_finish(journal, last_modified)
+    finally:
+        # The report is written even if the migration fails part way
+        if METRICS is not None:
+            with open(args.metrics_out, "w") as f:
+                json.dump(METRICS.report(), f, indent=2, sort_keys=True)
 
 
 if __name__ == "__main__":
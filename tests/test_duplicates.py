@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""Check how papers already in the Zotero library are found
+
+A synthetic library from benchmarks/papersdb.py is migrated to the mock
+Zotero server from benchmarks/mockservers.py and then migrated again with
+--duplicates skip, which should find every paper in the index of the
+Zotero library.
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import mockservers
+import papersdb
+import passport
+
+
+class DuplicatesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp(prefix="passport-test-")
+        cls.library = os.path.join(cls.workdir, "Library.papers3")
+        papersdb.generate(cls.library, 100, pdfs=0, seed=2)
+        cls.zotero = mockservers.start(mockservers.ZoteroHandler)
+        passport.ZOTERO_API = cls.zotero.url
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.zotero.shutdown()
+        cls.zotero.server_close()
+        shutil.rmtree(cls.workdir)
+
+    def passport(self, journal, *args):
+        sys.argv = ["passport.py", "migrate"] + list(args) + [
+                "--token", "test", "--library", self.library,
+                "--journal", os.path.join(self.workdir, journal),
+                "--zotero-index", os.path.join(self.workdir, "index.sqlite"),
+                "--upload-pdfs", "--no-pubmed-cache"]
+        passport.main()
+
+    def items(self):
+        return dict((key, obj)
+                    for key, obj in mockservers.ZoteroHandler.objects.items()
+                    if obj["itemType"] not in ("note", "attachment"))
+
+    def test_trashed_item_is_not_a_duplicate(self):
+        self.passport("first.sqlite")
+        uploaded = self.items()
+        self.passport("second.sqlite", "--duplicates", "skip")
+        self.assertEqual(self.items(), uploaded)
+
+        # Trashing an item in Zotero updates its version, and it has to be
+        # dropped from the index rather than standing in for the paper
+        handler = mockservers.ZoteroHandler
+        key = sorted(uploaded)[0]
+        with handler.versions_lock:
+            handler.library["version"] += 1
+            handler.versions[key] = handler.library["version"]
+            handler.objects[key]["deleted"] = 1
+        self.passport("third.sqlite", "--duplicates", "skip")
+        index = sqlite3.connect(os.path.join(self.workdir, "index.sqlite"))
+        self.assertIsNone(index.execute("SELECT key FROM items "
+                                        "WHERE key = ?;", (key,)).fetchone())
+        index.close()
+        added = [x for x in self.items() if x not in uploaded]
+        self.assertEqual(len(added), 1)
+        self.assertEqual(self.items()[added[0]]["title"],
+                         uploaded[key]["title"])
+
+
+if __name__ == "__main__":
+    unittest.main()
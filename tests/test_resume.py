@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""Check that a migration which fails part way can be resumed cleanly
+
+A synthetic library from benchmarks/papersdb.py is migrated to the mock
+Zotero server from benchmarks/mockservers.py, which is made to refuse one
+write.  Resuming the migration must then leave exactly one copy of every
+object in Zotero.
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import mockservers
+import papersdb
+import passport
+
+
+class ResumeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp(prefix="passport-test-")
+        cls.library = os.path.join(cls.workdir, "Library.papers3")
+        papersdb.generate(cls.library, 600, pdfs=0.2, pdf_size=1, seed=1)
+        db = sqlite3.connect(os.path.join(cls.library, "Database.papersdb"))
+        cls.items = db.execute("SELECT COUNT(*) "
+                               "FROM Publication a, Publication b "
+                               "WHERE a.bundle = b.uuid "
+                               "AND a.type >= 0 "
+                               "AND a.privacy_level = 0;").fetchone()[0]
+        db.close()
+        cls.zotero = mockservers.start(mockservers.ZoteroHandler,
+                                       latency=0.02)
+        passport.ZOTERO_API = cls.zotero.url
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.zotero.shutdown()
+        cls.zotero.server_close()
+        shutil.rmtree(cls.workdir)
+
+    def setUp(self):
+        handler = mockservers.ZoteroHandler
+        for state in [handler.files, handler.versions, handler.objects,
+                      handler.library]:
+            state.clear()
+        handler.library["version"] = 0
+        handler.fail_writes.clear()
+        self.journal = os.path.join(self.workdir, "journal.sqlite")
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+    def passport(self, *args):
+        sys.argv = ["passport.py"] + list(args) + [
+                "--token", "test", "--library", self.library,
+                "--journal", self.journal, "--upload-pdfs",
+                "--duplicates", "upload", "--no-pubmed-cache",
+                "--rejects", os.path.join(self.workdir, "rejects.ndjson")]
+        passport.main()
+
+    def zotero_counts(self):
+        counts = {}
+        for obj in mockservers.ZoteroHandler.objects.itervalues():
+            kind = obj["itemType"]
+            if kind not in ("note", "attachment"):
+                kind = "item"
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def journal_counts(self):
+        journal = sqlite3.connect(self.journal)
+        counts = dict(journal.execute("SELECT kind, COUNT(*) FROM map "
+                                      "GROUP BY kind;"))
+        journal.close()
+        return counts
+
+    def test_api_write_records_batches_in_flight(self):
+        books = [{"itemType": "book", "title": "Book %s" % i,
+                  "papers_uuid": str(i)} for i in xrange(600)]
+        url = "%s/users/1/items" % self.zotero.url
+        journal = passport.journal_open(self.journal, 1, False)
+        mockservers.ZoteroHandler.fail_writes.add(8)
+        self.assertRaises(SystemExit, passport.z_api_write, "test", url,
+                          books, passport.journal_recorder(
+                              journal, [("item", x["papers_uuid"])
+                                        for x in books]))
+        done = passport.journal_map(journal, "item")
+        self.assertEqual(self.zotero_counts()["item"], len(done))
+
+        books = [x for x in books if x["papers_uuid"] not in done]
+        passport.z_api_write("test", url, books, passport.journal_recorder(
+                journal, [("item", x["papers_uuid"]) for x in books]))
+        journal.close()
+        self.assertEqual(self.zotero_counts()["item"], 600)
+        self.assertEqual(self.journal_counts()["item"], 600)
+
+    def test_resume_after_failed_write(self):
+        mockservers.ZoteroHandler.fail_writes.add(8)
+        self.assertRaises(SystemExit, self.passport, "migrate")
+        written = self.zotero_counts()
+        self.assertEqual(written.get("item", 0),
+                         self.journal_counts().get("item", 0))
+        self.assertLess(written.get("item", 0), self.items)
+
+        self.passport("migrate", "--resume")
+        written = self.zotero_counts()
+        journaled = self.journal_counts()
+        self.assertEqual(written["item"], self.items)
+        self.assertEqual(journaled["item"], self.items)
+        self.assertEqual(written["note"], journaled["note"])
+        self.assertEqual(written["attachment"],
+                         journaled["pdf"] + journaled.get("pubmed", 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Check that objects Zotero refuses do not stop the rest being written
+
+The mock Zotero server from benchmarks/mockservers.py is made to refuse any
+write holding an object over a given size, as the real API does with HTTP
+413, so that the whole batch holding it is refused.
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import mockservers
+import passport
+
+
+class WriteTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.zotero = mockservers.start(mockservers.ZoteroHandler)
+        passport.ZOTERO_API = cls.zotero.url
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.zotero.shutdown()
+        cls.zotero.server_close()
+
+    def setUp(self):
+        handler = mockservers.ZoteroHandler
+        for state in [handler.files, handler.versions, handler.objects,
+                      handler.library]:
+            state.clear()
+        handler.library["version"] = 0
+        handler.fail_writes.clear()
+        handler.max_object_bytes = 10000
+        passport.REJECTS = None
+
+    def tearDown(self):
+        mockservers.ZoteroHandler.max_object_bytes = None
+
+    def test_large_object_fails_alone(self):
+        books = [{"itemType": "book", "title": "Book %s" % i}
+                 for i in xrange(50)]
+        books[17]["abstractNote"] = "x" * 20000
+        written = {}
+
+        def record(success, version):
+            written.update(success)
+
+        url = "%s/users/1/items" % self.zotero.url
+        passport.z_api_write("test", url, books, record)
+        self.assertEqual(len(written), 49)
+        self.assertNotIn(17, written)
+        self.assertEqual(len(mockservers.ZoteroHandler.objects), 49)
+
+
+if __name__ == "__main__":
+    unittest.main()